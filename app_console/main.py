@@ -28,6 +28,7 @@ from app_web.Common.logger import *
 from app_web.Common.OAIUtils import *
 from app_web.Common import ChatAICore
 from app_web.Common.MsgThread import MsgThread
+from app_web.Common.MsgJournal import MsgJournal
 
 import locale
 # Set the locale to the user's default setting/debug
@@ -168,6 +169,10 @@ def local_get_user_info(arguments):
 def local_get_main_MsgThread(arguments):
     return _msg_thread
 
+# Append-only persistence of the thread messages
+def makeThreadJournal(thread_id) -> MsgJournal:
+    return MsgJournal(f'_storage/{USER_BUCKET_PATH}/thread_{thread_id}.jsonl')
+
 # Create the thread if it doesn't exist
 def createThread(force_new=False) -> None:
     global _msg_thread
@@ -180,14 +185,19 @@ def createThread(force_new=False) -> None:
         session['thread_id'] = _msg_thread.thread_id
         if 'msg_thread_data' in session:
             del session['msg_thread_data']
+        _msg_thread.attach_journal(makeThreadJournal(_msg_thread.thread_id))
     else:
-        _msg_thread = MsgThread.from_thread_id(_oa_wrap, session['thread_id'])
+        journal = makeThreadJournal(session['thread_id'])
+        _msg_thread = MsgThread.from_journal(_oa_wrap, journal) if journal.exists() else None
+        if _msg_thread is None:
+            _msg_thread = MsgThread.from_thread_id(_oa_wrap, session['thread_id'])
+            # Migrate the messages from the old full-JSON session data
+            if 'msg_thread_data' in session:
+                _msg_thread.deserialize_data(session['msg_thread_data'])
+                del session['msg_thread_data']
+            _msg_thread.attach_journal(journal)
         logmsg("Retrieved existing thread with ID " + _msg_thread.thread_id)
 
-    # Get our cached thread messages
-    if 'msg_thread_data' in session:
-        _msg_thread.deserialize_data(session['msg_thread_data'])
-
     new_n = _msg_thread.fetch_new_messages(make_file_url)
     print(f"Found {new_n} new messages in the thread history")
     save_session()
@@ -196,11 +206,15 @@ def createThread(force_new=False) -> None:
     # Create the sub-agents system for the message-thread
     _msg_thread.create_judge(
         model=config["support_model_version"],
-        temperature=config["support_model_temperature"])
+        temperature=config["support_model_temperature"],
+        claim_min_score=(config.get("factcheck_prefilter_min_score", 2)
+                         if config.get("factcheck_prefilter", True) else None))
 
 def save_session():
-    session['msg_thread_data'] = _msg_thread.serialize_data()
-    session.save_to_disk()
+    # Messages are appended to the thread journal as they are added,
+    #  only the small session dictionary is saved here
+    if session.modified:
+        session.save_to_disk()
 
 #==================================================================
 logmsg("Creating storage...")
@@ -248,19 +262,18 @@ def index(do_clear=False):
     # Process the history messages
     print(f"Total history messages: {len(_msg_thread.messages)}")
     for msg in _msg_thread.messages:
-        printChatMsg(msg)
+        printChatMsg(msg.to_dict())
 
     #printFactCheck(_msg_thread.gen_fact_check()) # For debugging
 
 #==================================================================
-def printFactCheck(fcRepliesStr: str) -> None:
-    if fcRepliesStr is None:
+def printFactCheck(fcReplies: dict) -> None:
+    if fcReplies is None:
         return
 
-    logmsg(f"Fact-check replies: {fcRepliesStr}")
+    logmsg(f"Fact-check replies: {fcReplies}")
     try:
-        fcReplies = json.loads(fcRepliesStr)
-        if len(fcReplies['fact_checks']) == 0:
+        if len(fcReplies.get('fact_checks') or []) == 0:
             return
         #console.log(fcReplies)
 
@@ -292,9 +305,9 @@ def printFactCheck(fcRepliesStr: str) -> None:
 
         if outStr:
             console.print(Markdown(outStr))
-    except json.JSONDecodeError:
-        logerr("Error decoding JSON response")
-        console.print(Markdown("> " + fcRepliesStr))
+    except (AttributeError, TypeError) as e:
+        logerr(f"Unexpected fact-check format: {e}")
+        console.print(Markdown("> " + str(fcReplies)))
 
 #==================================================================
 # Main loop for console app
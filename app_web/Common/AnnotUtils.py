@@ -15,10 +15,12 @@ def IsImageAnnotation(a) -> bool:
 
 # Replace the file paths with actual URLs
 def ResolveImageAnnotations(out_msg, annotations, make_file_url) -> str:
-    new_msg = out_msg
-    # Sort annotations by start_index in descending order
-    sorted_annotations = sorted(annotations, key=lambda x: x.start_index, reverse=True)
+    # Build the new message in pieces, in order of start_index
+    #  (slicing the whole message for each annotation is quadratic)
+    sorted_annotations = sorted(annotations, key=lambda x: x.start_index)
 
+    parts = []
+    last_end = 0
     for a in sorted_annotations:
         if IsImageAnnotation(a):
             file_id = a.file_path.file_id
@@ -37,9 +39,12 @@ def ResolveImageAnnotations(out_msg, annotations, make_file_url) -> str:
             logmsg(f"Replacing file path {a.text} with URL {file_url}")
 
             # Replace the file path with the file URL
-            new_msg = new_msg[:a.start_index] + file_url + new_msg[a.end_index:]
+            parts.append(out_msg[last_end:a.start_index])
+            parts.append(file_url)
+            last_end = max(last_end, a.end_index)
 
-    return new_msg
+    parts.append(out_msg[last_end:])
+    return "".join(parts)
 
 def ResolveCiteAnnotations(out_msg, annotations, wrap) -> str:
     citations = []
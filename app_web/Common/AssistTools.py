@@ -5,29 +5,44 @@
 # Description: Tools for the assistant (aka function-calling/actions)
 #==================================================================
 
+import os
 import json
 import time
 import pytz
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock
 from datetime import datetime
-from duckduckgo_search import DDGS
 from .logger import *
 from typing import Callable, Optional
 from .MsgThread import MsgThread as MsgThread
+from . import ResearchEngine
+from . import WebSearch
+from . import PageFetch
+from .ToolRegistry import ToolItem, ToolRegistry
 
 # Directory for persisting llmaindex index data
 RAG_INDEX_PERSIST_DIR = "_index_data"
 # Directory for persisting Chroma data
 RAG_CHROMA_PERSIST_DIR = "_chroma_db"
+# Directory of the in-process vector index (see VectorIndex)
+RAG_VECTOR_INDEX_DIR = "_vector_index"
+# Candidates per query taken from each retriever before the fusion, times top-k
+RAG_HYBRID_CANDIDATES_FACTOR = 4
+# Max number of cached query embeddings
+RAG_EMBED_CACHE_SIZE = 1024
 
 #==================================================================
 # Define the super_get_user_info function
 super_get_user_info: Callable[[Optional[dict]], dict] = lambda arguments=None: None
 super_get_main_MsgThread: Callable[[], MsgThread] = lambda: None
+# Run the research searches up front and concurrently, see ResearchEngine
+research_fan_out = True
 
 #==================================================================
 def ddgsTextSearch(query, max_results=None):
     """
-    Perform a text search using the DuckDuckGo Search API.
+    Perform a text search with the configured backend (DuckDuckGo by default, see WebSearch).
 
     Args:
         query (str): The search query string.
@@ -35,14 +50,17 @@ def ddgsTextSearch(query, max_results=None):
 
     Returns:
         list of dict: A list of search results, each result being a dictionary.
+        Empty on errors, timeouts and when rate-limited.
     """
-    with DDGS() as ddgs:
-        results = [r for r in ddgs.text(query, max_results=max_results)]
-    return results
+    return WebSearch.search(query, max_results=max_results)
 
 # Define your functions
 def perform_web_search(arguments):
-    return ddgsTextSearch(arguments["query"], max_results=10)
+    results = ddgsTextSearch(arguments["query"], max_results=10)
+    # Add the relevant text of the top pages, so that one search is usually enough
+    if PageFetch.is_enabled():
+        results = PageFetch.add_passages(results, arguments["query"])
+    return results
 
 def get_user_info(arguments=None):
     return { "user_info": super_get_user_info(arguments) }
@@ -79,25 +97,33 @@ def ask_research_assistant(arguments=None):
         logwarn("No main message thread or judge found. Falling back to web search.")
         return ddgsTextSearch(arguments["query"], max_results=5)
 
+    evidence = None
+    if research_fan_out:
+        evidence = ResearchEngine.gather_evidence(
+            arguments["query"],
+            web_search_fn=ddgsTextSearch,
+            kb_search_fn=rag_system.search_many if rag_system else None)
+
     return msg_thread.judge.gen_research(
                 wrap=arguments["wrap"],
                 query=arguments["query"],
-                tools_user_data=arguments["tools_user_data"])
+                tools_user_data=arguments["tools_user_data"],
+                evidence=evidence)
 
-from typing import List, Dict, Any
-from pydantic import BaseModel
+def research_fallback(arguments):
+    """ A plain web search, when the research assistant fails """
+    return ddgsTextSearch(arguments["query"], max_results=5)
 
-class ToolItem(BaseModel):
-    name: str
-    function: Callable[[dict], Any]
-    requires_assistant: bool = False
-    definition: Dict[str, Any]
+#==================================================================
+# All the tools, by name
+registry = ToolRegistry()
 
-tool_items = [
+registry.register(
     ToolItem(
         name="get_user_info",
         function=get_user_info,
         requires_assistant=False,
+        timeout=5.0,
         definition={
             "name": "get_user_info",
             "description": "Get the user info, such as timezone and user-agent (browser)",
@@ -107,6 +133,7 @@ tool_items = [
         name="get_unix_time",
         function=get_unix_time,
         requires_assistant=False,
+        timeout=5.0,
         definition={
             "name": "get_unix_time",
             "description": "Get the current unix time",
@@ -116,6 +143,7 @@ tool_items = [
         name="get_user_local_time",
         function=get_user_local_time,
         requires_assistant=False,
+        timeout=5.0,
         definition={
             "name": "get_user_local_time",
             "description": "Get the user local time and timezone",
@@ -125,6 +153,9 @@ tool_items = [
         name="ask_research_assistant",
         function=ask_research_assistant,
         requires_assistant=True,
+        timeout=90.0,
+        max_concurrency=8,
+        fallback=research_fallback,
         definition={
             "name": "ask_research_assistant",
             "description": "Ask the research assistant for help",
@@ -140,7 +171,7 @@ tool_items = [
             }
         }
     )
-]
+)
 
 def fallback_tool_function(name, arguments):
     logerr(f"Unknown function {name}. Falling back to web search !")
@@ -151,46 +182,44 @@ def fallback_tool_function(name, arguments):
 
 #==================================================================
 # RAG (Retrieval Augmented Generation) tools
-import chromadb
-from llama_index.core import StorageContext, load_index_from_storage
-from llama_index.vector_stores.chroma import ChromaVectorStore
-
 class RAGSystem:
-    def __init__(self, storage, rag_query_instructions):
+    def __init__(self, storage, rag_query_instructions, top_k=5, backend="chroma",
+                 quantize_int8=False, hybrid=True, rerank=True):
+        # Heavy imports, only when the RAG is used
+        from llama_index.core import Settings
+
         self.tool_items = []
         self.index = None
-        self.query_engine = None
+        self.retriever = None
+        self.vector_index = None
+        self.lexical_index = None
+        self.rerank = rerank
         self.rag_query_instructions = rag_query_instructions
+        self.top_k = top_k
+        self.backend = backend
+
+        # Query embeddings by final query string (LRU)
+        self.embed_cache = OrderedDict()
+        self.embed_lock = Lock()
+        self.stats = {"queries": 0, "embed_hits": 0, "embed_misses": 0, "embed_batches": 0,
+                      "lexical_only_results": 0}
 
         try:
-            logmsg("Downloading RAG index and Chroma data...")
-            storage.download_dir(
-                local_dir=RAG_INDEX_PERSIST_DIR,
-                cloud_dir=RAG_INDEX_PERSIST_DIR,
-                use_file_listing=True)
-            storage.download_dir(
-                local_dir=RAG_CHROMA_PERSIST_DIR,
-                cloud_dir=RAG_CHROMA_PERSIST_DIR,
-                use_file_listing=True)
+            if backend == "numpy":
+                self._load_vector_index(storage, quantize_int8, hybrid)
+            elif backend == "chroma":
+                self._load_chroma_index(storage)
+            else:
+                raise ValueError(f"Unknown RAG backend {backend}")
         except Exception as e:
-            logerr(f"Error downloading RAG index: {e}")
+            logerr(f"Error loading RAG index: {e}")
             return
 
-        # Initialize Chroma client
-        logmsg("Initializing Chroma client...")
-        chdb = chromadb.PersistentClient(path=RAG_CHROMA_PERSIST_DIR)
-        chroma_collection = chdb.get_or_create_collection("quickstart")
-        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
-
-        logmsg("Loading documents and creating index...")
-        storage_context = StorageContext.from_defaults(
-            persist_dir=RAG_INDEX_PERSIST_DIR,
-            vector_store=vector_store)
-
-        # Load the index
-        logmsg("Loading existing index...")
-        self.index = load_index_from_storage(storage_context)
-        self.query_engine = self.index.as_query_engine()
+        self.embed_model = Settings.embed_model
+        # The queries must be embedded like the indexed chunks
+        if self.vector_index is not None and (name := self.vector_index.header.get("embed_model")):
+            if name != getattr(self.embed_model, "model_name", name):
+                logwarn(f"Vector index built with {name}, querying with {self.embed_model.model_name}")
 
         # Append the RAG tool definition
         logmsg("Creating RAG tool definition")
@@ -199,6 +228,10 @@ class RAGSystem:
                 name="search_knowledge_base",
                 function=self.rag_search_knowledge_base,
                 requires_assistant=False,
+                timeout=15.0,
+                max_concurrency=8,
+                cacheable=True,
+                cache_ttl=3600.0,
                 definition={
                     "name": "search_knowledge_base",
                     "description": "Search the knowledge base for information",
@@ -216,44 +249,262 @@ class RAGSystem:
             )
         )
 
-    def rag_search_knowledge_base(self, arguments):
-        query = arguments["query"]
+    def _load_chroma_index(self, storage):
+        """ llama-index storage with the vectors in Chroma """
+        import chromadb
+        from llama_index.core import StorageContext, load_index_from_storage
+        from llama_index.vector_stores.chroma import ChromaVectorStore
+
+        logmsg("Downloading RAG index and Chroma data...")
+        storage.download_dir(
+            local_dir=RAG_INDEX_PERSIST_DIR,
+            cloud_dir=RAG_INDEX_PERSIST_DIR,
+            use_file_listing=True)
+        storage.download_dir(
+            local_dir=RAG_CHROMA_PERSIST_DIR,
+            cloud_dir=RAG_CHROMA_PERSIST_DIR,
+            use_file_listing=True)
 
-        if inst := self.rag_query_instructions:
-            query = query + ". " + inst
-
-        similarity_top_k = 5
-
-        retrieved_docs = self.query_engine.retrieve(query)
+        # Initialize Chroma client
+        logmsg("Initializing Chroma client...")
+        chdb = chromadb.PersistentClient(path=RAG_CHROMA_PERSIST_DIR)
+        chroma_collection = chdb.get_or_create_collection("quickstart")
+        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
 
-        results = []
-        for doc in retrieved_docs[:similarity_top_k]:
-            score = doc.score
-            text = doc.text
-            metadata = doc.node.extra_info
+        logmsg("Loading documents and creating index...")
+        storage_context = StorageContext.from_defaults(
+            persist_dir=RAG_INDEX_PERSIST_DIR,
+            vector_store=vector_store)
 
-            logmsg(f"node.text: {doc.node.text}")
+        # Load the index
+        logmsg("Loading existing index...")
+        self.index = load_index_from_storage(storage_context)
+        # Only the retrieval is needed, with the top-k done by the vector store
+        self.retriever = self.index.as_retriever(similarity_top_k=self.top_k)
+
+    def _load_vector_index(self, storage, quantize_int8, hybrid):
+        """ In-process index (see VectorIndex), no Chroma nor llama-index storage.
+            The files are mapped, so the worker processes share one copy """
+        import shutil
+        import filecmp
+        from .VectorIndex import VectorIndex
+        from .LexicalIndex import LexicalIndex
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None
+
+        # One worker at a time: the first downloads, the others find it done
+        with open(RAG_VECTOR_INDEX_DIR + ".lock", "w") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            # Download to a staging directory, the files of the live one must
+            #  not be rewritten while mapped by other workers
+            logmsg("Downloading RAG vector index...")
+            stage_dir = RAG_VECTOR_INDEX_DIR + ".download"
+            storage.download_dir(
+                local_dir=stage_dir,
+                cloud_dir=RAG_VECTOR_INDEX_DIR,
+                use_file_listing=True)
 
-            result = {
-                "score": score,
-                "text": text,
-                "metadata": metadata
-            }
-            results.append(result)
+            cmp = filecmp.dircmp(stage_dir, RAG_VECTOR_INDEX_DIR) \
+                    if os.path.isdir(RAG_VECTOR_INDEX_DIR) else None
+            if cmp is None or cmp.diff_files or cmp.left_only or cmp.right_only:
+                # Swap in a new copy. The old files stay valid for who has them mapped
+                logmsg("Updating the RAG vector index...")
+                tmp_dir = RAG_VECTOR_INDEX_DIR + ".tmp"
+                old_dir = RAG_VECTOR_INDEX_DIR + ".old"
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                shutil.rmtree(old_dir, ignore_errors=True)
+                shutil.copytree(stage_dir, tmp_dir)
+                if cmp is not None:
+                    os.rename(RAG_VECTOR_INDEX_DIR, old_dir)
+                os.rename(tmp_dir, RAG_VECTOR_INDEX_DIR)
+                shutil.rmtree(old_dir, ignore_errors=True)
+
+            self.vector_index = VectorIndex.load(
+                RAG_VECTOR_INDEX_DIR, quantize=quantize_int8, use_mmap=True)
+            # Built with the vector index, by articles_index_and_upload.py
+            if hybrid and LexicalIndex.exists(RAG_VECTOR_INDEX_DIR):
+                self.lexical_index = LexicalIndex.load(RAG_VECTOR_INDEX_DIR, use_mmap=True)
+
+    def make_final_query(self, query):
+        if inst := self.rag_query_instructions:
+            query = query + ". " + inst
+        return query
+
+    def _embed_texts(self, texts):
+        if len(texts) == 1:
+            return [self.embed_model.get_query_embedding(texts[0])]
+        # OpenAI embeds queries and texts the same way, so one request does it.
+        #  For the other models, the query embeddings are done concurrently
+        if self.embed_model.class_name() == "OpenAIEmbedding":
+            return self.embed_model.get_text_embedding_batch(texts)
+        with ThreadPoolExecutor(max_workers=min(8, len(texts))) as ex:
+            return list(ex.map(self.embed_model.get_query_embedding, texts))
+
+    def embed_queries(self, final_queries) -> list:
+        """ Embeddings of the final queries, from the cache or in one batch """
+        out = {}
+        with self.embed_lock:
+            for q in final_queries:
+                if (emb := self.embed_cache.get(q)) is not None:
+                    self.embed_cache.move_to_end(q)
+                    out[q] = emb
+            missing = [q for q in dict.fromkeys(final_queries) if q not in out]
+            self.stats["embed_hits"] += len(final_queries) - len(missing)
+            self.stats["embed_misses"] += len(missing)
+
+        if missing:
+            embs = self._embed_texts(missing)
+            with self.embed_lock:
+                self.stats["embed_batches"] += 1
+                for q, emb in zip(missing, embs):
+                    out[q] = emb
+                    self.embed_cache[q] = emb
+                    if len(self.embed_cache) > RAG_EMBED_CACHE_SIZE:
+                        self.embed_cache.popitem(last=False)
+
+        return [out[q] for q in final_queries]
+
+    def retrieve_many(self, queries) -> list:
+        """ Top-k results for each query, with the embeddings batched """
+        from llama_index.core import QueryBundle
+        final_queries = [self.make_final_query(q) for q in queries]
+        embeddings = self.embed_queries(final_queries)
+        with self.embed_lock:
+            self.stats["queries"] += len(queries)
+
+        # One matrix product for all the queries
+        if self.vector_index is not None:
+            n_candidates = self.top_k * (RAG_HYBRID_CANDIDATES_FACTOR if self.lexical_index else 1)
+            out = []
+            for q, (ids, scores) in zip(queries, self.vector_index.search_ids(embeddings, n_candidates)):
+                if self.lexical_index is not None:
+                    ids, scores = self._fuse_lexical(q, ids, scores, n_candidates)
+                results = []
+                for i, score in zip(ids[:self.top_k], scores[:self.top_k]):
+                    rec = self.vector_index.records[i]
+                    results.append({
+                        "score": float(score),
+                        "text": rec["text"],
+                        "metadata": rec["metadata"]})
+                out.append(results)
+            return out
+
+        out = []
+        for fq, emb in zip(final_queries, embeddings):
+            nodes = self.retriever.retrieve(QueryBundle(query_str=fq, embedding=emb))
+            out.append([{
+                    "score": doc.score,
+                    "text": doc.text,
+                    "metadata": doc.node.extra_info
+                } for doc in nodes[:self.top_k]])
+        return out
+
+    def _fuse_lexical(self, query, vec_ids, vec_scores, n_candidates):
+        """ Merge the vector candidates with the BM25 ones, then rerank.
+            The lexical search uses the query without the instructions """
+        from .LexicalIndex import hybrid_rank
+        ids, scores = hybrid_rank(
+            self.lexical_index, query, vec_ids, vec_scores, n_candidates,
+            get_text=lambda i: self.vector_index.records[i]["text"],
+            rerank=self.rerank)
+
+        n_lexical_only = len(set(ids[:self.top_k].tolist()) - set(vec_ids[:self.top_k].tolist()))
+        with self.embed_lock:
+            self.stats["lexical_only_results"] += n_lexical_only
+        return ids, scores
+
+    def search_many(self, queries) -> list:
+        """ Merged results of several queries, best score first, no duplicates """
+        best = {}
+        for results in self.retrieve_many(queries):
+            for r in results:
+                if (prev := best.get(r["text"])) is None or (r["score"] or 0) > (prev["score"] or 0):
+                    best[r["text"]] = r
+        return sorted(best.values(), key=lambda r: r["score"] or 0, reverse=True)[:self.top_k]
 
-        return json.dumps(results)
+    def rag_search_knowledge_base(self, arguments):
+        results = self.retrieve_many([arguments["query"]])[0]
+        for r in results:
+            logmsg(f"KB result {r['score']}: {r['text'][:80]}...")
+        # The list as-is, ToolBudget compacts it and fits it to the budget
+        return results
+
+    def get_stats(self) -> dict:
+        with self.embed_lock:
+            stats = dict(self.stats)
+            stats["embed_cache_size"] = len(self.embed_cache)
+        stats["backend"] = self.backend
+        stats["hybrid"] = self.lexical_index is not None
+        if self.vector_index is not None:
+            stats["index_rows"] = len(self.vector_index)
+            stats["index_bytes"] = self.vector_index.nbytes()
+        n = stats["embed_hits"] + stats["embed_misses"]
+        stats["embed_hit_ratio"] = (stats["embed_hits"] / n) if n else 0.0
+        return stats
 
     def get_tool_items(self):
         return self.tool_items
 
 
 #==================================================================
-tool_items_dict = {}
+# RAG readiness: "disabled", "loading", "ready" or "failed"
+_rag_lock = Lock()
+_rag_status = {"state": "disabled", "load_time": None, "error": None}
+
+# The loaded RAGSystem, when ready
+rag_system = None
+
+def get_rag_status() -> dict:
+    with _rag_lock:
+        status = dict(_rag_status)
+    if rag_system is not None:
+        status["stats"] = rag_system.get_stats()
+    return status
+
+def prefetch_kb_queries(queries):
+    """ Embed in one batch the queries of the search_knowledge_base calls of a turn """
+    if rag_system is not None and len(queries) > 1:
+        rag_system.embed_queries([rag_system.make_final_query(q) for q in queries])
+
+def _set_rag_status(**kwargs):
+    with _rag_lock:
+        _rag_status.update(kwargs)
+
+def _init_rag_background(storage, rag_args):
+    """ Download and load the RAG index, then advertise its tools """
+    start_time = time.time()
+    try:
+        rag_sys = RAGSystem(storage, **rag_args)
+    except Exception as e:
+        logerr(f"RAG initialization failed: {e}")
+        _set_rag_status(state="failed", error=str(e), load_time=time.time() - start_time)
+        return
+
+    if not (rag_items := rag_sys.get_tool_items()):
+        _set_rag_status(state="failed", error="No RAG index", load_time=time.time() - start_time)
+        return
+
+    global rag_system
+    rag_system = rag_sys
+    registry.register(*rag_items)
+    _set_rag_status(state="ready", load_time=time.time() - start_time)
+    logmsg(f"RAG ready in {time.time() - start_time:.1f}s")
 
 def initialize_tools(
         enable_rag=False,
         rag_query_instructions=None,
+        rag_top_k=5,
+        rag_backend="chroma",
+        rag_quantize_int8=False,
+        rag_hybrid=True,
+        rag_rerank=True,
         enable_web_search=True,
+        research_fan_out_=True,
+        tool_timeouts=None,
         storage=None,
         super_get_user_info_: Callable[[Optional[dict]], dict]=None,
         super_get_main_MsgThread_: Callable[[], MsgThread]=None):
@@ -264,12 +515,23 @@ def initialize_tools(
     global super_get_user_info
     super_get_user_info = super_get_user_info_
 
+    global research_fan_out
+    research_fan_out = research_fan_out_
+
+    registry.set_timeouts(tool_timeouts)
+
+    # Registered by name, calling this again replaces the tool
     if enable_web_search:
-        tool_items.append(
+        registry.register(
             ToolItem(
                 name="perform_web_search",
                 function=perform_web_search,
                 requires_assistant=False,
+                # Search, then the page downloads (see WebSearch and PageFetch)
+                timeout=25.0,
+                max_concurrency=8,
+                cacheable=True,
+                cache_ttl=600.0,
                 definition={
                     "name": "perform_web_search",
                     "description": "Perform a web search",
@@ -286,12 +548,17 @@ def initialize_tools(
                 }
             )
         )
+    else:
+        registry.unregister("perform_web_search")
 
-    # Try to initialize the RAG
+    # The RAG is loaded in the background, its tools are added when ready
     if enable_rag and storage is not None:
-        rag_sys = RAGSystem(storage, rag_query_instructions)
-        tool_items.extend(rag_sys.get_tool_items())
-
-    # Finally initialize the dictionary only with the enabled tools
-    global tool_items_dict
-    tool_items_dict = {item.name: item for item in tool_items}
+        _set_rag_status(state="loading")
+        rag_args = dict(
+            rag_query_instructions=rag_query_instructions,
+            top_k=rag_top_k,
+            backend=rag_backend,
+            quantize_int8=rag_quantize_int8,
+            hybrid=rag_hybrid,
+            rerank=rag_rerank)
+        Thread(target=_init_rag_background, args=(storage, rag_args), daemon=True).start()
@@ -0,0 +1,141 @@
+#==================================================================
+# ClaimDetector.py
+#
+# Description: Local heuristics to tell if a message has checkable claims
+#==================================================================
+
+import re
+from .StatsUtils import StatsCounter
+
+# Default min score of a sentence to count as a checkable claim
+DEFAULT_MIN_SCORE = 2
+# Below this share of Latin letters the text is always checked (fail open)
+MIN_LATIN_RATIO = 0.8
+
+_code_block_re = re.compile(r"```.*?(```|$)", re.S)
+_inline_code_re = re.compile(r"`[^`\n]*`")
+_url_re = re.compile(r"https?://\S+")
+_sentence_split_re = re.compile(r"(?<=[.!?])\s+(?=[\"'(\[]?[A-Z0-9])|\n+")
+_list_marker_re = re.compile(r"^\s*(?:[-*+]|\d+[.)])\s+")
+
+_number_re = re.compile(r"\b\d")
+# Numbers with a unit or magnitude are a strong hint of a claim
+_quantity_re = re.compile(r"\d[\d,.]*\s*(%|°\s?[CF]\b|(percent|km|kg|m|cm|mm|mi|miles|ft|feet|lbs?|"
+                          r"million|billion|trillion|thousand|hundred|years?|people|dollars|euros|yen)\b)",
+                          re.I)
+_year_re = re.compile(r"\b(1[0-9]{3}|20[0-9]{2})\b")
+_month_re = re.compile(r"\b(January|February|March|April|May|June|July|August|September|"
+                       r"October|November|December)\b")
+# Capitalized words not at the start of the sentence (rough named entities)
+_entity_re = re.compile(r"(?<=[\w,;:] )[A-Z][a-zA-Z]+")
+_assertion_re = re.compile(
+    r"\b(is|are|was|were|has|have|had|born|died|founded|invented|discovered|located|"
+    r"built|completed|released|launched|published|won|contains|consists|measures|"
+    r"population|capital|largest|smallest|highest|tallest|first|oldest|according)\b", re.I)
+# Statements of what things are made of, cause, belong to...
+_relation_re = re.compile(
+    r"\b(made of|made from|composed of|consists? of|a (type|kind|form|species) of|part of|"
+    r"caused by|causes|cause|produces?|orbits?|boils|freezes|mammals?|(do|does) not work)\b", re.I)
+# Talking to or about the user or the assistant, rather than about the world
+_personal_re = re.compile(
+    r"\b(i|i'm|i've|i'd|i'll|me|my|you|you're|you'd|your|we|we're|us|our|let's|here|here's)\b", re.I)
+# Instructions, not statements
+_imperative_re = re.compile(
+    r"^(try|see|use|check|make|keep|take|run|install|add|remove|consider|remember|"
+    r"note|go|click|open|read|ask|avoid|start|don't)\b", re.I)
+# The heuristics are for English. Function words tell English from the
+#  other Latin-script languages the assistant replies in
+_english_words_re = re.compile(
+    r"\b(the|of|and|to|is|are|was|were|it|that|for|with|on|by|this|from|at|has|have|"
+    r"which|be|you|i|can|not)\b", re.I)
+_other_words_re = re.compile(
+    r"\b(il|lo|la|gli|di|che|è|sono|del|della|delle|nel|nella|anche|più|"
+    r"el|los|las|es|está|son|y|una|"
+    r"les|des|du|et|est|sont|une|avec|"
+    r"der|das|ist|und|nicht|ein|eine|sind|mit|"
+    r"não|uma|são)\b", re.I)
+# Greetings, opinions, hedges, offers... not worth a check by themselves
+_soft_re = re.compile(
+    r"\b(hello|hi|hey|thanks|thank you|you're welcome|sure|glad|sorry|happy to|"
+    r"i think|i believe|in my opinion|i hope|let me|feel free|would you like|"
+    r"let's|please|maybe|perhaps|good luck|sounds like|in my view)\b", re.I)
+
+#==================================================================
+def strip_non_prose(text) -> str:
+    """ Remove code, inline code and URLs, which are not fact-checked """
+    text = _code_block_re.sub(" ", text)
+    text = _inline_code_re.sub(" ", text)
+    return _url_re.sub(" ", text)
+
+def split_sentences(text) -> list:
+    out = []
+    for s in _sentence_split_re.split(text):
+        if s and (s := _list_marker_re.sub("", s).strip()):
+            out.append(s)
+    return out
+
+def sentence_score(sentence) -> int:
+    """ Higher means more likely to hold a checkable factual claim """
+    if sentence.endswith("?"):
+        return 0
+
+    score = 0
+    if _number_re.search(sentence):
+        score += 2 if _quantity_re.search(sentence) else 1
+    if _year_re.search(sentence) or _month_re.search(sentence):
+        score += 1
+    if _entity_re.search(sentence):
+        score += 1
+    if _assertion_re.search(sentence):
+        score += 1
+    if _relation_re.search(sentence):
+        score += 1
+    # An impersonal statement of a few words can be a claim with no numbers
+    #  or names (e.g. "Vitamin C prevents colds"), it's checked by default
+    if (len(sentence.split()) >= 4 and not _personal_re.search(sentence) and
+            not _imperative_re.search(sentence)):
+        score += 2
+    if _soft_re.search(sentence):
+        score -= 1
+    # Very short sentences rarely carry a full claim
+    if len(sentence) < 20:
+        score -= 1
+    return score
+
+def is_supported_language(text) -> bool:
+    """ True if the text is mostly English, the only language the scores
+        are meaningful for (numbers in CJK text aren't even word-bounded) """
+    letters = [c for c in text if c.isalpha()]
+    if not letters:
+        return True
+    # Basic Latin to Latin Extended-B, accented letters included
+    n_latin = sum(1 for c in letters if c < "\u0250")
+    if n_latin < MIN_LATIN_RATIO * len(letters):
+        return False
+    return len(_other_words_re.findall(text)) <= len(_english_words_re.findall(text))
+
+def find_claims(text, min_score=DEFAULT_MIN_SCORE) -> list:
+    """ Return the sentences that look like checkable claims """
+    return [s for s in split_sentences(strip_non_prose(text)) if sentence_score(s) >= min_score]
+
+#==================================================================
+_stats = StatsCounter({
+    "checked": 0,
+    "with_claims": 0,
+    "skipped": 0,
+    # Not English, always checked
+    "unsupported_language": 0,
+})
+
+def has_claims(content, min_score=DEFAULT_MIN_SCORE) -> bool:
+    """ Pre-filter for the fact-check, content as (type, value) pairs.
+        Fails open: True for the languages the heuristics don't cover """
+    text = "\n".join(value for t, value in content if t == "text")
+    supported = is_supported_language(strip_non_prose(text))
+    found = not supported or len(find_claims(text, min_score)) > 0
+    _stats.add(checked=1, with_claims=int(found), skipped=int(not found),
+               unsupported_language=int(not supported))
+    return found
+
+def get_stats() -> dict:
+    return _stats.get(ratios={"skipped_ratio": ("skipped", "checked")})
@@ -5,13 +5,29 @@
 # Description: A judge for conversations
 #==================================================================
 
-import json
+from threading import Thread, Condition, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor
 from .logger import *
 from .OpenAIWrapper import OpenAIWrapper
+from .JsonStream import JsonArrayStreamParser
+from .MsgThread import format_meta
+from . import FactCheckCache
+from . import ClaimDetector
+
+# Number of most recent messages that are fact-checked
+FACT_CHECK_MESSAGES = 2
+# Number of most recent messages given as context to the fact-check
+FACT_CHECK_CONTEXT_MESSAGES = 8
 
 class ConvoJudge:
-    def __init__(self, model, temperature):
+    def __init__(self, model, temperature, max_messages=None, claim_min_score=None):
         self.srcMessages = []
+        # Rendered transcript fragment of each message, by src_id
+        self.fragments = {}
+        # If set, only the last max_messages are kept (trimmed in batches)
+        self.max_messages = max_messages
+        # If set, messages without local claims (see ClaimDetector) are not fact-checked
+        self.claim_min_score = claim_min_score
         self.model = model
         self.temperature = temperature
 
@@ -98,125 +114,215 @@ When a question has a specific answer, the links are meant as
 a potential form of verification, not as the actual answer.
 Do not waste the parent assistant's and the user's time by
 telling them to follow some links.
+"""
+
+        # With the searches already done, see ResearchEngine
+        self.instructionsForResearchEvidence = self.instructionsForResearch + """
+The searches are already done: you are given the results for the query
+and its variants, numbered, each with title, URL and snippet.
+Base your reply on those results, use the search functions only when the
+results are clearly insufficient.
+Include the URLs of the results that you use.
 """
 
     def AddMessage(self, srcMsg):
         self.srcMessages.append(srcMsg)
+        self.fragments[srcMsg.src_id] = self.renderMessage(srcMsg)
+        if self.max_messages and len(self.srcMessages) >= self.max_messages * 2:
+            for old in self.srcMessages[:-self.max_messages]:
+                self.fragments.pop(old.src_id, None)
+            del self.srcMessages[:-self.max_messages]
+
+    def UpdateMessage(self, srcMsg):
+        """ Re-render a message after its content changed """
+        if srcMsg.src_id in self.fragments:
+            self.fragments[srcMsg.src_id] = self.renderMessage(srcMsg)
 
     def ClearMessages(self):
         self.srcMessages = []
+        self.fragments = {}
 
-    def makeConvoMessage(self, src_id, role, content):
+    def makeConvoMessage(self, src_id, role, content, meta=None):
+        # content is a sequence of (type, value) pairs, see MsgRecord
         out = f"- Message {src_id} by {role}:\n"
-        for cont in content:
-            out += cont['value'] + "\n"
+        if meta:
+            out += format_meta(meta)
+        for _, value in content:
+            out += value + "\n"
         return out
 
+    def renderMessage(self, srcMsg):
+        return self.makeConvoMessage(srcMsg.src_id, srcMsg.role, srcMsg.content, srcMsg.meta)
+
+    def joinFragments(self, staIdx, endIdx):
+        """ Transcript of the messages [staIdx, endIdx), from the cached fragments """
+        fragments = self.fragments
+        return "".join(fragments[m.src_id] for m in self.srcMessages[staIdx:endIdx])
+
     def buildConvoString(self, maxMessages):
-        convo = ""
         n = len(self.srcMessages)
-        staIdx = max(0, n - maxMessages)
-        for index in range(staIdx, n):
-            srcMsg = self.srcMessages[index]
-            convo += self.makeConvoMessage(srcMsg['src_id'], srcMsg['role'], srcMsg['content'])
-        return convo
+        return self.joinFragments(max(0, n - maxMessages), n)
 
-    def genCompletion(self, wrap, instructions, convo, tools_user_data=None):
+    def genCompletion(self, wrap, instructions, convo, tools_user_data=None, stream=False,
+                      feature="judge"):
+        """ Return the completion text, or an iterator of parts if `stream` """
         from .OAIUtils import completion_with_tools
-        return completion_with_tools(
+        response = completion_with_tools(
                 wrap=wrap,
                 model=self.model,
                 temperature=self.temperature,
                 instructions=instructions,
                 role_and_content_msgs=[{"role": "user", "content": convo}],
                 tools_user_data=tools_user_data,
-                stream=False)
-
-    def gen_completion_ret_json(self, wrap, instructions, convo, tools_user_data=None):
-        response = self.genCompletion(wrap, self.instructionsForFactCheck, convo, tools_user_data)
-        logmsg(f"Response: {response}")
-        # Handle the GPT-3.5 bug for when the response is more than one JSON object
-        fixed_response = ConvoJudge.extract_first_json_object(response)
-        logmsg(f"Fixed response: {fixed_response}")
-        # Convert the Python dictionary back to a JSON string if needed
-        return json.dumps(fixed_response)
+                stream=stream,
+                feature=feature)
+        if stream:
+            return response
+        # completion_with_tools is a generator also in the non-stream case
+        return "".join(part for part in response if part)
+
+    def gen_completion_stream_json_entries(self, wrap, instructions, convo, array_key,
+                                           tools_user_data=None, feature="judge"):
+        """ Stream the completion and yield each entry of the `array_key`
+            array as soon as it's complete. Returns True if the reply was complete """
+        # Only the first JSON object is parsed, which also handles
+        # the GPT-3.5 bug for when the response is more than one JSON object
+        parser = JsonArrayStreamParser(array_key)
+        for part in self.genCompletion(wrap, instructions, convo, tools_user_data,
+                                       stream=True, feature=feature):
+            if part is None:
+                continue
+            for entry in parser.feed(part):
+                logmsg(f"Streamed entry: {entry}")
+                yield entry
+            if parser.done:
+                break
+        return parser.done
 
     def GenSummary(self, wrap):
         convo = self.buildConvoString(1000)
-        return self.genCompletion(wrap, self.instructionsForSummary, convo)
+        return self.genCompletion(wrap, self.instructionsForSummary, convo, feature="summary")
 
     def GenCritique(self, wrap):
         convo = self.buildConvoString(1000)
-        return self.genCompletion(wrap, self.instructionsForCritique, convo)
+        return self.genCompletion(wrap, self.instructionsForCritique, convo, feature="critique")
 
-    @staticmethod
-    def extract_first_json_object(response):
-        try:
-            open_brackets = 0
-            json_start = 0
-            json_end = 0
-            in_string = False
-            escape = False
-
-            for i, char in enumerate(response):
-                if char == '"' and not escape:
-                    in_string = not in_string
-                elif char == '\\' and in_string:
-                    escape = not escape
-                    continue
-                elif char == '{' and not in_string:
-                    if open_brackets == 0:
-                        json_start = i
-                    open_brackets += 1
-                elif char == '}' and not in_string:
-                    open_brackets -= 1
-                    if open_brackets == 0:
-                        json_end = i + 1
-                        break
-                if escape:
-                    escape = False
-
-            if json_start < json_end:
-                json_str = response[json_start:json_end]
-                return json.loads(json_str)
-            else:
-                return {}
-        except Exception as e:
-            logerr(f"Error parsing JSON: {e}")
-            return {}
-
-    def GenFactCheck(self, wrap, tools_user_data):
+    def build_fact_check_convo(self, check_ids=None):
+        """ Build the convo with the messages in `check_ids` (default: the last
+            FACT_CHECK_MESSAGES) to fact-check, the others are context """
         n = len(self.srcMessages)
         if n == 0:
             logmsg("No source messages found")
-            return "{}"
+            return None
 
-        CONTEXT_MESSAGES = 8
-        FACT_CHECK_MESSAGES = 2
-        convo = ""
-        staIdx = max(0, n - CONTEXT_MESSAGES)
-        fcStartIdx = n - FACT_CHECK_MESSAGES
+        staIdx = max(0, n - FACT_CHECK_CONTEXT_MESSAGES)
+        if check_ids is None:
+            check_ids = {m.src_id for m in self.srcMessages[-FACT_CHECK_MESSAGES:]}
+
+        window = self.srcMessages[staIdx:]
+        context = [self.fragments[m.src_id] for m in window if m.src_id not in check_ids]
+        to_check = [self.fragments[m.src_id] for m in window if m.src_id in check_ids]
 
-        # Only add context section if there are messages before the fact-checking section
-        if staIdx < fcStartIdx:
-            convo += "## Begin context for fact-checking. Context-only DO NOT fact-check\n"
-            for index in range(staIdx, fcStartIdx):
-                srcMsg = self.srcMessages[index]
-                convo += self.makeConvoMessage(srcMsg['src_id'], srcMsg['role'], srcMsg['content'])
+        parts = []
+        # Only add context section if there are messages outside of the fact-checking section
+        if context:
+            parts.append("## Begin context for fact-checking. Context-only DO NOT fact-check\n")
+            parts += context
 
         # Fact-checking section
-        convo += "## Begin statements to fact-check. DO fact-check below\n"
-        for index in range(fcStartIdx, n):
-            srcMsg = self.srcMessages[index]
-            convo += self.makeConvoMessage(srcMsg['src_id'], srcMsg['role'], srcMsg['content'])
+        parts.append("## Begin statements to fact-check. DO fact-check below\n")
+        parts += to_check
+
+        return "".join(parts)
+
+    def build_segment_check_convo(self, src_id, role, segment, preceding_text=""):
+        """ Build the convo to fact-check a segment of a message still being
+            written. `preceding_text` is the end of the message before it """
+        window = self.srcMessages[-FACT_CHECK_CONTEXT_MESSAGES:]
+        context = [self.fragments[m.src_id] for m in window if m.src_id != src_id]
+        if preceding_text:
+            context.append(self.makeConvoMessage(f"{src_id} (preceding part)", role, (("text", preceding_text),)))
+
+        parts = []
+        if context:
+            parts.append("## Begin context for fact-checking. Context-only DO NOT fact-check\n")
+            parts += context
+
+        parts.append("## Begin statements to fact-check. DO fact-check below\n")
+        parts.append(self.makeConvoMessage(src_id, role, (("text", segment),)))
+        return "".join(parts)
+
+    def GenSegmentFactCheckStream(self, wrap, tools_user_data, src_id, role, segment, preceding_text=""):
+        """ Yield the fact-check entries of a segment of a message.
+            Returns True if the reply was complete """
+        convo = self.build_segment_check_convo(src_id, role, segment, preceding_text)
+        return (yield from self.gen_completion_stream_json_entries(
+            wrap, self.instructionsForFactCheck, convo, "fact_checks", tools_user_data,
+            feature="fact-check"))
 
-        return self.gen_completion_ret_json(wrap, self.instructionsForFactCheck, convo, tools_user_data)
+    @staticmethod
+    def _yield_and_collect(stream, results):
+        """ Re-yield the entries of `stream`, collecting them by msg_id in `results`.
+            Returns the return value of `stream` """
+        while True:
+            try:
+                entry = next(stream)
+            except StopIteration as e:
+                return e.value
+            if isinstance(entry, dict) and (lst := results.get(entry.get("msg_id"))) is not None:
+                lst.append(entry)
+            yield entry
+
+    def GenFactCheckStream(self, wrap, tools_user_data, targets=None):
+        """ Yield each fact-check entry as soon as the model completes it.
+            `targets` defaults to the last FACT_CHECK_MESSAGES messages.
+            Messages already checked are skipped, statements identical to
+            ones checked before are served from FactCheckCache """
+        if targets is None:
+            targets = self.srcMessages[-FACT_CHECK_MESSAGES:]
+
+        to_check = []
+        for m in targets:
+            hit, entries = FactCheckCache.lookup(m.src_id, m.role, m.content)
+            if hit is None:
+                to_check.append(m)
+            elif entries:
+                yield from entries
+
+        # Cheap local pre-filter, skip greetings, code, questions...
+        if self.claim_min_score is not None:
+            to_check = [m for m in to_check
+                        if ClaimDetector.has_claims(m.content, self.claim_min_score)]
+
+        if not to_check:
+            logmsg("Nothing to fact-check")
+            return
+
+        if (convo := self.build_fact_check_convo({m.src_id for m in to_check})) is None:
+            return
+
+        results = {m.src_id: [] for m in to_check}
+        is_complete = yield from self._yield_and_collect(
+            self.gen_completion_stream_json_entries(
+                wrap, self.instructionsForFactCheck, convo, "fact_checks", tools_user_data,
+                feature="fact-check"),
+            results)
+
+        # Only remember complete replies (an empty list of checks is a result)
+        if is_complete:
+            for m in to_check:
+                FactCheckCache.store(m.src_id, m.role, m.content, results[m.src_id])
 
-    def gen_research(self, wrap, query, tools_user_data):
+    def GenFactCheck(self, wrap, tools_user_data):
+        """ Return the fact-checks as a dictionary with a `fact_checks` list """
+        return {"fact_checks": list(self.GenFactCheckStream(wrap, tools_user_data))}
+
+    def gen_research(self, wrap, query, tools_user_data, evidence=None):
         """ Generate a research completion
                 :param wrap: OpenAIWrapper object
                 :param query: The query to research
                 :param tools_user_data: The user data to pass to the tools
+                :param evidence: Optional search results, see ResearchEngine
                 :return: The research completion
         """
         n = len(self.srcMessages)
@@ -224,21 +330,284 @@ telling them to follow some links.
             return "{}"
 
         CONTEXT_MESSAGES = 4
-        convo = ""
         staIdx = max(0, n - CONTEXT_MESSAGES)
 
-        # Context section
-        convo += "## Begin context for your research. Context-only DO NOT research on this\n"
-        for index in range(staIdx, n):
-            srcMsg = self.srcMessages[index]
-            convo += self.makeConvoMessage(srcMsg['src_id'], srcMsg['role'], srcMsg['content'])
-
-        # Query to research about
-        convo += "## Begin query for research. DO research about this\n"
-        convo += f"{query}\n"
-
-        response = self.genCompletion(wrap, self.instructionsForResearch, convo, tools_user_data)
+        convo = (
+            # Context section
+            "## Begin context for your research. Context-only DO NOT research on this\n"
+            + self.joinFragments(staIdx, n)
+            # Query to research about
+            + "## Begin query for research. DO research about this\n"
+            + f"{query}\n")
+
+        instructions = self.instructionsForResearch
+        if evidence:
+            from .ResearchEngine import format_evidence
+            convo += "## Begin search results for the query\n" + format_evidence(evidence)
+            instructions = self.instructionsForResearchEvidence
+
+        response = self.genCompletion(
+            wrap, instructions, convo, tools_user_data, feature="research")
         logmsg(f"Research outcome: {response}")
         return response
 
+#==================================================================
+class FactCheckJob:
+    """ Runs a streamed fact-check in the background, collecting the entries
+        so that they can be handed out as they arrive (e.g. to a poller) """
+    def __init__(self, judge: ConvoJudge, wrap, tools_user_data):
+        self.cond = Condition()
+        self.entries = []
+        self.n_taken = 0
+        self.done = False
+        self.thread = Thread(
+            target=self._run,
+            args=(judge, wrap, tools_user_data),
+            daemon=True)
+        self.thread.start()
+
+    def _run(self, judge, wrap, tools_user_data):
+        try:
+            for entry in judge.GenFactCheckStream(wrap, tools_user_data):
+                with self.cond:
+                    self.entries.append(entry)
+                    self.cond.notify_all()
+        except Exception as e:
+            logerr(f"Error during fact-check: {e}")
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+    def take_new(self, timeout=None):
+        """ Return (new entries, is_done). Waits up to `timeout` seconds
+            for at least one new entry or for the end of the job """
+        with self.cond:
+            if timeout:
+                self.cond.wait_for(
+                    lambda: self.done or len(self.entries) > self.n_taken, timeout)
+            new_entries = self.entries[self.n_taken:]
+            self.n_taken = len(self.entries)
+            return new_entries, self.done
 
+#==================================================================
+# Shared by the speculative fact-checks of all the clients. The reply segments
+#  in flight are bounded globally, the rest of the workers stay available for
+#  the final checks of the replies (and for the other messages)
+_segment_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="fcheck")
+_segment_slots = BoundedSemaphore(4)
+
+def initialize_speculative(max_workers=8, max_inflight_segments=4):
+    """ Size the pool of the speculative fact-checks, call before their use """
+    global _segment_executor, _segment_slots
+    _segment_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fcheck")
+    _segment_slots = BoundedSemaphore(max(1, min(max_inflight_segments, max_workers - 1)))
+
+class SpeculativeFactCheckJob:
+    """ Fact-checks a reply while it's being streamed: each completed paragraph
+        is checked in the background as soon as it arrives, the rest of the reply
+        when it ends. The other messages to check (e.g. the user's) are checked
+        right away. Entries are handed out like with FactCheckJob, and at the end
+        the merged results of the reply go to FactCheckCache.
+        Segments (and short replies, checked whole) already checked are taken
+        from FactCheckCache. Each segment costs a completion, so replies are
+        split only past MIN_SPECULATIVE_CHARS, and while MAX_INFLIGHT_SEGMENTS
+        are being checked the next paragraphs are merged in one segment """
+    MIN_SEGMENT_CHARS = 300
+    MIN_SPECULATIVE_CHARS = 1200
+    MAX_SEGMENTS = 4
+    MAX_INFLIGHT_SEGMENTS = 2
+    PRECEDING_CONTEXT_CHARS = 1000
+
+    def __init__(self, judge: ConvoJudge, wrap, tools_user_data, src_id, role="assistant"):
+        self.judge = judge
+        self.wrap = wrap
+        self.tools_user_data = tools_user_data
+        self.src_id = src_id
+        self.role = role
+
+        self.cond = Condition()
+        self.entries = []
+        self.n_taken = 0
+        self.n_pending = 0
+        self.n_inflight_segments = 0
+        self.finished = False
+        self.stored = False
+        self.reply_entries = []
+        self.reply_complete = True
+
+        # Streamed parts, joined only when a segment is cut (see _text())
+        self.parts = []
+        self.n_chars = 0
+        self.carry = ""         # Last chars scanned, for the "\n\n" and "```" split in parts
+        self.fences = []        # Positions of the "```" after seg_sta
+        self.seg_sta = 0        # Start of the segment being collected
+        self.last_break = -1    # Last paragraph break after seg_sta
+        self.open_code_break = -1   # Last break found inside a code block
+        self.n_segments = 0
+
+        others = [m for m in judge.srcMessages[-FACT_CHECK_MESSAGES:] if m.src_id != src_id]
+        if others:
+            self._submit(judge.GenFactCheckStream(wrap, tools_user_data, targets=others), False)
+
+    def _text(self) -> str:
+        """ The reply so far, joined only when needed (a few times per reply) """
+        if len(self.parts) > 1:
+            self.parts = ["".join(self.parts)]
+        return self.parts[0] if self.parts else ""
+
+    def feed(self, part):
+        """ Add a streamed part of the reply """
+        self.parts.append(part)
+        self.n_chars += len(part)
+        if self.n_segments >= self.MAX_SEGMENTS - 1:
+            return # The rest goes in the last segment
+
+        # Only scan the new text (and the chars before, for a split "\n\n" or "```")
+        tail = self.carry + part
+        base = self.n_chars - len(tail)
+        self.carry = tail[-2:]
+        if (idx := tail.rfind("\n\n")) != -1 and base + idx >= self.seg_sta:
+            self.last_break = base + idx
+        sta = 0
+        while (idx := tail.find("```", sta)) != -1:
+            if not self.fences or base + idx >= self.fences[-1] + 3:
+                self.fences.append(base + idx)
+            sta = idx + 3
+
+        if (self.last_break - self.seg_sta < self.MIN_SEGMENT_CHARS or
+                self.last_break == self.open_code_break or
+                self.n_chars < self.MIN_SPECULATIVE_CHARS):
+            return
+        # Don't cut inside a code block
+        if sum(1 for f in self.fences if f < self.last_break) % 2:
+            self.open_code_break = self.last_break
+            return
+        # Wait for a check to end (of this reply, or of any reply), the
+        #  segment grows in the meantime
+        with self.cond:
+            if self.n_inflight_segments >= self.MAX_INFLIGHT_SEGMENTS:
+                return
+        if not _segment_slots.acquire(blocking=False):
+            return
+
+        segment = self._text()[self.seg_sta:self.last_break]
+        self._submit_segment(segment, has_slot=True)
+        self.seg_sta = self.last_break + 2
+        self.fences = [f for f in self.fences if f >= self.seg_sta]
+
+    def finish(self, full_text=None):
+        """ The reply is complete, check what's left of it """
+        if full_text is not None:
+            self.parts = [full_text]
+        text = self._text()
+        if self.seg_sta == 0:
+            # Not split (e.g. a short reply), it may have been checked whole before
+            hit, entries = FactCheckCache.lookup(self.src_id, self.role, (("text", text),))
+            if hit is not None:
+                self._add_reply_entries(entries or [])
+                with self.cond:
+                    self.stored = True  # Already in the cache
+            elif text.strip():
+                self._submit_segment(text, whole_reply=True)
+        elif (segment := text[self.seg_sta:]).strip():
+            self._submit_segment(segment)
+        with self.cond:
+            self.finished = True
+            self.cond.notify_all()
+        self._store_if_done()
+
+    def _submit_segment(self, segment, whole_reply=False, has_slot=False):
+        """ Check a segment of the reply. The whole reply is looked up and
+            stored in the cache by message instead (see finish()).
+            `has_slot`: a slot of _segment_slots was taken for it """
+        self.n_segments += 1
+        content = (("text", segment),)
+        min_score = self.judge.claim_min_score
+        if min_score is not None and not ClaimDetector.has_claims(content, min_score):
+            if has_slot:
+                _segment_slots.release()
+            return
+        if whole_reply:
+            content = None
+        elif (entries := FactCheckCache.lookup_content(self.role, content)) is not None:
+            logmsg(f"Speculative fact-check of segment {self.n_segments} from the cache")
+            self._add_reply_entries([dict(e, msg_id=self.src_id) for e in entries])
+            if has_slot:
+                _segment_slots.release()
+            return
+        preceding = self._text()[max(0, self.seg_sta - self.PRECEDING_CONTEXT_CHARS):self.seg_sta]
+        logmsg(f"Speculative fact-check of segment {self.n_segments} ({len(segment)} chars)")
+        self._submit(self.judge.GenSegmentFactCheckStream(
+            self.wrap, self.tools_user_data, self.src_id, self.role, segment, preceding), True,
+            segment_content=content, has_slot=has_slot)
+
+    def _add_reply_entries(self, entries):
+        with self.cond:
+            self.entries += entries
+            self.reply_entries += entries
+            self.cond.notify_all()
+
+    def _submit(self, stream, is_reply, segment_content=None, has_slot=False):
+        with self.cond:
+            self.n_pending += 1
+            if segment_content is not None:
+                self.n_inflight_segments += 1
+        _segment_executor.submit(self._run, stream, is_reply, segment_content, has_slot)
+
+    def _run(self, stream, is_reply, segment_content=None, has_slot=False):
+        is_complete = False
+        seg_entries = []
+        try:
+            while True:
+                try:
+                    entry = next(stream)
+                except StopIteration as e:
+                    # GenFactCheckStream returns None, it only caches complete replies
+                    is_complete = e.value is not False
+                    break
+                if is_reply and isinstance(entry, dict):
+                    entry["msg_id"] = self.src_id
+                with self.cond:
+                    self.entries.append(entry)
+                    if is_reply:
+                        self.reply_entries.append(entry)
+                        seg_entries.append(entry)
+                    self.cond.notify_all()
+            if segment_content is not None and is_complete:
+                FactCheckCache.store_content(self.role, segment_content, seg_entries)
+        except Exception as e:
+            logerr(f"Error during speculative fact-check: {e}")
+        finally:
+            if has_slot:
+                _segment_slots.release()
+            with self.cond:
+                self.n_pending -= 1
+                if segment_content is not None:
+                    self.n_inflight_segments -= 1
+                if is_reply and not is_complete:
+                    self.reply_complete = False
+                self.cond.notify_all()
+            self._store_if_done()
+
+    def _store_if_done(self):
+        with self.cond:
+            if self.stored or not (self.finished and self.n_pending == 0):
+                return
+            self.stored = True
+            do_store = self.reply_complete
+        # The reply won't be checked again by the regular fact-check
+        if do_store:
+            FactCheckCache.store(self.src_id, self.role, (("text", self._text()),), self.reply_entries)
+
+    def take_new(self, timeout=None):
+        """ Return (new entries, is_done). Waits up to `timeout` seconds
+            for at least one new entry or for the end of the job """
+        with self.cond:
+            is_done = lambda: self.finished and self.n_pending == 0
+            if timeout:
+                self.cond.wait_for(
+                    lambda: is_done() or len(self.entries) > self.n_taken, timeout)
+            new_entries = self.entries[self.n_taken:]
+            self.n_taken = len(self.entries)
+            return new_entries, is_done()
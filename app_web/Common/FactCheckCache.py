@@ -0,0 +1,122 @@
+#==================================================================
+# FactCheckCache.py
+#
+# Description: Fact-check results by message and by normalized content
+#==================================================================
+
+import re
+import time
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+from .StatsUtils import StatsCounter
+
+# Bounds for the two stores (least recently used entries are dropped)
+MAX_BY_MSG = 20000
+MAX_BY_CONTENT = 5000
+# Results by content are shared across users, and facts get stale
+CONTENT_TTL_SEC = 24 * 3600
+# Short statements (e.g. "Yes, it is.") depend on the context, don't share them
+MIN_SHARED_CONTENT_LEN = 80
+
+_ws_re = re.compile(r"\s+")
+
+#==================================================================
+def normalize_text(text) -> str:
+    return _ws_re.sub(" ", text).strip().lower()
+
+def content_hash(role, content) -> str:
+    """ Hash of the normalized text of a message, content as (type, value) pairs """
+    text = normalize_text(" ".join(value for _, value in content))
+    return hashlib.sha1(f"{role}\n{text}".encode("utf-8")).hexdigest()
+
+def is_shareable(content) -> bool:
+    return sum(len(value) for _, value in content) >= MIN_SHARED_CONTENT_LEN
+
+#==================================================================
+_lock = Lock()
+# src_id -> (content hash, entries)
+_by_msg = OrderedDict()
+# content hash -> (time, entries)
+_by_content = OrderedDict()
+_stats = StatsCounter({
+    "lookups": 0,
+    "msg_hits": 0,
+    "content_hits": 0,
+    "misses": 0,
+    "stored": 0,
+})
+
+def _put(store, key, value, max_n):
+    store[key] = value
+    store.move_to_end(key)
+    if len(store) > max_n:
+        store.popitem(last=False)
+
+def lookup(src_id, role, content):
+    """ Return ("msg", None) if the message was already checked,
+        ("content", entries) if an identical statement was checked,
+        (None, None) if it needs checking """
+    h = content_hash(role, content)
+    with _lock:
+        _stats.add(lookups=1)
+        if (rec := _by_msg.get(src_id)) is not None and rec[0] == h:
+            _stats.add(msg_hits=1)
+            return "msg", None
+
+        if (rec := _by_content.get(h)) is not None:
+            if (time.time() - rec[0]) < CONTENT_TTL_SEC:
+                _stats.add(content_hits=1)
+                _by_content.move_to_end(h)
+                # Entries point to the message that was checked, rebind them
+                entries = [dict(e, msg_id=src_id) for e in rec[1]]
+                _put(_by_msg, src_id, (h, entries), MAX_BY_MSG)
+                return "content", entries
+            del _by_content[h]
+
+        _stats.add(misses=1)
+        return None, None
+
+def lookup_content(role, content):
+    """ Entries of an identical statement checked before, or None.
+        For parts of messages (e.g. the paragraphs of a streamed reply) """
+    if not is_shareable(content):
+        return None
+    h = content_hash(role, content)
+    with _lock:
+        _stats.add(lookups=1)
+        if (rec := _by_content.get(h)) is not None:
+            if (time.time() - rec[0]) < CONTENT_TTL_SEC:
+                _stats.add(content_hits=1)
+                _by_content.move_to_end(h)
+                return [dict(e) for e in rec[1]]
+            del _by_content[h]
+        _stats.add(misses=1)
+        return None
+
+def store_content(role, content, entries):
+    """ Store the fact-checks of a part of a message, by content only """
+    if not is_shareable(content):
+        return
+    h = content_hash(role, content)
+    with _lock:
+        _put(_by_content, h, (time.time(), entries), MAX_BY_CONTENT)
+        _stats.add(stored=1)
+
+def store(src_id, role, content, entries):
+    """ Store the fact-checks of a message (an empty list is a valid result) """
+    h = content_hash(role, content)
+    with _lock:
+        _put(_by_msg, src_id, (h, entries), MAX_BY_MSG)
+        if is_shareable(content):
+            _put(_by_content, h, (time.time(), entries), MAX_BY_CONTENT)
+        _stats.add(stored=1)
+
+def get_stats() -> dict:
+    stats = _stats.get(ratios={
+        "msg_hit_ratio": ("msg_hits", "lookups"),
+        "content_hit_ratio": ("content_hits", "lookups")})
+    with _lock:
+        stats["by_msg_size"] = len(_by_msg)
+        stats["by_content_size"] = len(_by_content)
+    return stats
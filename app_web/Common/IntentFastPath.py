@@ -0,0 +1,147 @@
+#==================================================================
+# IntentFastPath.py
+#
+# Description: Precomputed results of the trivial tools (e.g. local time),
+#  given with the first request instead of a tool round trip
+#==================================================================
+
+import re
+from .logger import *
+from .StatsUtils import StatsCounter, ratio
+from . import AssistTools
+from . import ToolBudget
+from .MsgThread import META_BLOCK_RE
+
+# Longer messages are not trivial, the model decides on its own
+MAX_TEXT_CHARS = 160
+
+# Tool to precompute, for each intent. The tools take no real arguments
+INTENT_TOOLS = {
+    "local_time": "get_user_local_time",
+    "unix_time": "get_unix_time",
+}
+
+# Polite words before the question, e.g. "hey, can you tell me ... please".
+#  The assistant name and the fillers of the config are added by initialize()
+DEFAULT_FILLERS = ("hey", "hi", "ok", "okay", "so", "please", "excuse me")
+
+_ASK = r"(?:(?:can|could) you tell me |do you know |tell me |give me |dimmi |sai )?"
+_SUFFIX = r"(?: (?:please|now|right now|currently|today|here|for me|per favore|adesso|ora|oggi))*"
+
+# All about the present: the current time, date or timezone of the user
+INTENT_PHRASES = {
+    "local_time": (
+        r"what time is it", r"what time it is", r"what(?:'s| is) the (?:current |local )?time",
+        r"what(?:'s| is) (?:the (?:current )?date|today's date)", r"what the date is",
+        r"what date is (?:it|today)", r"what day (?:of the week )?is (?:it|today)",
+        r"what day (?:it is|today is)", r"what(?:'s| is) today",
+        r"(?:what|which) time ?zone am i in", r"what(?:'s| is) my (?:current )?time ?zone",
+        r"che or[ae] (?:è|e'|e|sono)", r"che giorno è", r"che data è",
+        r"qual è la data di oggi", r"in che fuso orario sono",
+        r"今 ?何時(?:ですか)?", r"何時ですか", r"今日は ?何日(?:ですか)?", r"今日は ?何曜日(?:ですか)?"),
+    "unix_time": (
+        r"what(?:'s| is) the (?:current )?(?:unix time|unix timestamp|epoch time|timestamp)",
+        r"(?:the )?(?:current )?unix (?:time|timestamp)"),
+}
+
+def _make_intent_res(fillers) -> dict:
+    """ The whole message must be one of the phrases (after normalize_text()),
+        so that e.g. "what day did WW2 end" is not taken for the current date """
+    fillers = sorted({normalize_text(f) for f in fillers if f and f.strip()}, key=len, reverse=True)
+    prefix = f"(?:(?:{'|'.join(re.escape(f) for f in fillers)}) )*" if fillers else ""
+    return {intent: re.compile(f"^{prefix}{_ASK}(?:{'|'.join(phrases)}){_SUFFIX}$")
+            for intent, phrases in INTENT_PHRASES.items()}
+
+_punct_re = re.compile(r"[?!.,;:。？！、「」]+")
+_space_re = re.compile(r"\s+")
+
+def normalize_text(text) -> str:
+    text = _punct_re.sub(" ", text.lower().replace("’", "'"))
+    return _space_re.sub(" ", text).strip()
+
+INTENT_RES = _make_intent_res(DEFAULT_FILLERS)
+
+_enabled = True
+
+def initialize(enabled=True, assistant_name=None, fillers=None):
+    """ `fillers`: the words that may come before the question (default
+        DEFAULT_FILLERS), `assistant_name` is one of them """
+    global _enabled, INTENT_RES
+    _enabled = enabled
+    INTENT_RES = _make_intent_res(list(fillers or DEFAULT_FILLERS) + [assistant_name])
+
+#==================================================================
+_stats = StatsCounter({
+    "checked": 0,
+    "hits": 0,
+    # Calls of the fast-path tools still made by the model (missed intents)
+    "model_tool_calls": 0,
+    "by_intent": {},
+})
+
+def detect_intents(user_text) -> list:
+    """ Intents of a user message, [] if none or if the message is not trivial """
+    text = normalize_text(META_BLOCK_RE.sub("", user_text or ""))
+    if not text or len(text) > MAX_TEXT_CHARS:
+        return []
+    return [intent for intent, rx in INTENT_RES.items() if rx.match(text)]
+
+def _last_user_text(role_and_content_msgs):
+    for msg in reversed(role_and_content_msgs):
+        if msg.get("role") == "user":
+            return msg.get("content")
+        if msg.get("role") == "assistant":
+            break
+    return None
+
+def make_messages(role_and_content_msgs, tools_user_data=None) -> list:
+    """ Tool call and tool result messages to append to the first request,
+        as if the model had called the tools, or [] if no intent is found.
+        The system message and the history are untouched (prompt caching) """
+    if not _enabled:
+        return []
+    user_text = _last_user_text(role_and_content_msgs)
+    if user_text is None:
+        return []
+
+    intents = [i for i in detect_intents(user_text) if INTENT_TOOLS[i] in AssistTools.registry]
+    _stats.add(checked=1, hits=int(bool(intents)))
+    with _stats.lock:
+        by_intent = _stats.counters["by_intent"]
+        for intent in intents:
+            by_intent[intent] = by_intent.get(intent, 0) + 1
+    if not intents:
+        return []
+
+    calls = []
+    results = []
+    for n, intent in enumerate(intents):
+        name = INTENT_TOOLS[intent]
+        call_id = f"call_fastpath_{n}"
+        response = AssistTools.registry.dispatch(name, {"tools_user_data": tools_user_data})
+        calls.append({
+            "id": call_id,
+            "type": "function",
+            "function": {"name": name, "arguments": "{}"},
+        })
+        results.append({
+            "tool_call_id": call_id,
+            "role": "tool",
+            "name": name,
+            "content": ToolBudget.make_tool_content(name, response),
+        })
+
+    logmsg(f"Intent fast-path: {intents}")
+    return [{"role": "assistant", "content": None, "tool_calls": calls}] + results
+
+def record_model_tool_call(name):
+    """ Called for the tool calls requested by the model """
+    if name in INTENT_TOOLS.values():
+        _stats.add(model_tool_calls=1)
+
+def get_stats() -> dict:
+    stats = _stats.get(ratios={"hit_ratio": ("hits", "checked")})
+    stats["enabled"] = _enabled
+    # Share of the time-like turns served without a tool round trip
+    stats["round_trips_saved_ratio"] = ratio(stats["hits"], stats["hits"] + stats["model_tool_calls"])
+    return stats
@@ -0,0 +1,95 @@
+#==================================================================
+# JsonStream.py
+#
+# Description: Incremental JSON parsing of streamed completions
+#==================================================================
+
+import json
+from .logger import *
+
+#==================================================================
+class JsonArrayStreamParser:
+    """ Parse a streamed JSON object and return the elements of one of its
+        top-level arrays as soon as each element closes.
+        e.g. for '{"fact_checks": [{...}, {...}]}' with array_key="fact_checks"
+
+        Anything before the first '{' (e.g. a ```json fence) and anything
+        after the first complete object is ignored. Each character is
+        scanned once, so the cost is linear in the size of the reply.
+    """
+    def __init__(self, array_key):
+        self.array_key = array_key
+        self.entries = []
+        self.done = False
+        self._stack = []            # Open containers, '{' or '['
+        self._in_string = False
+        self._escape = False
+        self._key_chars = None      # Chars of the string being read at depth 1
+        self._last_key = None       # Last string read at depth 1
+        self._in_target = False     # Inside the target array
+        self._elem_chars = None     # Chars of the array element being read
+
+    def feed(self, chunk) -> list:
+        """ Feed a piece of text, return the list of newly completed elements """
+        out = []
+        if self.done or not chunk:
+            return out
+
+        stack = self._stack
+        for ch in chunk:
+            if self._elem_chars is not None:
+                self._elem_chars.append(ch)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._key_chars is not None:
+                        self._last_key = ''.join(self._key_chars)
+                        self._key_chars = None
+                    continue
+                if self._key_chars is not None:
+                    self._key_chars.append(ch)
+                continue
+
+            # Skip everything until the top-level object begins
+            if not stack and ch != '{':
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                if len(stack) == 1:
+                    self._key_chars = []
+            elif ch == '{' or ch == '[':
+                if ch == '[' and len(stack) == 1 and self._last_key == self.array_key:
+                    self._in_target = True
+                elif ch == '{' and self._in_target and len(stack) == 2:
+                    self._elem_chars = ['{']
+                stack.append(ch)
+            elif ch == '}' or ch == ']':
+                if stack:
+                    stack.pop()
+                if self._elem_chars is not None and len(stack) == 2:
+                    if (entry := self._parse_element(''.join(self._elem_chars))) is not None:
+                        self.entries.append(entry)
+                        out.append(entry)
+                    self._elem_chars = None
+                elif self._in_target and len(stack) == 1:
+                    self._in_target = False
+                if not stack:
+                    self.done = True
+                    break
+        return out
+
+    def _parse_element(self, text):
+        try:
+            return json.loads(text)
+        except ValueError as e:
+            logerr(f"Error parsing streamed JSON element: {e}")
+            return None
+
+    def result(self) -> dict:
+        return {self.array_key: self.entries}
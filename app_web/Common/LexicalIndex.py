@@ -0,0 +1,186 @@
+#==================================================================
+# LexicalIndex.py
+#
+# Description: BM25 inverted index, rank fusion and reranking for the RAG
+#==================================================================
+
+import os
+import re
+import json
+import unicodedata
+import numpy as np
+from collections import Counter
+from .logger import *
+
+# Files of a saved index, next to the ones of VectorIndex
+PARAMS_FILE = "lexical.json"
+POSTINGS_FILE = "lexical_postings.npy"
+TFS_FILE = "lexical_tfs.npy"
+TERM_OFFSETS_FILE = "lexical_term_offsets.npy"
+DOC_LENS_FILE = "lexical_doc_lens.npy"
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Reciprocal rank fusion constant. Lower than the usual 60, since there are
+#  only two short rankings and the top of each one matters most
+RRF_K = 5
+
+# Words, also split at underscores (e.g. file names)
+_word_re = re.compile(r"[^\W_]+")
+
+def tokenize(text) -> list:
+    """ Lowercase words without accents (e.g. "perché" -> "perche") """
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [w for w in _word_re.findall(text) if len(w) > 1]
+
+#==================================================================
+class LexicalIndex:
+    """ BM25 over the chunks of the knowledge base, for the exact terms
+        (names, codes, titles) that embeddings tend to blur.
+        The postings are flat arrays (CSR-like), by term id, so that the
+        index can be memory-mapped like the VectorIndex """
+    def __init__(self, texts, k1=BM25_K1, b=BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.vocab = {}
+        by_term = []
+        doc_lens = []
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lens.append(len(tokens))
+            for term, cnt in Counter(tokens).items():
+                if (tid := self.vocab.get(term)) is None:
+                    tid = self.vocab[term] = len(by_term)
+                    by_term.append([])
+                by_term[tid].append((doc_id, min(cnt, 65535)))
+
+        self.term_offsets = np.zeros(len(by_term) + 1, dtype=np.int64)
+        self.term_offsets[1:] = np.cumsum([len(p) for p in by_term])
+        flat = [p for plist in by_term for p in plist]
+        self.postings = np.array([d for d, _ in flat], dtype=np.int32)
+        self.tfs = np.array([c for _, c in flat], dtype=np.uint16)
+        self.doc_lens = np.array(doc_lens, dtype=np.int32)
+        self.avg_len = float(self.doc_lens.mean()) if len(doc_lens) else 0.0
+
+    def __len__(self):
+        return len(self.doc_lens)
+
+    def idf(self, tid) -> float:
+        df = int(self.term_offsets[tid + 1] - self.term_offsets[tid])
+        return float(np.log(1.0 + (len(self.doc_lens) - df + 0.5) / (df + 0.5)))
+
+    def search(self, query, top_k=20) -> tuple:
+        """ (doc ids, scores) of the best `top_k` docs with any query term """
+        scores = np.zeros(len(self.doc_lens), dtype=np.float32)
+        for term in set(tokenize(query)):
+            if (tid := self.vocab.get(term)) is None:
+                continue
+            sta, end = self.term_offsets[tid], self.term_offsets[tid + 1]
+            docs = self.postings[sta:end]
+            tfs = self.tfs[sta:end].astype(np.float32)
+            norm = tfs + self.k1 * (1.0 - self.b + self.b * self.doc_lens[docs] / self.avg_len)
+            # A term appears once per doc in its postings, no need for np.add.at
+            scores[docs] += self.idf(tid) * tfs * (self.k1 + 1.0) / norm
+
+        hits = np.flatnonzero(scores)
+        if not len(hits):
+            return hits, scores[hits]
+        k = min(top_k, len(hits))
+        top = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return top, scores[top]
+
+    def rerank(self, query, ids, scores, texts) -> tuple:
+        """ Reorder fused candidates by how well their text covers the query:
+            share of the query terms (by idf) found, and a bonus for query
+            word pairs found in sequence. Cheap and local, no model.
+            The bonuses are small, they mostly break near ties of the fusion """
+        q_tokens = tokenize(query)
+        weights = {}
+        for t in q_tokens:
+            if (tid := self.vocab.get(t)) is not None:
+                weights[t] = self.idf(tid)
+        total = sum(weights.values())
+        if not total or not len(ids):
+            return ids, scores
+
+        q_pairs = set(zip(q_tokens, q_tokens[1:]))
+        top_score = float(np.max(scores)) or 1.0
+        new_scores = []
+        for score, text in zip(scores, texts):
+            tokens = tokenize(text)
+            present = set(tokens)
+            coverage = sum(w for t, w in weights.items() if t in present) / total
+            phrase = 1.0 if q_pairs and not q_pairs.isdisjoint(zip(tokens, tokens[1:])) else 0.0
+            new_scores.append(float(score) / top_score + 0.05 * coverage + 0.05 * phrase)
+
+        order = np.argsort(-np.array(new_scores), kind="stable")
+        return np.asarray(ids)[order], np.array(new_scores, dtype=np.float32)[order]
+
+    #==================================================================
+    def save(self, dir_path):
+        os.makedirs(dir_path, exist_ok=True)
+        np.save(os.path.join(dir_path, POSTINGS_FILE), self.postings)
+        np.save(os.path.join(dir_path, TFS_FILE), self.tfs)
+        np.save(os.path.join(dir_path, TERM_OFFSETS_FILE), self.term_offsets)
+        np.save(os.path.join(dir_path, DOC_LENS_FILE), self.doc_lens)
+        with open(os.path.join(dir_path, PARAMS_FILE), "w") as f:
+            json.dump({"k1": self.k1, "b": self.b, "avg_len": self.avg_len,
+                       "vocab": self.vocab}, f, ensure_ascii=False)
+        logmsg(f"Saved lexical index to {dir_path}: {len(self.vocab)} terms, "
+               f"{len(self.postings)} postings")
+
+    @staticmethod
+    def exists(dir_path) -> bool:
+        return os.path.exists(os.path.join(dir_path, PARAMS_FILE))
+
+    @classmethod
+    def load(cls, dir_path, use_mmap=False):
+        """ Load a saved index, see VectorIndex.load() for `use_mmap` """
+        with open(os.path.join(dir_path, PARAMS_FILE), "r") as f:
+            params = json.load(f)
+        mmap_mode = "r" if use_mmap else None
+        li = cls.__new__(cls)
+        li.k1 = params["k1"]
+        li.b = params["b"]
+        li.avg_len = params["avg_len"]
+        li.vocab = params["vocab"]
+        li.postings = np.load(os.path.join(dir_path, POSTINGS_FILE), mmap_mode=mmap_mode)
+        li.tfs = np.load(os.path.join(dir_path, TFS_FILE), mmap_mode=mmap_mode)
+        li.term_offsets = np.load(os.path.join(dir_path, TERM_OFFSETS_FILE), mmap_mode=mmap_mode)
+        li.doc_lens = np.load(os.path.join(dir_path, DOC_LENS_FILE), mmap_mode=mmap_mode)
+        logmsg(f"Loaded lexical index {dir_path}: {len(li.vocab)} terms, {len(li.doc_lens)} docs")
+        return li
+
+#==================================================================
+def score_confidence(scores) -> float:
+    """ How much the best result stands out from the others, 0 to 1.
+        A name found by BM25 stands out, a topic match does not """
+    if len(scores) < 2 or not scores[0]:
+        return 1.0 if len(scores) else 0.0
+    rest = float(np.mean(scores[1:]))
+    return max(0.0, min(1.0, (float(scores[0]) - rest) / abs(float(scores[0]))))
+
+def rrf_fuse(rankings, weights=None, k=RRF_K) -> tuple:
+    """ Reciprocal rank fusion of lists of doc ids, best first, optionally
+        weighted by list. Returns (doc ids, fused scores), best first """
+    fused = {}
+    for ranking, w in zip(rankings, weights or [1.0] * len(rankings)):
+        for rank, doc_id in enumerate(ranking):
+            doc_id = int(doc_id)
+            fused[doc_id] = fused.get(doc_id, 0.0) + w / (k + rank + 1)
+    ids = sorted(fused, key=fused.get, reverse=True)
+    return np.array(ids, dtype=np.int64), np.array([fused[i] for i in ids], dtype=np.float32)
+
+def hybrid_rank(lexical_index, query, vec_ids, vec_scores, n_candidates, get_text, rerank=True) -> tuple:
+    """ Fuse the vector ranking with the BM25 one for `query`, each weighted
+        by how confident it is, and optionally rerank.
+        `get_text(id)` gives the text of a row, for the reranker """
+    lex_ids, lex_scores = lexical_index.search(query, n_candidates)
+    ids, scores = rrf_fuse([vec_ids, lex_ids],
+                           weights=[score_confidence(vec_scores), score_confidence(lex_scores)])
+    ids, scores = ids[:n_candidates], scores[:n_candidates]
+    if rerank:
+        ids, scores = lexical_index.rerank(query, ids, scores, [get_text(i) for i in ids])
+    return ids, scores
@@ -0,0 +1,205 @@
+#==================================================================
+# ModelRouter.py
+#
+# Description: Route easy turns to the fast model, escalate the rest
+#==================================================================
+
+import re
+import time
+from pydantic import BaseModel
+from .logger import *
+from .OpenAIWrapper import OpenAIWrapper
+from . import UsageLedger
+from .TextUtils import estimate_tokens
+from .StatsUtils import StatsCounter
+
+# Easy-confidence above which the fast model is used
+DEFAULT_MIN_CONFIDENCE = 0.7
+
+GREETING_RE = re.compile(
+    r"^\W*(hi|hello|hey|yo|thanks|thank you|thx|ok|okay|bye|good (morning|evening|night)|"
+    r"ciao|grazie|salve|buongiorno|buonasera|こんにちは|こんばんは|おはよう|ありがとう)\b",
+    re.IGNORECASE)
+
+# The whole message is small talk (also what may follow a greeting)
+SMALL_TALK_RE = re.compile(
+    r"^\W*(how are you( doing| today)?|how's it going|what's up|nice to meet you|"
+    r"(ok|okay|yes|yeah|yep|no|nope|sure|cool|great|nice|awesome|perfect|got it|i see|lol|haha)"
+    r"( thanks| thank you)?|see you( later| tomorrow)?|bye|goodbye|good (morning|evening|night|afternoon)|"
+    r"come stai|tutto bene|va bene|perfetto|buonanotte|sì|si|元気ですか|おやすみ|はい|いいえ)\W*$",
+    re.IGNORECASE)
+
+# Below the default threshold: short is not easy by itself
+SHORT_MESSAGE_CONFIDENCE = 0.55
+
+HARD_WORDS_RE = re.compile(
+    r"\b(explain|why|how does|how do|compare|analy[sz]e|prove|derive|calculate|compute|"
+    r"write|code|debug|implement|refactor|translate|summari[sz]e|step by step|plan|"
+    r"research|pros and cons|difference between|perch[eé]|spiega|confronta|なぜ|説明)\b",
+    re.IGNORECASE)
+
+CODE_OR_MATH_RE = re.compile(r"```|\bdef |\bclass |\bfunction\b|[{};]\s*$|\\frac|\$\$|[∫∑√]", re.MULTILINE)
+
+#==================================================================
+class RouteDecision(BaseModel):
+    model: str
+    temperature: float
+    tier: str               # "fast" or "main"
+    easy_confidence: float
+    reason: str
+    route_time: float = 0.0
+
+def heuristic_easy_confidence(user_text, history=None, assistant_name=None) -> tuple:
+    """ Return (confidence that the turn is easy, reason) """
+    text = user_text.strip()
+    n = len(text)
+
+    if n == 0:
+        return 0.9, "empty"
+
+    if CODE_OR_MATH_RE.search(text):
+        return 0.05, "code_or_math"
+
+    if n > 400:
+        return 0.1, "long_message"
+
+    if HARD_WORDS_RE.search(text):
+        return 0.2, "hard_keywords"
+
+    # Follow-ups in a technical conversation should stay on the main model
+    if history:
+        for msg in history[-2:]:
+            if msg.get("role") == "assistant" and "```" in (msg.get("content") or ""):
+                return 0.3, "technical_context"
+
+    # A greeting followed by a real question is not a greeting
+    if n <= 60 and (m := GREETING_RE.search(text)):
+        names = ["there", "everyone", "all"] + ([re.escape(assistant_name)] if assistant_name else [])
+        rest = re.sub(rf"^({'|'.join(names)})\b", "", text[m.end():].strip(" ,.!?~"),
+                      flags=re.IGNORECASE).strip(" ,.!?~")
+        if len(rest) <= 12 or SMALL_TALK_RE.search(rest):
+            return 0.95, "greeting"
+
+    if n <= 60 and SMALL_TALK_RE.search(text):
+        return 0.9, "small_talk"
+
+    # Trivial questions answered from precomputed tool results (e.g. the time)
+    from .IntentFastPath import detect_intents
+    if detect_intents(text):
+        return 0.9, "trivial_intent"
+
+    # Short but with no sign of being simple ("Explain quantum tunneling"),
+    #  left to the model scoring, if enabled
+    if n <= 80:
+        return SHORT_MESSAGE_CONFIDENCE, "short_message"
+
+    return 0.5, "undecided"
+
+def model_easy_confidence(wrap: OpenAIWrapper, model, user_text, client_id=None) -> float:
+    """ Ask the cheap model to score the difficulty. Returns None on failure """
+    instructions = (
+        "Rate how difficult it is for an AI assistant to answer the user message "
+        "below, from 0 (trivial, e.g. a greeting) to 10 (requires expert reasoning). "
+        "Reply ONLY with the integer.")
+    try:
+        start_time = time.time()
+        response = wrap.CreateCompletion(
+            model=model,
+            temperature=0.0,
+            messages=[
+                {"role": "system", "content": instructions},
+                {"role": "user", "content": user_text[:2000]},
+            ])
+        UsageLedger.record(
+            client_id=client_id,
+            feature="router",
+            model=model,
+            usage=getattr(response, "usage", None),
+            latency=time.time() - start_time)
+        reply = response.choices[0].message.content or ""
+        if (m := re.search(r"\d+", reply)) is None:
+            return None
+        score = min(10, max(0, int(m.group(0))))
+        return 1.0 - score / 10.0
+    except Exception as e:
+        logerr(f"Error scoring the turn: {e}")
+        return None
+
+#==================================================================
+_stats = StatsCounter({
+    "turns": 0,
+    "fast": 0,
+    "main": 0,
+    "model_scored": 0,
+    "route_time_total": 0.0,
+    "est_saved_usd": 0.0,
+    "latency_total_fast": 0.0,
+    "latency_total_main": 0.0,
+})
+
+def route_turn(wrap: OpenAIWrapper, config, user_text, history=None, client_id=None) -> RouteDecision:
+    """ Pick the model for the turn. Uses the fast (support) model only
+        when confident that the turn is easy, otherwise escalates """
+    main_model = config["model_version"]
+    temperature = config.get("model_temperature", 0.7)
+
+    if not config.get("enable_model_router", False):
+        return RouteDecision(
+            model=main_model, temperature=temperature, tier="main",
+            easy_confidence=0.0, reason="router_disabled")
+
+    t0 = time.time()
+    fast_model = config.get("router_fast_model", config["support_model_version"])
+    min_conf = config.get("router_min_confidence", DEFAULT_MIN_CONFIDENCE)
+
+    conf, reason = heuristic_easy_confidence(user_text, history, config.get("assistant_name"))
+
+    # Only pay for the scoring call when the heuristics are in the gray area
+    model_scored = False
+    if config.get("router_use_model_scoring", False) and 0.3 <= conf < min_conf:
+        if (mconf := model_easy_confidence(wrap, fast_model, user_text, client_id)) is not None:
+            conf = (conf + mconf) / 2
+            reason += "+model_score"
+            model_scored = True
+
+    use_fast = conf >= min_conf
+    decision = RouteDecision(
+        model=fast_model if use_fast else main_model,
+        temperature=temperature,
+        tier="fast" if use_fast else "main",
+        easy_confidence=conf,
+        reason=reason,
+        route_time=time.time() - t0)
+
+    # Estimated savings on the prompt side, from the history size and the
+    #  rough USD price per 1K prompt tokens of the models in the config
+    saved = 0.0
+    if use_fast:
+        cost_per_1k = config.get("model_cost_per_1k", {})
+        n_tokens = estimate_tokens(user_text) + sum(
+            estimate_tokens(m.get("content") or "") for m in (history or []))
+        saved = n_tokens / 1000 * (
+            cost_per_1k.get(main_model, 0.0) - cost_per_1k.get(fast_model, 0.0))
+
+    _stats.add(**{
+        "turns": 1,
+        decision.tier: 1,
+        "model_scored": int(model_scored),
+        "route_time_total": decision.route_time,
+        "est_saved_usd": max(0.0, saved)})
+
+    logmsg(f"Route: {decision.tier} ({decision.model}) conf={conf:.2f} "
+           f"reason={reason} time={decision.route_time * 1e3:.1f}ms est_saved=${saved:.5f}")
+    return decision
+
+def record_latency(decision: RouteDecision, seconds):
+    """ Record the full reply time of a routed turn, to compare the tiers """
+    _stats.add(**{f"latency_total_{decision.tier}": seconds})
+    logmsg(f"Reply time for {decision.tier} ({decision.model}): {seconds:.2f}s")
+
+def get_stats() -> dict:
+    return _stats.get(ratios={
+        "fast_ratio": ("fast", "turns"),
+        "avg_route_time": ("route_time_total", "turns"),
+        "avg_latency_fast": ("latency_total_fast", "fast"),
+        "avg_latency_main": ("latency_total_main", "main")})
@@ -0,0 +1,138 @@
+#==================================================================
+# MsgJournal.py
+#
+# Description: Append-only journal for MsgThread persistence
+#==================================================================
+
+import os
+import json
+from threading import Lock
+from .logger import *
+
+# One compact JSON array per line:
+#   ["t", thread_id]                first record, identifies the thread
+#   ["a", message_dict]             message added
+#   ["u", src_id, content_list]     message content updated
+OP_THREAD = "t"
+OP_ADD = "a"
+OP_UPDATE = "u"
+
+# Compact when the journal has this many more records than messages
+COMPACT_MIN_EXTRA = 64
+# ...and the extra records are at least this fraction of the messages
+COMPACT_EXTRA_RATIO = 1.0
+
+#==================================================================
+class MsgJournal:
+    """ Persistence cost is O(new messages): each add/update is appended as
+        one line. The journal is periodically compacted into a snapshot
+        (one add per message), written to a temp file and atomically
+        swapped in. On load, a torn last line (e.g. after a crash) is
+        dropped and truncated away. """
+    def __init__(self, path, sync_writes=False):
+        self.path = path
+        self.sync_writes = sync_writes
+        self.n_records = 0
+        self.lock = Lock()
+        self._file = None
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def _open_for_append(self):
+        if self._file is None:
+            if (dirname := os.path.dirname(self.path)):
+                os.makedirs(dirname, exist_ok=True)
+            self._file = open(self.path, "ab")
+
+    def _write_line(self, rec):
+        self._open_for_append()
+        self._file.write(json.dumps(rec, separators=(',', ':')).encode("utf-8") + b"\n")
+        self._file.flush()
+        if self.sync_writes:
+            os.fsync(self._file.fileno())
+        self.n_records += 1
+
+    def append_add(self, msg_dict):
+        with self.lock:
+            self._write_line([OP_ADD, msg_dict])
+
+    def append_update(self, src_id, content_list):
+        with self.lock:
+            self._write_line([OP_UPDATE, src_id, content_list])
+
+    def needs_compaction(self, n_messages) -> bool:
+        extra = self.n_records - (n_messages + 1)
+        return extra >= COMPACT_MIN_EXTRA and extra >= n_messages * COMPACT_EXTRA_RATIO
+
+    def compact(self, thread_id, msg_dicts):
+        """ Rewrite the journal as a snapshot of the given messages """
+        tmp_path = self.path + ".tmp"
+        with self.lock:
+            if (dirname := os.path.dirname(self.path)):
+                os.makedirs(dirname, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                lines = [json.dumps([OP_THREAD, thread_id], separators=(',', ':'))]
+                lines += [json.dumps([OP_ADD, m], separators=(',', ':')) for m in msg_dicts]
+                f.write(("\n".join(lines) + "\n").encode("utf-8"))
+                f.flush()
+                os.fsync(f.fileno())
+
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            os.replace(tmp_path, self.path)
+            self.n_records = len(lines)
+        logmsg(f"Compacted journal {self.path} to {self.n_records} records")
+
+    def replay(self) -> tuple:
+        """ Return (thread_id, list of message dicts) from the journal """
+        thread_id = None
+        msgs = []
+        index = {}
+        good_end = 0
+        n_records = 0
+        with self.lock:
+            with open(self.path, "rb") as f:
+                data = f.read()
+
+            pos = 0
+            while pos < len(data):
+                nl = data.find(b"\n", pos)
+                if nl == -1:
+                    logwarn(f"Incomplete record at offset {pos} in {self.path}. Dropping.")
+                    break
+                try:
+                    rec = json.loads(data[pos:nl])
+                except ValueError:
+                    logwarn(f"Corrupt record at offset {pos} in {self.path}. Dropping the tail.")
+                    break
+
+                op = rec[0]
+                if op == OP_THREAD:
+                    thread_id = rec[1]
+                elif op == OP_ADD:
+                    index[rec[1]['src_id']] = len(msgs)
+                    msgs.append(rec[1])
+                elif op == OP_UPDATE:
+                    if (idx := index.get(rec[1])) is not None:
+                        msgs[idx]['content'] = rec[2]
+                    else:
+                        logwarn(f"Update for unknown message {rec[1]}. Ignoring.")
+                n_records += 1
+                pos = good_end = nl + 1
+
+            # Cut away the damaged tail, so that new appends start clean
+            if good_end < len(data):
+                with open(self.path, "r+b") as f:
+                    f.truncate(good_end)
+
+            self.n_records = n_records
+
+        return thread_id, msgs
+
+    def close(self):
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,80 @@
+#==================================================================
+# MsgSpill.py
+#
+# Description: On-disk segment for the older messages of a MsgThread
+#==================================================================
+
+import os
+import json
+from array import array
+from threading import Lock
+from . import ThreadCodec
+
+#==================================================================
+class MsgSpill:
+    """ Append-only segment file, one JSON row per line (see ThreadCodec).
+        Only the file offset of each message is kept in RAM (8 bytes each),
+        messages are paged back in on demand. """
+    def __init__(self, path):
+        self.path = path
+        self.offsets = array('q')
+        self.lock = Lock()
+        if (dirname := os.path.dirname(path)):
+            os.makedirs(dirname, exist_ok=True)
+        # Always start from an empty segment
+        self._file = open(path, "w+b")
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, records):
+        with self.lock:
+            self._file.seek(0, os.SEEK_END)
+            pos = self._file.tell()
+            lines = []
+            for msg in records:
+                line = json.dumps(ThreadCodec.record_to_row(msg), separators=(',', ':')).encode("utf-8") + b"\n"
+                self.offsets.append(pos)
+                pos += len(line)
+                lines.append(line)
+            self._file.write(b"".join(lines))
+            self._file.flush()
+
+    def _read_row_locked(self, idx):
+        self._file.seek(self.offsets[idx])
+        return json.loads(self._file.readline())
+
+    def read_range(self, start, end) -> list:
+        """ Page in the records [start, end) """
+        with self.lock:
+            rows = [self._read_row_locked(i) for i in range(start, min(end, len(self.offsets)))]
+        return ThreadCodec.rows_to_records(rows)
+
+    def iter_records(self, start=0, batch=256):
+        for i in range(start, len(self.offsets), batch):
+            yield from self.read_range(i, i + batch)
+
+    def update_content(self, src_id, content):
+        """ Update a spilled message (rare): the new version is appended and
+            the offset redirected. Returns the new record, or None if not found """
+        with self.lock:
+            for i in range(len(self.offsets) - 1, -1, -1):
+                row = self._read_row_locked(i)
+                if row[0] != src_id:
+                    continue
+                row[3] = [list(c) for c in content]
+                self._file.seek(0, os.SEEK_END)
+                pos = self._file.tell()
+                self._file.write(json.dumps(row, separators=(',', ':')).encode("utf-8") + b"\n")
+                self._file.flush()
+                self.offsets[i] = pos
+                return ThreadCodec.rows_to_records([row])[0]
+        return None
+
+    def close(self, remove=True):
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if remove and os.path.isfile(self.path):
+                os.remove(self.path)
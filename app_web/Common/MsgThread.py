@@ -5,21 +5,140 @@
 # Description:
 #==================================================================
 
+import re
+import sys
 import json
 import time
 import uuid
 from .logger import *
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 from typing import List, Dict, Optional, Any
 from .OpenAIWrapper import OpenAIWrapper
+from . import ThreadCodec
 
 META_TAG = "message_meta"
+# Number of messages at the start of the thread always kept for completions
+KEEP_HEAD_N = 4
+# Windowed threads spill in batches, to amortize the cost
+SPILL_BATCH = 32
+MIN_WINDOW_SIZE = 64
+META_BEGIN_TAG = f"<{META_TAG}>"
+META_END_TAG = f"</{META_TAG}>"
+# A metadata block (and its trailing newline, if any)
+META_BLOCK_RE = re.compile(f"{META_BEGIN_TAG}.*?{META_END_TAG}\n?", re.DOTALL)
+META_UNIX_TIME_RE = re.compile(r"unix_time:\s*(\d+)")
+
+def format_meta(meta) -> str:
+    """ The metadata block as seen by the model, e.g.
+        <message_meta>\nunix_time: 1620000000\n</message_meta>\n """
+    lines = "".join(f"{k}: {v}\n" for k, v in meta.items())
+    return f"{META_BEGIN_TAG}\n{lines}{META_END_TAG}\n"
 
+#==================================================================
+class MsgRecord:
+    """ Compact message: slots instead of a dict, interned role/type strings
+        and the content as a tuple of (type, value) pairs.
+        Metadata (e.g. unix_time of user messages) is kept in `meta` and
+        only injected in the text when building the completion payload.
+        Dict-style access (e.g. msg['src_id']) is kept for compatibility,
+        but hot paths should use the attributes. """
+    __slots__ = ("src_id", "created_at", "role", "_content", "meta", "_dict")
+
+    def __init__(self, src_id, created_at, role, content, meta=None):
+        self.src_id = src_id
+        self.created_at = created_at
+        self.role = sys.intern(role)
+        self._content = content
+        self.meta = meta
+        self._dict = None
+
+    @property
+    def content(self):
+        return self._content
+
+    @content.setter
+    def content(self, content):
+        self._content = content
+        self._dict = None
+
+    @staticmethod
+    def make_content(pairs) -> tuple:
+        return tuple((sys.intern(t), v) for t, v in pairs)
+
+    @classmethod
+    def from_dict(cls, d):
+        content = MsgRecord.make_content((c['type'], c['value']) for c in d['content'])
+        meta = d.get('meta')
+        # Migrate the legacy format, with the metadata inline in the text
+        if meta is None and d['role'] == 'user':
+            content, meta = MsgRecord.extract_inline_meta(content)
+        return cls(d['src_id'], d['created_at'], d['role'], content, meta)
+
+    @staticmethod
+    def extract_inline_meta(content) -> tuple:
+        """ Return (content without the metadata blocks, meta or None) """
+        meta = None
+        new_content = []
+        for ctype, value in content:
+            if ctype == 'text' and META_BEGIN_TAG in value:
+                if meta is None and (m := META_UNIX_TIME_RE.search(value)):
+                    meta = {"unix_time": int(m.group(1))}
+                value = MsgThread.deinstrument_user_message(value)
+            new_content.append((ctype, value))
+        return tuple(new_content), meta
+
+    def content_dicts(self) -> list:
+        return [{'type': t, 'value': v} for t, v in self._content]
+
+    def to_dict(self) -> dict:
+        """ Cached until the content changes, treat as read-only """
+        if self._dict is None:
+            d = {
+                'src_id': self.src_id,
+                'created_at': self.created_at,
+                'role': self.role,
+                'content': self.content_dicts()
+            }
+            if self.meta:
+                d['meta'] = self.meta
+            self._dict = d
+        return self._dict
+
+    def make_payload_text(self, value) -> str:
+        """ Text as sent to the model, with the metadata block (if any) """
+        return format_meta(self.meta) + value if self.meta else value
+
+    def __getitem__(self, key):
+        if key == 'content':
+            return self.content_dicts()
+        if key in MsgRecord.KEYS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in MsgRecord.KEYS else default
+
+    def __contains__(self, key):
+        return key in MsgRecord.KEYS
+
+MsgRecord.KEYS = ("src_id", "created_at", "role", "content", "meta")
+
+#==================================================================
 class MsgThread(BaseModel):
     wrap: OpenAIWrapper
     thread_id: str
-    messages: list = []
+    messages: list = []     # List of MsgRecord
     judge: Optional[Any] = None
+    # src_id -> index in messages
+    _index: dict = PrivateAttr(default_factory=dict)
+    # Optional append-only persistence, see MsgJournal
+    _journal: Any = PrivateAttr(default=None)
+    # Windowed mode: only the last `_window` messages (plus the head) stay in RAM,
+    #  the older ones are in `_spill` (see MsgSpill) and `messages` is the hot tail
+    _window: int = PrivateAttr(default=0)
+    _spill: Any = PrivateAttr(default=None)
+    _n_spilled: int = PrivateAttr(default=0)
+    _head: list = PrivateAttr(default_factory=list)
 
     class Config:
         arbitrary_types_allowed = True
@@ -34,42 +153,85 @@ class MsgThread(BaseModel):
         # TODO: Fetch the messages from the server
         return instance
 
+    @classmethod
+    def from_journal(cls, wrap: OpenAIWrapper, journal):
+        """ Load the thread from a journal, and keep appending to it """
+        thread_id, msg_dicts = journal.replay()
+        if thread_id is None:
+            return None
+        instance = cls(wrap=wrap, thread_id=thread_id)
+        instance.set_messages([MsgRecord.from_dict(m) for m in msg_dicts])
+        instance._journal = journal
+        return instance
+
+    def enable_windowing(self, window, spill_path):
+        """ Bound the resident messages to `window`, spilling older ones to disk """
+        from .MsgSpill import MsgSpill
+        self._window = max(window, MIN_WINDOW_SIZE)
+        self._spill = MsgSpill(spill_path)
+        self._spill_excess()
+
+    def release(self):
+        """ Free the resources of the thread (e.g. the spill file) """
+        if self._spill is not None:
+            self._spill.close(remove=True)
+            self._spill = None
+        if self._journal is not None:
+            self._journal.close()
+
+    def num_messages(self) -> int:
+        return self._n_spilled + len(self.messages)
+
+    def iter_all_messages(self):
+        """ All the messages, paging in the spilled ones """
+        if self._n_spilled:
+            yield from self._spill.iter_records()
+        yield from self.messages
+
+    def _spill_excess(self):
+        if not self._window or len(self.messages) <= self._window + SPILL_BATCH:
+            return
+        n = len(self.messages) - self._window
+        old = self.messages[:n]
+        self._spill.append(old)
+        del self.messages[:n]
+        self._n_spilled += n
+        # Re-base the index on the resident messages (once per batch)
+        self._index = {m.src_id: i for i, m in enumerate(self.messages)}
+        logmsg(f"Spilled {n} messages, {self._n_spilled} on disk, {len(self.messages)} in RAM")
+
+    def attach_journal(self, journal):
+        """ Start persisting to the journal, from a snapshot of the current state """
+        self._journal = journal
+        self.compact_journal()
+
+    def compact_journal(self):
+        if self._journal is not None:
+            self._journal.compact(self.thread_id, [m.to_dict() for m in self.iter_all_messages()])
+
+    def _journal_changed(self):
+        if self._journal.needs_compaction(self.num_messages()):
+            self.compact_journal()
+
     def to_json(self):
         # Convert messages to a serializable format
-        serializable_messages = [self.message_to_dict(m) for m in self.messages]
+        serializable_messages = [self.message_to_dict(m) for m in self.iter_all_messages()]
         return json.dumps({
             'thread_id': self.thread_id,
             'messages': serializable_messages})
 
     @staticmethod
     def instrument_user_message(msg_text):
-        return f"<{META_TAG}>\nunix_time: {int(time.time())}\n</{META_TAG}>\n{msg_text}"
+        return format_meta({"unix_time": int(time.time())}) + msg_text
 
     @staticmethod
     def deinstrument_user_message(msg_with_meta):
-        msg = msg_with_meta
-        begin_tag = f"<{META_TAG}>"
-        end_tag = f"</{META_TAG}>"
-        end_tag_len = len(end_tag)
-
-        while True:
-            start = msg.find(begin_tag)
-            if start == -1:
-                break
-            end = msg.find(end_tag, start)
-            if end == -1:
-                break
-
-            # Check if the character following the end tag is a newline
-            if msg[end + end_tag_len:end + end_tag_len + 1] == "\n":
-                msg = msg[:start] + msg[end + end_tag_len + 1:]
-            else:
-                msg = msg[:start] + msg[end + end_tag_len:]
-
-        return msg
-
+        # Remove all the metadata blocks, in a single pass
+        return META_BLOCK_RE.sub("", msg_with_meta)
 
     def message_to_dict(self, message):
+        if isinstance(message, MsgRecord):
+            return message.to_dict()
         # Convert each content item in the list to its dictionary representation
         content_list = [{'type': c['type'], 'value': c['value']} for c in message['content']]
         return {
@@ -80,6 +242,8 @@ class MsgThread(BaseModel):
         }
 
     def is_valid_message(self, message):
+        if isinstance(message, MsgRecord):
+            return True
         # Check if the message format is correct, including content being a list of dictionaries
         return ('src_id' in message and
                 'created_at' in message and
@@ -90,7 +254,29 @@ class MsgThread(BaseModel):
     def serialize_data(self):
         return self.to_json()
 
+    def to_bytes(self, codec=None, compress=False) -> bytes:
+        """ Binary encoding, see ThreadCodec. `compress` for archived threads """
+        return ThreadCodec.encode_thread(self.thread_id, self.iter_all_messages(), codec, compress)
+
+    def from_bytes(self, data) -> bool:
+        try:
+            thread_id, records = ThreadCodec.decode_thread(data)
+        except ThreadCodec.CodecError as e:
+            logerr(f"Error decoding thread: {e}. Ignoring.")
+            return False
+
+        if thread_id != self.thread_id:
+            logerr(f"Thread ID mismatch: {thread_id} != {self.thread_id}. Ignoring.")
+            return False
+
+        self.set_messages(records)
+        return True
+
     def deserialize_data(self, data):
+        if ThreadCodec.is_encoded_thread(data):
+            self.from_bytes(data)
+            return
+
         attrs = json.loads(data)
         if attrs['thread_id'] != self.thread_id:
             logerr(f"Thread ID mismatch: {attrs['thread_id']} != {self.thread_id}. Ignoring.")
@@ -104,42 +290,88 @@ class MsgThread(BaseModel):
                 logerr(f"Invalid message format: {msg}. Ignoring.")
                 return
 
-        self.messages = attrs['messages']
-
-    def create_judge(self, model, temperature):
+        self.set_messages([MsgRecord.from_dict(m) for m in attrs['messages']])
+
+    def set_messages(self, records):
+        # Restart from an empty spill, if windowed
+        if self._spill is not None:
+            from .MsgSpill import MsgSpill
+            self._spill.close(remove=True)
+            self._spill = MsgSpill(self._spill.path)
+        self._n_spilled = 0
+
+        self.messages = records
+        self._head = records[:KEEP_HEAD_N]
+        self._index = {m.src_id: i for i, m in enumerate(records)}
+        self._spill_excess()
+        if self._journal is not None:
+            self.compact_journal()
+
+    def get_message(self, src_id) -> MsgRecord:
+        """ Get a resident message (the spilled ones are not indexed) """
+        if (idx := self._index.get(src_id)) is None:
+            return None
+        return self.messages[idx]
+
+    def create_judge(self, model, temperature, claim_min_score=None):
         from .ConvoJudge import ConvoJudge
-        self.judge = ConvoJudge(model=model, temperature=temperature)
+        # The judge only looks at recent messages, keep it bounded as the thread
+        self.judge = ConvoJudge(
+            model=model,
+            temperature=temperature,
+            max_messages=self._window or None,
+            claim_min_score=claim_min_score)
         for msg in self.messages:
             self.judge.AddMessage(msg)
 
     def gen_fact_check(self, tools_user_data=None):
         return self.judge.GenFactCheck(self.wrap, tools_user_data)
 
-    def create_message(self, role, content) -> dict:
-        # Wrap content in a list containing one dictionary
-        message = {
-            "src_id": f"msg_{uuid.uuid4()}",
-            "created_at": time.time(),
-            "role": role,
-            "content": [{"type": "text", "value": content}]  # Now a list of dictionaries
-        }
+    def start_fact_check(self, tools_user_data=None):
+        from .ConvoJudge import FactCheckJob
+        return FactCheckJob(self.judge, self.wrap, tools_user_data)
+
+    def start_speculative_fact_check(self, src_id, tools_user_data=None):
+        """ Fact-check the message `src_id` while it's streamed, see SpeculativeFactCheckJob """
+        from .ConvoJudge import SpeculativeFactCheckJob
+        return SpeculativeFactCheckJob(self.judge, self.wrap, tools_user_data, src_id)
+
+    def create_message(self, role, content, meta=None) -> MsgRecord:
+        message = MsgRecord(
+            src_id=f"msg_{uuid.uuid4()}",
+            created_at=time.time(),
+            role=role,
+            content=(("text", content),),
+            meta=meta)
         self.add_message(message)
         return message
 
-    def update_message(self, src_id, content) -> dict:
+    def update_message(self, src_id, content) -> MsgRecord:
         # Find the message with the given src_id and update its content
-        for msg in self.messages:
-            if msg['src_id'] == src_id:
-                msg['content'] = [{"type": "text", "value": content}]
-                return msg
+        new_content = (("text", content),)
+        if (msg := self.get_message(src_id)) is not None:
+            msg.content = new_content
+        elif self._spill is not None and (msg := self._spill.update_content(src_id, new_content)):
+            # Keep the pinned head in sync
+            for h in self._head:
+                if h.src_id == src_id:
+                    h.content = new_content
+        else:
+            logerr(f"Message with src_id {src_id} not found. Ignoring update.")
+            return None
 
-        logerr(f"Message with src_id {src_id} not found. Ignoring update.")
-        return None
+        if self._journal is not None:
+            self._journal.append_update(src_id, msg.content_dicts())
+            self._journal_changed()
+        if self.judge:
+            self.judge.UpdateMessage(msg)
+        return msg
 
-    def create_user_message(self, content) -> dict:
-        return self.create_message("user", MsgThread.instrument_user_message(content))
+    def create_user_message(self, content) -> MsgRecord:
+        # Metadata is stored apart, see make_messages_for_completion
+        return self.create_message("user", content, meta={"unix_time": int(time.time())})
 
-    def create_assistant_message(self, content) -> dict:
+    def create_assistant_message(self, content) -> MsgRecord:
         return self.create_message("assistant", content)
 
     def add_message(self, msg):
@@ -147,23 +379,32 @@ class MsgThread(BaseModel):
             logerr(f"Invalid message format: {msg}. Ignoring.")
             return
 
+        if not isinstance(msg, MsgRecord):
+            msg = MsgRecord.from_dict(msg)
+
+        if self.num_messages() < KEEP_HEAD_N:
+            self._head.append(msg)
+        self._index[msg.src_id] = len(self.messages)
         self.messages.append(msg)
+        self._spill_excess()
+        if self._journal is not None:
+            self._journal.append_add(msg.to_dict())
+            self._journal_changed()
         if self.judge:
             self.judge.AddMessage(msg)
 
     def make_messages_for_completion(self, max_n) -> List[Dict[str, str]]:
         """Return a list of simplified dictionaries with 'role' and 'content' where content type is 'text',
         maintaining the first KEEP_HEAD_N messages and the last part to ensure the total is <= max_n."""
-        KEEP_HEAD_N = 4
-
         result = []
         #logmsg(f"Messages: {self.messages}")
 
         # Determine the number of messages to process based on max_n
-        total_messages = len(self.messages)
+        total_messages = self.num_messages()
         if total_messages > max_n:
             # If more than max_n messages, keep the first KEEP_HEAD_N and the last max_n - (KEEP_HEAD_N + 1) messages
-            messages_to_process = self.messages[:KEEP_HEAD_N] + self.messages[-(max_n - (KEEP_HEAD_N + 1)):]
+            # NOTE: the head is pinned in RAM, also for windowed threads
+            messages_to_process = self._head[:KEEP_HEAD_N] + self.messages[-(max_n - (KEEP_HEAD_N + 1)):]
             # Insert a placeholder message for redacted content
             result.append({"role": "system", "content": "*** CONTENT REDACTED FOR BREVITY ***"})
         else:
@@ -171,9 +412,9 @@ class MsgThread(BaseModel):
 
         for msg in messages_to_process:
             # Extract text type contents and append them as simple 'role': 'content' pairs
-            for c in msg['content']:
-                if c['type'] == 'text':
-                    result.append({"role": msg['role'], "content": c['value']})
+            for ctype, value in msg.content:
+                if ctype == 'text':
+                    result.append({"role": msg.role, "content": msg.make_payload_text(value)})
 
         # If messages were reduced, ensure the placeholder is correctly positioned
         if total_messages > max_n:
@@ -184,31 +425,17 @@ class MsgThread(BaseModel):
 
         return result
 
-    def make_messages_for_display(self):
-        # Return the messages, only modifying the user messages to remove the metadata
-        result = []
-        for msg in self.messages:
-            # Check if it's a user message and remove metadata
-            if msg['role'] == 'user':
-                cleaned_content = []
-                for c in msg['content']:
-                    if c['type'] == 'text':
-                        # Remove instrumented meta from the user message
-                        cleaned_text = MsgThread.deinstrument_user_message(c['value'])
-                        cleaned_content.append({'type': 'text', 'value': cleaned_text})
-                    else:
-                        # If not text, add as is
-                        cleaned_content.append(c)
-
-                result.append({
-                    'src_id': msg['src_id'],
-                    'created_at': msg['created_at'],
-                    'role': msg['role'],
-                    'content': cleaned_content
-                })
-            else:
-                # For non-user messages, add as is
-                result.append(msg)
+    def make_messages_for_display(self, start=0, count=None):
+        """ Messages [start, start + count) as dicts. Spilled messages are paged in """
+        # Metadata is not in the text, so the cached dicts can be returned as-is
+        if start == 0 and count is None and not self._n_spilled:
+            return [msg.to_dict() for msg in self.messages]
 
+        end = self.num_messages() if count is None else min(self.num_messages(), start + count)
+        result = []
+        if start < self._n_spilled:
+            result += [msg.to_dict() for msg in self._spill.read_range(start, min(end, self._n_spilled))]
+        hot_sta = max(0, start - self._n_spilled)
+        hot_end = max(hot_sta, end - self._n_spilled)
+        result += [msg.to_dict() for msg in self.messages[hot_sta:hot_end]]
         return result
-
@@ -6,16 +6,31 @@
 #==================================================================
 
 import re
+import time
 from .logger import *
 import json
 from .OpenAIWrapper import OpenAIWrapper
 from . import AssistTools
+from . import PromptCache
+from . import UsageLedger
+from . import ToolBudget
+from . import IntentFastPath
 from typing import List, Dict, Iterator
 
 #==================================================================
 def apply_tools(tool_calls, wrap, tools_user_data) -> list:
     logmsg(f"Tool calls: {tool_calls}")
     messages = []
+
+    # Knowledge base searches of the same turn get their queries embedded together
+    kb_queries = []
+    for call in tool_calls:
+        if call.function.name == "search_knowledge_base" and call.function.arguments:
+            try:
+                kb_queries.append(json.loads(call.function.arguments)["query"])
+            except (ValueError, KeyError):
+                pass
+    AssistTools.prefetch_kb_queries(kb_queries)
     # Process each tool/function call
     for call in tool_calls:
         if call.function.name is None:
@@ -25,22 +40,24 @@ def apply_tools(tool_calls, wrap, tools_user_data) -> list:
         args = json.loads(call.function.arguments) if call.function.arguments else {}
 
         logmsg(f"Tool call: {name}({args})")
+        IntentFastPath.record_model_tool_call(name)
 
         # Add wrap and tools_user_data to the arguments
         args["wrap"] = wrap
         args["tools_user_data"] = tools_user_data
 
-        # Look up the function in the dictionary and call it
-        if name in AssistTools.tool_items_dict:
-            function_response = AssistTools.tool_items_dict[name].function(args)
+        # Call the registered tool, within its time and concurrency limits
+        if name in AssistTools.registry:
+            function_response = AssistTools.registry.dispatch(name, args)
         else:
             function_response = AssistTools.fallback_tool_function(name, args)
 
         #logmsg(f"Tool respose: {function_response}")
 
+        # Compacted and trimmed to the budget of the tool
         content = None
         try:
-            content = json.dumps(function_response)
+            content = ToolBudget.make_tool_content(name, function_response)
         except:
             content = function_response.response
 
@@ -55,24 +72,47 @@ def apply_tools(tool_calls, wrap, tools_user_data) -> list:
     return messages
 
 #==================================================================
-def handle_non_stream(response, wrap, model, temperature, messages, tools_user_data):
+def record_usage(usage, model, feature, tools_user_data, latency):
+    PromptCache.record_usage(usage)
+    # NOTE: 'tools_user_data' is the Client ID for the web app
+    UsageLedger.record(
+        client_id=tools_user_data,
+        feature=feature,
+        model=model,
+        usage=usage,
+        latency=latency)
+
+def post_tool_feature(feature):
+    # Post-tool completions of the chat are tracked separately,
+    #  for the sub-agents they're part of the same feature
+    return "post-tool" if feature == "chat" else feature
+
+#==================================================================
+def handle_non_stream(response, wrap, model, temperature, messages, tools_user_data,
+                      feature="chat", start_time=None):
     # Handle the non-stream case
+    record_usage(getattr(response, "usage", None), model, feature, tools_user_data,
+                 time.time() - (start_time or time.time()))
     response_msg = response.choices[0].message
     if response_msg.tool_calls:
         tools_out = apply_tools(response_msg.tool_calls, wrap, tools_user_data)
         messages.append(response_msg)  # Add the response message to the conversation
         messages += tools_out  # Add the messages from the tools
+        pt_start_time = time.time()
         pt_response = wrap.CreateCompletion(
             model=model,
             temperature=temperature,
             messages=messages,
         )
+        record_usage(getattr(pt_response, "usage", None), model, post_tool_feature(feature),
+                     tools_user_data, time.time() - pt_start_time)
         return pt_response.choices[0].message.content
     else:
         return response_msg.content
 
 #==================================================================
-def handle_stream(response, wrap, model, temperature, messages, tools_user_data):
+def handle_stream(response, wrap, model, temperature, messages, tools_user_data,
+                  feature="chat", start_time=None):
 
     # A class to store the tool call that can mimic the structure tool_calls in the response
     class ToolCall:
@@ -80,6 +120,8 @@ def handle_stream(response, wrap, model, temperature, messages, tools_user_data)
             self.id = id
             self.function = self.Function(name=function_name, arguments=function_arguments)
             self.is_complete = False
+            # Argument deltas, joined once complete (+= on the attribute is quadratic)
+            self.arguments_parts = []
 
         class Function:
             def __init__(self, name=None, arguments=''):
@@ -90,9 +132,18 @@ def handle_stream(response, wrap, model, temperature, messages, tools_user_data)
     full_calls = {}
     cur_call_index = None
     accumulating_calls = False
+    start_time = start_time or time.time()
+    # When the main stream is over, excluding the tools and post-tool time
+    main_end_time = None
 
     # Process the stream of responses
     for response_it in response:
+        # The final chunk carries only the usage, with no choices
+        if not response_it.choices:
+            record_usage(getattr(response_it, "usage", None), model, feature, tools_user_data,
+                         (main_end_time or time.time()) - start_time)
+            continue
+
         response_d = response_it.choices[0].delta
 
         # Do we have tool calls ?
@@ -118,7 +169,7 @@ def handle_stream(response, wrap, model, temperature, messages, tools_user_data)
                     assert fc.function.name is None
                     fc.function.name = call_d.function.name
                 if call_d.function.arguments:
-                    fc.function.arguments += call_d.function.arguments
+                    fc.arguments_parts.append(call_d.function.arguments)
         else:
             # No more tool calls, can process the accumulated ones
             accumulating_calls = False
@@ -127,7 +178,11 @@ def handle_stream(response, wrap, model, temperature, messages, tools_user_data)
 
         # If we have a complete set of tool calls, process them
         if full_calls and not accumulating_calls:
+            main_end_time = time.time()
             fc_list = list(full_calls.values())
+            for c in fc_list:
+                c.function.arguments += "".join(c.arguments_parts)
+                c.arguments_parts = []
             tools_out = apply_tools(fc_list, wrap, tools_user_data)
 
             # Build the message that details the requested too calls
@@ -148,6 +203,7 @@ def handle_stream(response, wrap, model, temperature, messages, tools_user_data)
             fc_list = []
             full_calls = {}
             # Post-tool call completion
+            pt_start_time = time.time()
             pt_response = wrap.CreateCompletion(
                 model=model,
                 temperature=temperature,
@@ -155,6 +211,11 @@ def handle_stream(response, wrap, model, temperature, messages, tools_user_data)
                 stream=True)
 
             for pt_response_it in pt_response:
+                if not pt_response_it.choices:
+                    record_usage(getattr(pt_response_it, "usage", None), model,
+                                 post_tool_feature(feature), tools_user_data,
+                                 time.time() - pt_start_time)
+                    continue
                 yield pt_response_it.choices[0].delta.content
         else:
             yield response_d.content
@@ -167,29 +228,31 @@ def completion_with_tools(
         instructions: str,
         role_and_content_msgs: List[Dict[str, str]],
         tools_user_data=None,
-        stream=False) -> Iterator[str]:
+        stream=False,
+        feature="chat") -> Iterator[str]:
+
+    start_time = time.time()
 
-    tools = []
-    for item in AssistTools.tool_items:
-        # NOTE: "assistant" here means our agent system (e.g. research asssitant),
-        #  not OpenAI's high level API
-        if not item.requires_assistant:
-            tools.append({"type": "function", "function": item.definition})
+    # System message and tools are compiled once and reused byte-identical
+    cprompt = PromptCache.get_compiled_prompt(instructions)
 
-    messages = [
-        {"role": "system", "content": instructions},
-    ] + role_and_content_msgs
+    messages = cprompt.make_messages(role_and_content_msgs)
+    # Trivial tools (e.g. the local time) are answered up front, no round trip
+    if feature == "chat":
+        messages += IntentFastPath.make_messages(role_and_content_msgs, tools_user_data)
 
     response = wrap.CreateCompletion(
         model=model,
         temperature=temperature,
         messages=messages,
-        tools=tools,
+        tools=cprompt.tools,
         stream=stream,
     )
 
     if not stream:
-        yield handle_non_stream(response, wrap, model, temperature, messages, tools_user_data)
+        yield handle_non_stream(response, wrap, model, temperature, messages, tools_user_data,
+                                feature=feature, start_time=start_time)
     else:
-        yield from handle_stream(response, wrap, model, temperature, messages, tools_user_data)
+        yield from handle_stream(response, wrap, model, temperature, messages, tools_user_data,
+                                 feature=feature, start_time=start_time)
 
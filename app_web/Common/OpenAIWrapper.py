@@ -119,10 +119,13 @@ class OpenAIWrapper:
 
     #==== Completions
     def CreateCompletion(self, model, messages, temperature=0.7, tools=None, stream=False):
+        # When streaming, ask for the usage (sent as a final chunk with no choices)
+        extra = {"stream_options": {"include_usage": True}} if stream else {}
         return self.client.chat.completions.create(
             model=model,
             messages=messages,
             temperature=temperature,
             tools=tools,
             tool_choice="auto" if tools else None,
-            stream=stream)
+            stream=stream,
+            **extra)
@@ -0,0 +1,328 @@
+#==================================================================
+# PageFetch.py
+#
+# Description: Fetch search result pages and extract condensed passages
+#==================================================================
+
+import os
+import re
+import json
+import time
+import socket
+import hashlib
+import ipaddress
+import http.client
+import urllib.parse
+import urllib.request
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor, wait
+from .logger import *
+from .StatsUtils import StatsCounter
+
+USER_AGENT = "Mozilla/5.0 (compatible; ChatAI/1.0)"
+ACCEPTED_TYPES = ("text/html", "text/plain", "application/xhtml+xml")
+ALLOWED_SCHEMES = ("http", "https")
+
+_enabled = False
+_cache_dir = "_page_cache"
+_top_k = 3
+_max_bytes = 512 * 1024
+_timeout = 5.0
+_cache_ttl_sec = 24 * 3600
+_max_cache_files = 2000
+_passage_chars = 1500
+
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="pagefetch")
+
+#==================================================================
+def initialize(enabled=False, cache_dir="_page_cache", top_k=3, max_bytes=512 * 1024,
+               timeout=5.0, cache_ttl_hours=24, passage_chars=1500):
+    global _enabled, _cache_dir, _top_k, _max_bytes, _timeout, _cache_ttl_sec, _passage_chars
+    _enabled = enabled
+    _cache_dir = cache_dir
+    _top_k = top_k
+    _max_bytes = max_bytes
+    _timeout = timeout
+    _cache_ttl_sec = cache_ttl_hours * 3600
+    _passage_chars = passage_chars
+    if enabled:
+        os.makedirs(_cache_dir, exist_ok=True)
+
+def is_enabled() -> bool:
+    return _enabled
+
+#==================================================================
+class _TextExtractor(HTMLParser):
+    """ Collect the text of the content blocks, skipping scripts, menus and such """
+    SKIP_TAGS = {"script", "style", "noscript", "nav", "header", "footer", "aside",
+                 "form", "svg", "iframe", "button", "select", "template"}
+    BLOCK_TAGS = {"p", "li", "h1", "h2", "h3", "h4", "h5", "h6", "td", "th", "pre",
+                  "blockquote", "div", "article", "section", "br", "tr", "dd", "dt"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.skip_depth = 0
+        self.blocks = []
+        self.cur = []
+        self.title = ""
+        self.in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag == "title":
+            self.in_title = True
+        elif tag in self.BLOCK_TAGS:
+            self._end_block()
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag == "title":
+            self.in_title = False
+        elif tag in self.BLOCK_TAGS:
+            self._end_block()
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title += data
+        elif not self.skip_depth:
+            self.cur.append(data)
+
+    def _end_block(self):
+        if self.cur:
+            text = " ".join("".join(self.cur).split())
+            if text:
+                self.blocks.append(text)
+            self.cur = []
+
+def extract_main_text(html) -> tuple:
+    """ Return (title, list of text blocks). Short blocks (menus, buttons,
+        captions) are dropped, unless they look like sentences """
+    parser = _TextExtractor()
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception as e:
+        logwarn(f"HTML parsing error: {e}")
+    parser._end_block()
+    blocks = [b for b in parser.blocks if len(b) >= 60 or b.endswith((".", "!", "?", ":"))]
+    return parser.title.strip(), blocks
+
+_word_re = re.compile(r"\w+")
+_stopwords = frozenset("""
+the and for are was were with from that this what which who how when where why
+does did can could would should about into than then there their have has had
+""".split())
+
+def condense(blocks, query, max_chars=None) -> str:
+    """ Keep the blocks most relevant to the query (by term overlap),
+        in their original order, up to `max_chars`. Blocks without any
+        query term are only used if no block has one """
+    max_chars = max_chars or _passage_chars
+    terms = {w for w in _word_re.findall(query.lower()) if len(w) > 2 and w not in _stopwords}
+    scored = []
+    for i, b in enumerate(blocks):
+        words = _word_re.findall(b.lower())
+        hits = sum(1 for w in words if w in terms)
+        # Early blocks get a small bonus, pages tend to lead with the answer
+        scored.append((hits / (1 + len(words) ** 0.5) + 0.05 / (1 + i), i, hits))
+
+    if any(hits for _, _, hits in scored):
+        scored = [s for s in scored if s[2]]
+
+    picked = []
+    n_chars = 0
+    for _, i, _ in sorted(scored, reverse=True):
+        if n_chars >= max_chars:
+            break
+        block = blocks[i][:max_chars - n_chars]
+        picked.append((i, block))
+        n_chars += len(block)
+    return "\n".join(b for _, b in sorted(picked))
+
+#==================================================================
+def _cache_path(url):
+    return os.path.join(_cache_dir, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+def _cache_get(url):
+    path = _cache_path(url)
+    try:
+        if time.time() - os.path.getmtime(path) > _cache_ttl_sec:
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _cache_put(url, rec):
+    try:
+        tmp_path = _cache_path(url) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(rec, f)
+        os.replace(tmp_path, _cache_path(url))
+    except OSError as e:
+        logwarn(f"Page cache write failed: {e}")
+
+def _prune_cache():
+    """ Drop the oldest extracts when the cache is over its size """
+    try:
+        names = [n for n in os.listdir(_cache_dir) if n.endswith(".json")]
+        if len(names) <= _max_cache_files:
+            return
+        paths = sorted((os.path.join(_cache_dir, n) for n in names), key=os.path.getmtime)
+        for p in paths[:len(paths) - _max_cache_files]:
+            os.remove(p)
+    except OSError as e:
+        logwarn(f"Page cache pruning failed: {e}")
+
+#==================================================================
+_stats = StatsCounter({
+    "pages": 0,
+    "cache_hits": 0,
+    "fetched": 0,
+    "failed": 0,
+    "timeouts": 0,
+    "bytes": 0,
+})
+
+def _public_addrinfos(host, port) -> list:
+    """ Resolve `host`, raise ValueError unless all its addresses are public """
+    try:
+        infos = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError) as e:
+        raise ValueError(f"Cannot resolve {host}: {e}")
+    for info in infos:
+        ip = ipaddress.ip_address(info[4][0].split("%")[0])
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(f"Host {host} resolves to a non-public address {ip}")
+    return infos
+
+def check_url(url):
+    """ Raise ValueError unless the URL is http(s) and its host resolves only
+        to public addresses. The URLs come from the search results, they must
+        not reach the server's own network (e.g. the cloud metadata service) """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ALLOWED_SCHEMES:
+        raise ValueError(f"Unsupported URL scheme {parts.scheme!r}")
+    if not parts.hostname:
+        raise ValueError("URL without a host")
+    _public_addrinfos(parts.hostname, parts.port or 0)
+
+def _create_checked_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                               source_address=None):
+    """ socket.create_connection() to the addresses that were checked, not to
+        a new lookup of the host, which could give a private one (DNS rebinding) """
+    host, port = address
+    err = None
+    for family, type_, proto, _, sockaddr in _public_addrinfos(host, port):
+        sock = socket.socket(family, type_, proto)
+        try:
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            err = e
+            sock.close()
+    raise err or OSError(f"Cannot connect to {host}")
+
+# The Host header, the SNI and the certificate check still use the host name
+class _CheckedHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _create_checked_connection
+
+class _CheckedHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _create_checked_connection
+
+class _CheckedHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_CheckedHTTPConnection, req)
+
+class _CheckedHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_CheckedHTTPSConnection, req, context=self._context)
+
+class _CheckedRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """ Redirects are checked like the first URL """
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+# No proxies: a proxy would resolve the host again, after the check
+_opener = urllib.request.build_opener(
+    urllib.request.ProxyHandler({}), _CheckedHTTPHandler, _CheckedHTTPSHandler,
+    _CheckedRedirectHandler)
+
+def fetch_page(url, max_bytes=None, timeout=None) -> dict:
+    """ Download a page (at most `max_bytes`) and extract its text blocks.
+        Returns {"url", "title", "blocks"}, raises on errors """
+    max_bytes = max_bytes or _max_bytes
+    check_url(url)
+    req = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
+    with _opener.open(req, timeout=timeout or _timeout) as resp:
+        ctype = resp.headers.get_content_type()
+        if ctype not in ACCEPTED_TYPES:
+            raise ValueError(f"Unsupported content type {ctype}")
+        data = resp.read(max_bytes)
+        charset = resp.headers.get_content_charset() or "utf-8"
+
+    _stats.add(bytes=len(data))
+    html = data.decode(charset, errors="replace")
+    if ctype == "text/plain":
+        return {"url": url, "title": "", "blocks": [b for b in html.split("\n\n") if b.strip()]}
+    title, blocks = extract_main_text(html)
+    return {"url": url, "title": title, "blocks": blocks}
+
+def _get_page(url):
+    if (rec := _cache_get(url)) is not None:
+        _stats.add(cache_hits=1)
+        return rec
+    rec = fetch_page(url)
+    _cache_put(url, rec)
+    _stats.add(fetched=1)
+    return rec
+
+def add_passages(results, query, top_k=None, url_key="href") -> list:
+    """ Fetch the pages of the first `top_k` results concurrently and add the
+        condensed passages relevant to `query` as "passages". Pages that fail
+        or don't make the deadline keep only their snippet """
+    top_k = _top_k if top_k is None else top_k
+    # Copies, results may be shared (e.g. by a search fixture)
+    results = [dict(r) for r in results]
+    futures = {}
+    for r in results[:top_k]:
+        if (url := r.get(url_key)) and url.startswith(("http://", "https://")):
+            futures[_executor.submit(_get_page, url)] = r
+
+    # Time limit for the whole stage, not per page
+    done, not_done = wait(futures, timeout=_timeout + 1.0)
+    n_failed = 0
+    for fut, r in futures.items():
+        if fut not in done:
+            continue
+        try:
+            page = fut.result()
+            if page["blocks"]:
+                r["passages"] = condense(page["blocks"], query)
+        except Exception as e:
+            logwarn(f"Fetch failed for {r.get(url_key)}: {e}")
+            n_failed += 1
+
+    _stats.add(pages=len(futures), failed=n_failed, timeouts=len(not_done))
+    n_fetched = _stats.get()["fetched"]
+    if n_fetched and n_fetched % 100 == 0:
+        _prune_cache()
+    return results
+
+def get_stats() -> dict:
+    stats = _stats.get(ratios={"cache_hit_ratio": ("cache_hits", "pages")})
+    stats["enabled"] = _enabled
+    return stats
@@ -0,0 +1,85 @@
+#==================================================================
+# PromptCache.py
+#
+# Description: Compiled system prompt + tools, stable across requests
+#==================================================================
+
+import json
+import hashlib
+from threading import Lock
+from .logger import *
+from .StatsUtils import StatsCounter
+from . import AssistTools
+
+# Max number of distinct compiled prompts (main assistant, judges, ...)
+MAX_COMPILED_PROMPTS = 16
+
+#==================================================================
+class CompiledPrompt:
+    """ System message and tool schemas built once and then reused as-is.
+        Keeping the request prefix byte-identical lets the provider-side
+        prompt caching hit reliably. """
+    def __init__(self, instructions, tools):
+        self.system_msg = {"role": "system", "content": instructions}
+        self.tools = tools
+        self.prefix_hash = hashlib.sha1(
+            (instructions + json.dumps(tools, sort_keys=True)).encode("utf-8")
+        ).hexdigest()[:12]
+
+    def make_messages(self, role_and_content_msgs):
+        return [self.system_msg] + role_and_content_msgs
+
+def build_tools_schema() -> list:
+    tools = []
+    for item in AssistTools.registry.items():
+        # NOTE: "assistant" here means our agent system (e.g. research asssitant),
+        #  not OpenAI's high level API
+        if not item.requires_assistant:
+            tools.append({"type": "function", "function": item.definition})
+    return tools
+
+#==================================================================
+_lock = Lock()
+_compiled = {}
+_stats = StatsCounter({
+    "compiles": 0,
+    "lookups": 0,
+    "requests_with_usage": 0,
+    "prompt_tokens": 0,
+    "cached_prompt_tokens": 0,
+})
+
+def get_compiled_prompt(instructions) -> CompiledPrompt:
+    """ Return the compiled prompt for the instructions and the current tools """
+    key = (instructions, AssistTools.registry.version)
+    with _lock:
+        _stats.add(lookups=1)
+        if (cp := _compiled.get(key)) is not None:
+            return cp
+
+        # Drop the oldest entry if full (dicts keep insertion order)
+        if len(_compiled) >= MAX_COMPILED_PROMPTS:
+            del _compiled[next(iter(_compiled))]
+
+        cp = CompiledPrompt(instructions, build_tools_schema())
+        _compiled[key] = cp
+        _stats.add(compiles=1)
+
+    logmsg(f"Compiled prompt {cp.prefix_hash} ({len(instructions)} chars, {len(cp.tools)} tools)")
+    return cp
+
+def record_usage(usage):
+    """ Accumulate the prompt-cache stats from a completion `usage` object """
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+    prompt = getattr(usage, "prompt_tokens", 0) or 0
+    _stats.add(requests_with_usage=1, prompt_tokens=prompt, cached_prompt_tokens=cached)
+    logmsg(f"Prompt tokens: {prompt}, cached: {cached}")
+
+def get_stats() -> dict:
+    stats = _stats.get(ratios={"cached_prompt_ratio": ("cached_prompt_tokens", "prompt_tokens")})
+    with _lock:
+        stats["compiled_prompts"] = len(_compiled)
+    return stats
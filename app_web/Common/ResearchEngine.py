@@ -0,0 +1,154 @@
+#==================================================================
+# ResearchEngine.py
+#
+# Description: Concurrent search fan-out for the research assistant
+#==================================================================
+
+import re
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from .logger import *
+from . import PageFetch
+from .TextUtils import normalize_url
+from .StatsUtils import StatsCounter
+
+MAX_VARIANTS = 3
+WEB_RESULTS_PER_QUERY = 5
+KB_RESULTS = 5
+# Searches still running after this are dropped from the evidence
+FAN_OUT_TIMEOUT_SEC = 10.0
+MAX_SNIPPET_CHARS = 500
+
+# Shared by all the research requests
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="research")
+
+_stopwords = frozenset("""
+a an the of in on at to for from by with about into over is are was were be been
+what which who whom whose when where why how do does did can could should would
+will shall may might must please tell me us you your i my we our it its this that
+these those there some any and or but if then than as so just
+""".split())
+
+_word_re = re.compile(r"[\w'-]+")
+
+#==================================================================
+def make_query_variants(query, max_variants=MAX_VARIANTS) -> list:
+    """ The query, plus cheap local rewrites that tend to surface other results """
+    query = query.strip()
+    variants = [query]
+
+    # Keywords only (search engines do better without the question words)
+    words = _word_re.findall(query)
+    keywords = " ".join(w for w in words if w.lower() not in _stopwords)
+    variants.append(keywords)
+
+    # Quoted multi-word names (e.g. "Eiffel Tower"), when there are any
+    names = re.findall(r"\b[A-Z][\w-]+(?:\s+[A-Z][\w-]+)+", query)
+    if names:
+        rest = " ".join(w for w in keywords.split() if not any(w in n for n in names))
+        variants.append(" ".join(f'"{n}"' for n in names) + (" " + rest if rest else ""))
+
+    # Unique, non-empty, in order
+    out = []
+    for v in variants:
+        if v and v.lower() not in (o.lower() for o in out):
+            out.append(v)
+    return out[:max_variants]
+
+def _web_evidence(results, query):
+    return [{"source": "web",
+             "query": query,
+             "title": r.get("title", ""),
+             "url": r.get("href") or r.get("url", ""),
+             "snippet": (r.get("body") or "")[:MAX_SNIPPET_CHARS]}
+            for r in results or []]
+
+def _kb_evidence(results, query):
+    if isinstance(results, str):
+        results = json.loads(results)
+    return [{"source": "knowledge_base",
+             "query": query,
+             "title": (r.get("metadata") or {}).get("title", ""),
+             "url": (r.get("metadata") or {}).get("url", ""),
+             "snippet": (r.get("text") or "")[:MAX_SNIPPET_CHARS]}
+            for r in results or []]
+
+#==================================================================
+_stats = StatsCounter({
+    "runs": 0,
+    "searches": 0,
+    "search_errors": 0,
+    "search_timeouts": 0,
+    "duplicates_dropped": 0,
+    "total_time": 0.0,
+})
+
+def gather_evidence(query, web_search_fn, kb_search_fn=None, timeout=FAN_OUT_TIMEOUT_SEC) -> list:
+    """ Run the web searches for all the query variants, and the knowledge
+        base search if available, concurrently. Return the merged evidence,
+        with duplicate URLs removed. Failed or late searches are skipped.
+        `kb_search_fn` takes the list of variants (embedded in one batch) """
+    start_time = time.time()
+    variants = make_query_variants(query)
+
+    futures = {}
+    for v in variants:
+        fut = _executor.submit(web_search_fn, v, max_results=WEB_RESULTS_PER_QUERY)
+        futures[fut] = (_web_evidence, v)
+    if kb_search_fn is not None:
+        futures[_executor.submit(kb_search_fn, variants)] = (_kb_evidence, query)
+
+    done, not_done = wait(futures, timeout=timeout)
+
+    n_errors = 0
+    evidence = []
+    # Keep the order of submission, the original query first
+    for fut, (to_evidence, q) in futures.items():
+        if fut not in done:
+            continue
+        try:
+            evidence += to_evidence(fut.result(), q)
+        except Exception as e:
+            logerr(f"Search failed for '{q}': {e}")
+            n_errors += 1
+
+    seen = set()
+    merged = []
+    for e in evidence:
+        key = normalize_url(e["url"]) if e["url"] else e["snippet"][:100]
+        if key in seen:
+            continue
+        seen.add(key)
+        merged.append(e)
+
+    # Passages from the top pages (knowledge base entries already have the text)
+    if PageFetch.is_enabled():
+        web = PageFetch.add_passages(
+            [e for e in merged if e["source"] == "web"], query, url_key="url")
+        merged = web + [e for e in merged if e["source"] != "web"]
+
+    elapsed = time.time() - start_time
+    _stats.add(
+        runs=1,
+        searches=len(futures),
+        search_errors=n_errors,
+        search_timeouts=len(not_done),
+        duplicates_dropped=len(evidence) - len(merged),
+        total_time=elapsed)
+
+    logmsg(f"Research fan-out: {len(variants)} variants, {len(merged)} results, "
+           f"{len(evidence) - len(merged)} duplicates, {elapsed:.2f}s")
+    return merged
+
+def format_evidence(evidence) -> str:
+    """ Evidence as one block for the completion """
+    out = []
+    for i, e in enumerate(evidence, 1):
+        title = e["title"] or e["source"]
+        url = f" <{e['url']}>" if e["url"] else ""
+        out.append(f"[{i}] {title}{url}\n{e.get('passages') or e['snippet']}\n")
+    return "\n".join(out)
+
+def get_stats() -> dict:
+    return _stats.get(ratios={"avg_time": ("total_time", "runs")})
@@ -0,0 +1,31 @@
+#==================================================================
+# StatsUtils.py
+#
+# Description: Thread-safe counters for the get_stats() of the modules
+#==================================================================
+
+import copy
+from threading import Lock
+
+def ratio(num, den) -> float:
+    return (num / den) if den else 0.0
+
+class StatsCounter:
+    """ Counters shared by the threads of a module. Nested dicts (e.g. per
+        tool) are updated under `lock`, the plain counters with add() """
+    def __init__(self, counters: dict):
+        self.lock = Lock()
+        self.counters = counters
+
+    def add(self, **deltas):
+        with self.lock:
+            for key, delta in deltas.items():
+                self.counters[key] += delta
+
+    def get(self, ratios=None) -> dict:
+        """ Copy of the counters, plus the `ratios` {name: (num key, den key)} """
+        with self.lock:
+            stats = copy.deepcopy(self.counters)
+        for name, (num, den) in (ratios or {}).items():
+            stats[name] = ratio(stats[num], stats[den])
+        return stats
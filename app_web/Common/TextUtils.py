@@ -0,0 +1,17 @@
+#==================================================================
+# TextUtils.py
+#
+# Description: Small text helpers shared by the tools and the routing
+#==================================================================
+
+import re
+
+def estimate_tokens(text) -> int:
+    # ~4 characters per token is good enough for cost estimates
+    return max(1, len(text) // 4)
+
+def normalize_url(url) -> str:
+    """ URL without scheme, "www.", fragment and trailing slash, to find duplicates """
+    url = url.strip().split("#", 1)[0]
+    url = re.sub(r"^https?://(www\.)?", "", url, flags=re.I)
+    return url.rstrip("/").lower()
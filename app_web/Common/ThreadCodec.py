@@ -0,0 +1,141 @@
+#==================================================================
+# ThreadCodec.py
+#
+# Description: Pluggable codecs for MsgThread serialization and transfer
+#==================================================================
+
+import json
+import zlib
+
+# Optional dependencies
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Binary header: magic, codec id, compression id
+MAGIC = b"CTH1"
+CODEC_IDS = {"json": 0, "msgpack": 1}
+COMP_NONE = 0
+COMP_ZLIB = 1
+COMP_ZSTD = 2
+
+FORMAT_VERSION = 1
+
+class CodecError(ValueError):
+    pass
+
+#==================================================================
+# Rows are positional: [src_id, created_at, role, [[type, value], ...], meta]
+def record_to_row(msg) -> list:
+    return [msg.src_id, msg.created_at, msg.role, [list(c) for c in msg.content], msg.meta]
+
+def rows_to_records(rows) -> list:
+    """ Validate and convert in a single pass """
+    from .MsgThread import MsgRecord
+    if not isinstance(rows, list):
+        raise CodecError("messages is not a list")
+
+    records = []
+    for i, row in enumerate(rows):
+        if not (isinstance(row, (list, tuple)) and len(row) == 5):
+            raise CodecError(f"message {i}: bad row")
+        src_id, created_at, role, content, meta = row
+        if not (isinstance(src_id, str) and isinstance(role, str)
+                and isinstance(created_at, (int, float))
+                and isinstance(content, (list, tuple))
+                and (meta is None or isinstance(meta, dict))):
+            raise CodecError(f"message {i}: bad field type")
+        for c in content:
+            if not (isinstance(c, (list, tuple)) and len(c) == 2
+                    and isinstance(c[0], str) and isinstance(c[1], str)):
+                raise CodecError(f"message {i}: bad content")
+        records.append(MsgRecord(
+            src_id, created_at, role, MsgRecord.make_content(content), meta))
+    return records
+
+#==================================================================
+class JsonCodec:
+    """ Same positional layout as the binary codecs, encoded as JSON """
+    name = "json"
+
+    def encode(self, doc) -> bytes:
+        return json.dumps(doc, separators=(',', ':')).encode("utf-8")
+
+    def decode(self, data):
+        return json.loads(data)
+
+class MsgpackCodec:
+    name = "msgpack"
+
+    def encode(self, doc) -> bytes:
+        return msgpack.packb(doc, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False, use_list=True, strict_map_key=False)
+
+_codecs = {"json": JsonCodec()}
+if msgpack is not None:
+    _codecs["msgpack"] = MsgpackCodec()
+
+def available_codecs() -> list:
+    return list(_codecs.keys())
+
+def best_codec_name() -> str:
+    return "msgpack" if "msgpack" in _codecs else "json"
+
+#==================================================================
+def _compress(data, compress):
+    if not compress:
+        return COMP_NONE, data
+    if zstandard is not None:
+        return COMP_ZSTD, zstandard.ZstdCompressor(level=3).compress(data)
+    return COMP_ZLIB, zlib.compress(data, 6)
+
+def _decompress(comp_id, data):
+    if comp_id == COMP_NONE:
+        return data
+    if comp_id == COMP_ZLIB:
+        return zlib.decompress(data)
+    if comp_id == COMP_ZSTD:
+        if zstandard is None:
+            raise CodecError("zstd-compressed data, but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise CodecError(f"Unknown compression {comp_id}")
+
+def encode_thread(thread_id, records, codec=None, compress=False) -> bytes:
+    """ Encode to bytes, with a small header naming codec and compression.
+        `compress` is meant for archived threads (zstd if available, else zlib) """
+    codec = codec or best_codec_name()
+    if codec not in _codecs:
+        raise CodecError(f"Codec {codec} not available")
+    doc = [FORMAT_VERSION, thread_id, [record_to_row(m) for m in records]]
+    comp_id, payload = _compress(_codecs[codec].encode(doc), compress)
+    return MAGIC + bytes([CODEC_IDS[codec], comp_id]) + payload
+
+def is_encoded_thread(data) -> bool:
+    return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:4]) == MAGIC
+
+def decode_thread(data) -> tuple:
+    """ Return (thread_id, list of MsgRecord). Raises CodecError """
+    if not is_encoded_thread(data) or len(data) < 6:
+        raise CodecError("Not an encoded thread")
+    codec_id, comp_id = data[4], data[5]
+    codec = next((c for n, c in _codecs.items() if CODEC_IDS[n] == codec_id), None)
+    if codec is None:
+        raise CodecError(f"Codec {codec_id} not available")
+    try:
+        doc = codec.decode(_decompress(comp_id, bytes(data[6:])))
+    except CodecError:
+        raise
+    except Exception as e:
+        raise CodecError(f"Decoding failed: {e}")
+
+    if not (isinstance(doc, list) and len(doc) == 3 and doc[0] == FORMAT_VERSION):
+        raise CodecError("Bad document header")
+    return doc[1], rows_to_records(doc[2])
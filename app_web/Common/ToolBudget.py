@@ -0,0 +1,188 @@
+#==================================================================
+# ToolBudget.py
+#
+# Description: Fit the tool outputs to a token budget, before the completion
+#==================================================================
+
+import json
+from .logger import *
+from .TextUtils import estimate_tokens, normalize_url
+from .StatsUtils import StatsCounter, ratio
+
+# Max tokens of the output of each tool, DEFAULT_BUDGET for the others
+DEFAULT_BUDGETS = {
+    "perform_web_search": 1500,
+    "search_knowledge_base": 2000,
+    "ask_research_assistant": 2500,
+}
+DEFAULT_BUDGET = 2000
+
+# Metadata worth showing to the model, the rest (paths, sizes, dates...) is dropped
+KEEP_METADATA_KEYS = ("title", "url", "file_name", "page_label", "source")
+# Long text fields of the results, shortened to fit, in this order of preference
+TEXT_KEYS = ("passages", "text", "body", "snippet")
+# Text fields are not shortened below this, results are dropped instead
+MIN_FIELD_CHARS = 200
+
+_enabled = True
+_budgets = dict(DEFAULT_BUDGETS)
+
+def initialize(enabled=True, budgets=None):
+    global _enabled, _budgets
+    _enabled = enabled
+    _budgets = dict(DEFAULT_BUDGETS)
+    _budgets.update(budgets or {})
+
+def get_budget(tool_name) -> int:
+    return _budgets.get(tool_name, DEFAULT_BUDGET)
+
+#==================================================================
+def _dumps(obj) -> str:
+    # No spaces and no \u escapes, both cost tokens
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+def _compact_item(item) -> dict:
+    out = {}
+    for k, v in item.items():
+        if k == "metadata" and isinstance(v, dict):
+            v = {mk: mv for mk, mv in v.items() if mk in KEEP_METADATA_KEYS and mv not in (None, "")}
+        elif k == "score" and isinstance(v, float):
+            v = round(v, 3)
+        if v in (None, "", [], {}):
+            continue
+        out[k] = v
+    # The page passages include what the search snippet says
+    if out.get("passages"):
+        out.pop("body", None)
+    return out
+
+def _item_key(item):
+    if url := item.get("href") or item.get("url") or (item.get("metadata") or {}).get("url"):
+        return normalize_url(url)
+    return next((item[k] for k in TEXT_KEYS if isinstance(item.get(k), str)), None)
+
+def _shorten(text, max_chars) -> str:
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind(" ", 0, max_chars)
+    return text[:cut if cut > max_chars // 2 else max_chars].rstrip() + "…"
+
+def _with_cap(items, cap) -> list:
+    return [{k: (_shorten(v, cap) if k in TEXT_KEYS and isinstance(v, str) else v)
+             for k, v in it.items()} for it in items]
+
+def _fit_items(items, budget) -> tuple:
+    """ Shorten the text fields to a common length, then drop results from
+        the end, until within `budget`. Returns (items, n dropped) """
+    if estimate_tokens(_dumps(items)) <= budget:
+        return items, 0
+
+    longest = max((len(v) for it in items for k, v in it.items()
+                   if k in TEXT_KEYS and isinstance(v, str)), default=0)
+    # Longest cap that fits
+    lo, hi = MIN_FIELD_CHARS, max(MIN_FIELD_CHARS, longest)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(_dumps(_with_cap(items, mid))) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    items = _with_cap(items, lo)
+
+    n_dropped = 0
+    while len(items) > 1 and estimate_tokens(_dumps(items)) > budget:
+        items = items[:-1]
+        n_dropped += 1
+    return items, n_dropped
+
+def _fit_text(text, budget) -> str:
+    """ Cut long text at a paragraph (or line) end within the budget """
+    max_chars = budget * 4
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind("\n\n", 0, max_chars)
+    if cut < max_chars // 2:
+        cut = text.rfind("\n", 0, max_chars)
+    if cut < max_chars // 2:
+        cut = max_chars
+    return text[:cut].rstrip() + "\n[...]"
+
+#==================================================================
+_stats = StatsCounter({
+    "calls": 0,
+    "trimmed_calls": 0,
+    "tokens_in": 0,
+    "tokens_out": 0,
+    "duplicates_dropped": 0,
+    "results_dropped": 0,
+    "by_tool": {},
+})
+
+def _decode_json_text(response):
+    """ Results already encoded as JSON text, as a list or dict, else None """
+    text = response.lstrip()
+    if not text.startswith(("[", "{")):
+        return None
+    try:
+        decoded = json.loads(text)
+    except ValueError:
+        return None
+    return decoded if isinstance(decoded, (list, dict)) else None
+
+def make_tool_content(tool_name, response) -> str:
+    """ The tool response as the content of the tool message, compacted and
+        fitted to the budget of the tool. Raises TypeError if the response
+        is not JSON-serializable """
+    original = json.dumps(response)
+    if not _enabled:
+        return original
+
+    # Tools returning json.dumps() of their results get them compacted too,
+    #  not cut as text in the middle of a record
+    if isinstance(response, str) and (decoded := _decode_json_text(response)) is not None:
+        original = response
+        response = decoded
+
+    budget = get_budget(tool_name)
+    n_dups = n_dropped = 0
+    if isinstance(response, list) and all(isinstance(r, dict) for r in response):
+        items = []
+        seen = set()
+        for r in response:
+            key = _item_key(r)
+            if key is not None and key in seen:
+                n_dups += 1
+                continue
+            seen.add(key)
+            items.append(_compact_item(r))
+        items, n_dropped = _fit_items(items, budget)
+        content = _dumps(items)
+    elif isinstance(response, str):
+        content = _dumps(_fit_text(response, budget))
+    else:
+        content = _dumps(response)
+
+    n_in = estimate_tokens(original)
+    n_out = estimate_tokens(content)
+    _stats.add(
+        calls=1,
+        tokens_in=n_in,
+        tokens_out=n_out,
+        duplicates_dropped=n_dups,
+        results_dropped=n_dropped,
+        trimmed_calls=int(n_out < n_in))
+    with _stats.lock:
+        tool = _stats.counters["by_tool"].setdefault(tool_name, {"calls": 0, "tokens_saved": 0})
+        tool["calls"] += 1
+        tool["tokens_saved"] += n_in - n_out
+
+    if n_out < n_in:
+        logmsg(f"Tool output {tool_name}: ~{n_in} -> ~{n_out} tokens")
+    return content
+
+def get_stats() -> dict:
+    stats = _stats.get()
+    stats["enabled"] = _enabled
+    stats["tokens_saved"] = stats["tokens_in"] - stats["tokens_out"]
+    stats["saved_ratio"] = ratio(stats["tokens_saved"], stats["tokens_in"])
+    return stats
@@ -0,0 +1,174 @@
+#==================================================================
+# ToolRegistry.py
+#
+# Description: Registered tools, and their dispatch with limits and stats
+#==================================================================
+
+import json
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from threading import Lock, BoundedSemaphore
+from typing import Callable, Optional, Dict, Any
+from pydantic import BaseModel
+from .logger import *
+
+# Latencies kept per tool, for the percentiles
+LATENCY_WINDOW = 1000
+# Max number of cached results, all tools together
+MAX_CACHED_RESULTS = 256
+# Arguments added by apply_tools, not part of the call itself
+CONTEXT_ARGS = ("wrap", "tools_user_data")
+
+#==================================================================
+class ToolItem(BaseModel):
+    name: str
+    function: Callable[[dict], Any]
+    requires_assistant: bool = False
+    definition: Dict[str, Any]
+    # Seconds before the call is abandoned (the thread is left to finish)
+    timeout: float = 30.0
+    # Calls running at once, including the abandoned ones still running
+    max_concurrency: int = 4
+    # Results can be reused for the same arguments, by any user
+    cacheable: bool = False
+    cache_ttl: float = 600.0
+    # Called with the same arguments when the tool fails or times out
+    fallback: Optional[Callable[[dict], Any]] = None
+
+def _percentile(sorted_vals, p):
+    return sorted_vals[min(len(sorted_vals) - 1, int(p * len(sorted_vals)))]
+
+#==================================================================
+class ToolRegistry:
+    """ The tools by name. Registering a name again replaces the tool.
+        `version` changes whenever the set of tools does (see PromptCache) """
+    def __init__(self, max_workers=32):
+        self.lock = Lock()
+        self.tools = {}
+        self.semaphores = {}
+        self.timeouts = {}
+        self.version = 0
+        self.cache = OrderedDict()
+        self.stats = {}
+        self.latencies = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+
+    def set_timeouts(self, timeouts):
+        """ Timeouts by tool name, overriding the ones of the tools """
+        with self.lock:
+            self.timeouts.update(timeouts or {})
+            for name, item in self.tools.items():
+                item.timeout = self.timeouts.get(name, item.timeout)
+
+    def register(self, *items):
+        with self.lock:
+            for item in items:
+                item.timeout = self.timeouts.get(item.name, item.timeout)
+                self.tools[item.name] = item
+                self.semaphores[item.name] = BoundedSemaphore(item.max_concurrency)
+            self.version += 1
+
+    def unregister(self, name):
+        with self.lock:
+            if self.tools.pop(name, None) is not None:
+                self.version += 1
+
+    def __contains__(self, name):
+        return name in self.tools
+
+    def get(self, name) -> Optional[ToolItem]:
+        return self.tools.get(name)
+
+    def items(self) -> list:
+        """ Snapshot of the tools, in order of registration """
+        with self.lock:
+            return list(self.tools.values())
+
+    #==================================================================
+    def _count(self, name, key, n=1):
+        with self.lock:
+            st = self.stats.setdefault(name, {
+                "calls": 0, "errors": 0, "timeouts": 0, "rejected": 0,
+                "cache_hits": 0, "fallbacks": 0})
+            st[key] += n
+
+    def _cache_key(self, name, args):
+        try:
+            return name, json.dumps({k: v for k, v in args.items() if k not in CONTEXT_ARGS},
+                                    sort_keys=True)
+        except TypeError:
+            return None
+
+    def _failed(self, item, args, reason):
+        """ Result of a failed call: the fallback's, or an error for the model """
+        if item.fallback is not None:
+            self._count(item.name, "fallbacks")
+            logwarn(f"Tool {item.name} {reason}, using its fallback")
+            try:
+                return item.fallback(args)
+            except Exception as e:
+                logerr(f"Fallback of tool {item.name} failed: {e}")
+        return {"error": f"The tool {item.name} {reason}"}
+
+    def dispatch(self, name, args):
+        """ Call a registered tool, within its timeout and concurrency limit """
+        item = self.tools[name]
+        self._count(name, "calls")
+        start_time = time.time()
+
+        key = self._cache_key(name, args) if item.cacheable else None
+        if key is not None:
+            with self.lock:
+                entry = self.cache.get(key)
+                if entry is not None and time.time() - entry[0] < item.cache_ttl:
+                    self.cache.move_to_end(key)
+                    self.stats[name]["cache_hits"] += 1
+                    return entry[1]
+
+        # The slot is held until the function returns, even if abandoned
+        sem = self.semaphores[name]
+        if not sem.acquire(timeout=item.timeout):
+            self._count(name, "rejected")
+            return self._failed(item, args, "is busy")
+        try:
+            fut = self.executor.submit(item.function, args)
+        except Exception:
+            sem.release()
+            raise
+        fut.add_done_callback(lambda _: sem.release())
+
+        remaining = max(0.1, item.timeout - (time.time() - start_time))
+        try:
+            result = fut.result(timeout=remaining)
+        except FutureTimeoutError:
+            self._count(name, "timeouts")
+            return self._failed(item, args, f"timed out after {item.timeout}s")
+        except Exception as e:
+            logerr(f"Tool {name} failed: {e}")
+            self._count(name, "errors")
+            return self._failed(item, args, "failed")
+        finally:
+            with self.lock:
+                self.latencies.setdefault(name, deque(maxlen=LATENCY_WINDOW)).append(
+                    time.time() - start_time)
+
+        if key is not None:
+            with self.lock:
+                self.cache[key] = (time.time(), result)
+                if len(self.cache) > MAX_CACHED_RESULTS:
+                    self.cache.popitem(last=False)
+        return result
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            stats = {name: dict(st) for name, st in self.stats.items()}
+            latencies = {name: sorted(lat) for name, lat in self.latencies.items()}
+        for name, st in stats.items():
+            n = st["calls"]
+            st["error_rate"] = ((st["errors"] + st["timeouts"] + st["rejected"]) / n) if n else 0.0
+            if lat := latencies.get(name):
+                st["p50_ms"] = 1e3 * _percentile(lat, 0.50)
+                st["p95_ms"] = 1e3 * _percentile(lat, 0.95)
+                st["p99_ms"] = 1e3 * _percentile(lat, 0.99)
+        return stats
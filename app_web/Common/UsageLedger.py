@@ -0,0 +1,190 @@
+#==================================================================
+# UsageLedger.py
+#
+# Description: Per-client token usage and latency, in rolling daily files
+#==================================================================
+
+import os
+import hmac
+import json
+import time
+import atexit
+import hashlib
+from datetime import datetime, timezone, timedelta
+from threading import Lock
+from .logger import *
+
+# Record layout, one compact JSON array per line
+# [unix_time, client_id, feature, model, prompt_tokens, completion_tokens, cached_tokens, latency_ms]
+# The client_id is a pseudonym (see client_pseudonym()), not the session id
+FIELDS = ["time", "client_id", "feature", "model",
+          "prompt_tokens", "completion_tokens", "cached_tokens", "latency_ms"]
+
+FILE_PREFIX = "usage_"
+FILE_EXT = ".jsonl"
+# Secret key of the pseudonyms, created in the ledger directory
+ID_KEY_FILE = ".id_key"
+
+FLUSH_EVERY_N = 32      # Flush after this many records...
+FLUSH_EVERY_SEC = 10.0  # ...or after this many seconds
+
+_lock = Lock()
+# Nothing is recorded until initialize() sets the directory
+_ledger_dir = None
+_retention_days = 30
+_id_key = None
+_pending = []
+_last_flush = time.time()
+
+#==================================================================
+def initialize(ledger_dir, retention_days=30):
+    global _ledger_dir, _retention_days, _id_key
+    _ledger_dir = ledger_dir
+    _retention_days = retention_days
+    os.makedirs(_ledger_dir, exist_ok=True)
+    _id_key = _load_id_key(os.path.join(_ledger_dir, ID_KEY_FILE))
+
+def _load_id_key(path) -> bytes:
+    """ The key is kept with the ledger, so that pseudonyms stay the same
+        across restarts and workers (the first one to create it wins) """
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(os.urandom(32))
+    except FileExistsError:
+        pass
+    with open(path, "rb") as f:
+        return f.read()
+
+def client_pseudonym(client_id) -> str:
+    """ Stable id of a client in the ledger, which doesn't reveal its session id """
+    if not client_id:
+        return "-"
+    return hmac.new(_id_key or b"", str(client_id).encode("utf-8"), hashlib.sha256).hexdigest()[:16]
+
+def _day_str(unix_time):
+    return datetime.fromtimestamp(unix_time, timezone.utc).strftime("%Y%m%d")
+
+def _file_path_for_day(day_str):
+    return os.path.join(_ledger_dir, f"{FILE_PREFIX}{day_str}{FILE_EXT}")
+
+def record(client_id, feature, model, usage, latency):
+    """ Add a record from a completion `usage` object (may be None) """
+    if _ledger_dir is None:
+        return
+    pt = getattr(usage, "prompt_tokens", 0) or 0
+    ct = getattr(usage, "completion_tokens", 0) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+
+    rec = [int(time.time()), client_pseudonym(client_id), feature, model,
+           pt, ct, cached, int(latency * 1000)]
+
+    with _lock:
+        _pending.append(rec)
+        if len(_pending) >= FLUSH_EVERY_N or (time.time() - _last_flush) >= FLUSH_EVERY_SEC:
+            _flush_locked()
+
+def flush():
+    with _lock:
+        _flush_locked()
+
+def _flush_locked():
+    global _pending, _last_flush
+    _last_flush = time.time()
+    if not _pending or _ledger_dir is None:
+        return
+    try:
+        os.makedirs(_ledger_dir, exist_ok=True)
+        # Group by day, records are normally all in the same file
+        by_day = {}
+        for rec in _pending:
+            by_day.setdefault(_day_str(rec[0]), []).append(rec)
+        for day, recs in by_day.items():
+            with open(_file_path_for_day(day), "a") as f:
+                f.write("".join(json.dumps(r, separators=(',', ':')) + "\n" for r in recs))
+        _pending = []
+        _prune_old_files()
+    except Exception as e:
+        logerr(f"Error writing the usage ledger: {e}")
+
+def _prune_old_files():
+    oldest = _day_str(time.time() - _retention_days * 86400)
+    for name in os.listdir(_ledger_dir):
+        if name.startswith(FILE_PREFIX) and name.endswith(FILE_EXT):
+            if name[len(FILE_PREFIX):-len(FILE_EXT)] < oldest:
+                os.remove(os.path.join(_ledger_dir, name))
+
+atexit.register(flush)
+
+#==================================================================
+def _iter_records(days):
+    """ Iterate the records of the last `days` days, oldest first """
+    since = time.time() - days * 86400
+    now = datetime.now(timezone.utc)
+    with _lock:
+        pending = list(_pending)
+
+    for i in range(days, -1, -1):
+        if _ledger_dir is None:
+            break
+        path = _file_path_for_day((now - timedelta(days=i)).strftime("%Y%m%d"))
+        if not os.path.isfile(path):
+            continue
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue # Partially written line
+                if rec[0] >= since:
+                    yield rec
+
+    for rec in pending:
+        if rec[0] >= since:
+            yield rec
+
+def _new_totals():
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0,
+            "cached_tokens": 0, "total_tokens": 0, "latency_ms": 0}
+
+def _add_to_totals(tot, rec):
+    tot["calls"] += 1
+    tot["prompt_tokens"] += rec[4]
+    tot["completion_tokens"] += rec[5]
+    tot["cached_tokens"] += rec[6]
+    tot["total_tokens"] += rec[4] + rec[5]
+    tot["latency_ms"] += rec[7]
+
+def _finish_totals(tot):
+    tot["avg_latency_ms"] = tot["latency_ms"] // tot["calls"] if tot["calls"] else 0
+    del tot["latency_ms"]
+    return tot
+
+def top_consumers(n=10, days=1, feature=None, by="total_tokens") -> list:
+    """ Return the top `n` clients by `by` (e.g. total_tokens, calls, avg_latency_ms)
+        over the last `days` days, with a per-feature breakdown """
+    clients = {}
+    for rec in _iter_records(days):
+        if feature and rec[2] != feature:
+            continue
+        c = clients.setdefault(rec[1], {"totals": _new_totals(), "features": {}})
+        _add_to_totals(c["totals"], rec)
+        _add_to_totals(c["features"].setdefault(rec[2], _new_totals()), rec)
+
+    out = []
+    for client_id, c in clients.items():
+        entry = _finish_totals(c["totals"])
+        entry["client_id"] = client_id
+        entry["features"] = {k: _finish_totals(v) for k, v in c["features"].items()}
+        out.append(entry)
+
+    out.sort(key=lambda e: e.get(by, 0), reverse=True)
+    return out[:n]
+
+def summary_by_feature(days=1) -> dict:
+    """ Totals per feature and model over the last `days` days """
+    out = {}
+    for rec in _iter_records(days):
+        _add_to_totals(out.setdefault(f"{rec[2]}/{rec[3]}", _new_totals()), rec)
+    return {k: _finish_totals(v) for k, v in out.items()}
@@ -0,0 +1,186 @@
+#==================================================================
+# VectorIndex.py
+#
+# Description: In-process vector index, a NumPy matrix and a metadata table
+#==================================================================
+
+import os
+import json
+import mmap
+import numpy as np
+from .logger import *
+
+# Files of a saved index
+HEADER_FILE = "index.json"
+EMBEDDINGS_FILE = "embeddings.npy"
+SCALES_FILE = "scales.npy"
+META_FILE = "meta.jsonl"
+# Byte offsets of the lines of META_FILE, for the lookups in place
+META_OFFSETS_FILE = "meta_offsets.npy"
+
+FORMAT_VERSION = 1
+
+# Rows per block when scoring an int8 matrix (bounds the float32 temporaries)
+INT8_BLOCK_ROWS = 1024
+
+#==================================================================
+def quantize_int8(matrix):
+    """ Rows of a float matrix as int8, with a float32 scale per row """
+    scales = np.abs(matrix).max(axis=1) / 127.0
+    scales = np.maximum(scales, 1e-12).astype(np.float32)
+    return np.round(matrix / scales[:, None]).astype(np.int8), scales
+
+#==================================================================
+class _MappedRecords:
+    """ Read-only sequence of the records of a saved index. The table is
+        memory-mapped and a record is only parsed when accessed """
+    def __init__(self, path, offsets):
+        self.offsets = offsets
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return json.loads(self.mm[self.offsets[i]:self.offsets[i + 1]])
+
+def _line_offsets(path):
+    """ For the tables saved without META_OFFSETS_FILE """
+    offsets = [0]
+    with open(path, "rb") as f:
+        for line in f:
+            offsets.append(offsets[-1] + len(line))
+    return np.array(offsets, dtype=np.int64)
+
+#==================================================================
+class VectorIndex:
+    """ Exact cosine top-k over a contiguous embedding matrix.
+        Rows are L2-normalized at build time, so cosine is a dot product and
+        a batch of queries is one matrix product. With `quantize`, rows are
+        stored as int8 with a per-row scale (4x smaller, tiny score error).
+        Texts and metadata are in a sidecar table, by row """
+    def __init__(self, embeddings, records, quantize=False):
+        emb = np.asarray(embeddings, dtype=np.float32)
+        if emb.ndim != 2 or len(emb) != len(records):
+            raise ValueError("embeddings must be (N, dim) with one record per row")
+
+        norms = np.linalg.norm(emb, axis=1, keepdims=True)
+        emb = emb / np.maximum(norms, 1e-12)
+
+        self.records = list(records)
+        self.dim = emb.shape[1]
+        self.header = {}
+        if quantize:
+            self.matrix, self.scales = quantize_int8(emb)
+        else:
+            self.matrix = np.ascontiguousarray(emb)
+            self.scales = None
+
+    @property
+    def is_quantized(self) -> bool:
+        return self.scales is not None
+
+    def __len__(self):
+        return len(self.records)
+
+    def nbytes(self) -> int:
+        return self.matrix.nbytes + (self.scales.nbytes if self.is_quantized else 0)
+
+    def _scores(self, queries):
+        """ (Q, N) cosine scores for (Q, dim) normalized queries """
+        if not self.is_quantized:
+            return queries @ self.matrix.T
+
+        out = np.empty((len(queries), len(self.matrix)), dtype=np.float32)
+        for sta in range(0, len(self.matrix), INT8_BLOCK_ROWS):
+            block = self.matrix[sta:sta + INT8_BLOCK_ROWS].astype(np.float32)
+            out[:, sta:sta + len(block)] = (queries @ block.T) * self.scales[sta:sta + len(block)]
+        return out
+
+    def search_ids(self, query_embeddings, top_k=5) -> list:
+        """ For each query, (row ids, scores) best first """
+        q = np.asarray(query_embeddings, dtype=np.float32).reshape(-1, self.dim)
+        if len(self.records) == 0:
+            return [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)) for _ in q]
+
+        q = q / np.maximum(np.linalg.norm(q, axis=1, keepdims=True), 1e-12)
+        scores = self._scores(q)
+
+        k = min(top_k, scores.shape[1])
+        # Partial selection, then sort only the k best
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        out = []
+        for qi in range(len(q)):
+            idx = top[qi][np.argsort(-scores[qi, top[qi]])]
+            out.append((idx, scores[qi, idx]))
+        return out
+
+    def search(self, query_embeddings, top_k=5) -> list:
+        """ For each query, a list of (score, record) best first """
+        return [[(float(s), self.records[i]) for i, s in zip(ids, scores)]
+                for ids, scores in self.search_ids(query_embeddings, top_k)]
+
+    #==================================================================
+    def save(self, dir_path, extra_header=None):
+        os.makedirs(dir_path, exist_ok=True)
+        np.save(os.path.join(dir_path, EMBEDDINGS_FILE), self.matrix)
+        if self.is_quantized:
+            np.save(os.path.join(dir_path, SCALES_FILE), self.scales)
+        offsets = [0]
+        with open(os.path.join(dir_path, META_FILE), "wb") as f:
+            for rec in self.records:
+                line = (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+                f.write(line)
+                offsets.append(offsets[-1] + len(line))
+        np.save(os.path.join(dir_path, META_OFFSETS_FILE), np.array(offsets, dtype=np.int64))
+
+        header = {"version": FORMAT_VERSION,
+                  "count": len(self.records),
+                  "dim": self.dim,
+                  "quantized": self.is_quantized}
+        header.update(extra_header or {})
+        with open(os.path.join(dir_path, HEADER_FILE), "w") as f:
+            json.dump(header, f, indent=2)
+        logmsg(f"Saved vector index to {dir_path}: {len(self.records)} rows, "
+               f"{self.nbytes() / 1e6:.1f} MB")
+
+    @classmethod
+    def load(cls, dir_path, quantize=False, use_mmap=False):
+        """ Load a saved index. With `quantize`, a float32 index is
+            converted to int8 at load time.
+            With `use_mmap`, the matrix and the records are mapped read-only
+            from the files: the pages are in the OS cache, shared by all the
+            processes that map the same index, and loaded on first access """
+        with open(os.path.join(dir_path, HEADER_FILE), "r") as f:
+            header = json.load(f)
+        if header.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported vector index version {header.get('version')}")
+
+        meta_path = os.path.join(dir_path, META_FILE)
+        mmap_mode = "r" if use_mmap else None
+        # Bypass __init__, the saved rows are already normalized/quantized
+        vi = cls.__new__(cls)
+        vi.dim = header["dim"]
+        vi.matrix = np.load(os.path.join(dir_path, EMBEDDINGS_FILE), mmap_mode=mmap_mode)
+        vi.scales = np.load(os.path.join(dir_path, SCALES_FILE)) if header["quantized"] else None
+        if use_mmap and header["count"]:
+            offsets_path = os.path.join(dir_path, META_OFFSETS_FILE)
+            offsets = (np.load(offsets_path, mmap_mode="r") if os.path.exists(offsets_path)
+                       else _line_offsets(meta_path))
+            vi.records = _MappedRecords(meta_path, offsets)
+        else:
+            with open(meta_path, "r") as f:
+                vi.records = [json.loads(line) for line in f if line.strip()]
+
+        if len(vi.matrix) != len(vi.records):
+            raise ValueError(f"Vector index {dir_path}: {len(vi.matrix)} rows, {len(vi.records)} records")
+        if quantize and not vi.is_quantized:
+            if use_mmap:
+                logwarn("Quantizing a mapped vector index makes a private copy, "
+                        "quantize it when exporting instead")
+            vi.matrix, vi.scales = quantize_int8(vi.matrix)
+        vi.header = header
+        logmsg(f"Loaded vector index {dir_path}: {len(vi.records)} rows, {vi.nbytes() / 1e6:.1f} MB"
+               + (" (mapped)" if use_mmap else ""))
+        return vi
@@ -0,0 +1,195 @@
+#==================================================================
+# WebSearch.py
+#
+# Description: Web search providers, with rate limiting and timeouts
+#==================================================================
+
+import re
+import json
+import math
+import time
+from queue import Queue, Empty
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from threading import Lock
+from .logger import *
+from .StatsUtils import StatsCounter
+
+# Results are lists of dicts with: title, href, body (as from DDGS)
+
+#==================================================================
+class TokenBucket:
+    """ Global rate limit: `rate` requests per second, bursts up to `burst` """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_time = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self, timeout=None) -> bool:
+        """ Wait for a token, False if it can't be had within `timeout` """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+                self.last_time = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return True
+                wait = (1.0 - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+#==================================================================
+class DDGSBackend:
+    """ DuckDuckGo search, reusing a small pool of sessions """
+    name = "ddgs"
+
+    def __init__(self, pool_size=4, timeout=10):
+        self.timeout = timeout
+        self.pool = Queue()
+        self.pool_size = pool_size
+        self.n_created = 0
+        self.lock = Lock()
+
+    def _get_session(self):
+        try:
+            return self.pool.get_nowait()
+        except Empty:
+            pass
+        with self.lock:
+            if self.n_created < self.pool_size:
+                self.n_created += 1
+                from duckduckgo_search import DDGS
+                return DDGS(timeout=self.timeout)
+        return self.pool.get()
+
+    def search(self, query, max_results=None) -> list:
+        ddgs = self._get_session()
+        try:
+            return [r for r in ddgs.text(query, max_results=max_results)]
+        finally:
+            self.pool.put(ddgs)
+
+#==================================================================
+_token_re = re.compile(r"\w+")
+
+def _tokenize(text):
+    return _token_re.findall(text.lower())
+
+class FixtureBackend:
+    """ Offline search over a local JSONL file, for tests and benchmarks.
+        Each line is either {"query": ..., "results": [...]} (canned results
+        for that query) or a document {"title": ..., "href": ..., "body": ...}
+        Other queries are answered by term overlap (tf-idf) over the documents.
+        `latency` adds a fixed delay, to simulate a remote provider """
+    name = "fixture"
+
+    def __init__(self, path, latency=0.0):
+        self.latency = latency
+        self.canned = {}
+        self.docs = []
+        with open(path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                rec = json.loads(line)
+                if "query" in rec:
+                    self.canned[" ".join(_tokenize(rec["query"]))] = rec["results"]
+                else:
+                    self.docs.append(rec)
+
+        # Inverted index: term -> list of (doc index, term count)
+        self.postings = {}
+        for i, d in enumerate(self.docs):
+            for term, cnt in Counter(_tokenize(d.get("title", "") + " " + d.get("body", ""))).items():
+                self.postings.setdefault(term, []).append((i, cnt))
+        logmsg(f"Search fixture {path}: {len(self.canned)} queries, {len(self.docs)} documents")
+
+    def search(self, query, max_results=None) -> list:
+        if self.latency:
+            time.sleep(self.latency)
+        terms = _tokenize(query)
+        if (res := self.canned.get(" ".join(terms))) is not None:
+            return res[:max_results]
+
+        scores = {}
+        for term in set(terms):
+            if not (plist := self.postings.get(term)):
+                continue
+            idf = math.log(1 + len(self.docs) / len(plist))
+            for i, cnt in plist:
+                scores[i] = scores.get(i, 0.0) + (1 + math.log(cnt)) * idf
+        best = sorted(scores, key=scores.get, reverse=True)[:max_results or 10]
+        return [self.docs[i] for i in best]
+
+#==================================================================
+_lock = Lock()
+_backend = None
+_bucket = TokenBucket(rate=1.0, burst=4)
+_timeout = 10.0
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="websearch")
+_stats = StatsCounter({
+    "queries": 0,
+    "errors": 0,
+    "timeouts": 0,
+    "rate_limited": 0,
+    "total_time": 0.0,
+})
+
+def initialize(backend="ddgs", rate_per_sec=1.0, burst=4, timeout=10.0,
+               pool_size=4, fixture_path=None, fixture_latency=0.0):
+    """ Select the backend ("ddgs" or "fixture") and the limits """
+    global _backend, _bucket, _timeout
+    if backend == "fixture":
+        _backend = FixtureBackend(fixture_path, latency=fixture_latency)
+    elif backend == "ddgs":
+        _backend = DDGSBackend(pool_size=pool_size, timeout=int(math.ceil(timeout)))
+    else:
+        raise ValueError(f"Unknown search backend {backend}")
+    _bucket = TokenBucket(rate=rate_per_sec, burst=burst)
+    _timeout = timeout
+    logmsg(f"Web search backend: {backend}, {rate_per_sec}/s, burst {burst}, timeout {timeout}s")
+
+def get_backend():
+    global _backend
+    with _lock:
+        if _backend is None:
+            _backend = DDGSBackend(timeout=int(math.ceil(_timeout)))
+        return _backend
+
+def search(query, max_results=None) -> list:
+    """ Search with the current backend. Returns [] on errors, on timeout
+        and when the rate limit can't be met within the timeout """
+    backend = get_backend()
+    start_time = time.time()
+    _stats.add(queries=1)
+
+    if not _bucket.acquire(timeout=_timeout):
+        logwarn(f"Search rate-limited, dropping query: {query}")
+        _stats.add(rate_limited=1)
+        return []
+
+    remaining = max(0.1, _timeout - (time.time() - start_time))
+    fut = _executor.submit(backend.search, query, max_results)
+    try:
+        return fut.result(timeout=remaining)
+    except FutureTimeoutError:
+        logwarn(f"Search timed out after {_timeout}s: {query}")
+        _stats.add(timeouts=1)
+        return []
+    except Exception as e:
+        logerr(f"Search error for '{query}': {e}")
+        _stats.add(errors=1)
+        return []
+    finally:
+        _stats.add(total_time=time.time() - start_time)
+
+def get_stats() -> dict:
+    stats = _stats.get(ratios={"avg_time": ("total_time", "queries")})
+    with _lock:
+        stats["backend"] = _backend.name if _backend else None
+    return stats
@@ -9,8 +9,10 @@ import sys
 import json
 import time
 import uuid
+import hmac
+import functools
 from flask import Flask, jsonify, redirect, render_template, request, url_for
-from flask import make_response
+from flask import make_response, Response
 from flask_session import Session
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit, join_room
@@ -25,9 +27,25 @@ from Common import OAIUtils
 from Common import ChatAICore
 from Common.MsgThread import MsgThread
 from Common import AssistTools
+from Common import PromptCache
+from Common import ModelRouter
+from Common import UsageLedger
+from Common import ThreadCodec
+from Common import FactCheckCache
+from Common import ClaimDetector
+from Common import ResearchEngine
+from Common import WebSearch
+from Common import PageFetch
+from Common import ToolBudget
+from Common import IntentFastPath
+from Common import ConvoJudge
 
 USER_BUCKET_PATH = "user_a_00001"
 ENABLE_SLEEP_LOGGING = False
+# Mimetype for the binary thread transfer, see ThreadCodec
+BINARY_MIMETYPE = "application/x-msgpack"
+# Max seconds that /get_addendums waits for new fact-checks before replying
+FCHECK_POLL_WAIT = 5.0
 
 #===============================================================================
 # Load the environment variables, override the existing ones
@@ -45,6 +63,9 @@ with open(config_file) as f:
 with open(config['assistant_instructions'], 'r') as f:
     assistant_instructions = f.read()
 
+# Full system instructions, built once so that the prompt prefix is stable
+_main_instructions = ChatAICore.instrument_instructions(assistant_instructions)
+
 # Initialize OpenAI API
 _oa_wrap = OpenAIWrapper(api_key=os.environ.get("OPENAI_API_KEY"))
 
@@ -88,6 +109,10 @@ class AppClient:
         with self.lock:
             self._misc_dict[key] = value
 
+    def get_key(self, key):
+        with self.lock:
+            return self._misc_dict.get(key)
+
 # TODO: store this in a database
 _app_clients = {}
 
@@ -120,6 +145,9 @@ def client_consume_key(client_id, key):
 def client_set_key(client_id, key, value):
     get_app_client(client_id).set_key(key, value)
 
+def client_get_key(client_id, key):
+    return get_app_client(client_id).get_key(key)
+
 
 def local_get_user_info(arguments):
     # NOTE: This function is called by AssistTools and
@@ -138,16 +166,26 @@ def local_get_main_MsgThread(arguments):
 
 # Create the thread if it doesn't exist
 def create_msg_thread(client_id, force_new) -> None:
-    mt = None if force_new else client_get_msg_thread(client_id)
+    mt = client_get_msg_thread(client_id)
+    if force_new and mt is not None:
+        mt.release()
+        mt = None
     if mt is None:
         mt = MsgThread.create_thread(_oa_wrap)
+        # Bound the messages kept in RAM, older ones go to a spill file
+        if (window := config.get('thread_window_size', 0)) > 0:
+            mt.enable_windowing(
+                window=window,
+                spill_path=os.path.join(config.get('thread_spill_dir', '_spill'), mt.thread_id + ".jsonl"))
         client_set_msg_thread(client_id, mt)
         logmsg("Created new thread with ID " + mt.thread_id)
 
     # Create the sub-agents system for the message-thread
     mt.create_judge(
         model=config["support_model_version"],
-        temperature=config["support_model_temperature"])
+        temperature=config["support_model_temperature"],
+        claim_min_score=(config.get("factcheck_prefilter_min_score", 2)
+                         if config.get("factcheck_prefilter", True) else None))
 
 #===============================================================================
 _storage = None
@@ -159,12 +197,59 @@ if os.getenv("DO_STORAGE_CONTAINER") is not None:
         secret_key=os.getenv("DO_SPACES_SECRET_KEY"),
         endpoint=os.getenv("DO_STORAGE_SERVER"))
 
+#===============================================================================
+# Token usage and latency, per client and feature
+UsageLedger.initialize(
+    ledger_dir=config.get('usage_ledger_dir', '_usage'),
+    retention_days=config.get('usage_retention_days', 30))
+
+#===============================================================================
+# Workers of the speculative fact-checks, shared by all the clients
+ConvoJudge.initialize_speculative(
+    max_workers=config.get('factcheck_workers', 8),
+    max_inflight_segments=config.get('factcheck_max_inflight_segments', 4))
+
 #===============================================================================
 # Initialize the tools
+# Web search provider, shared by the tools, the research and the fact-checks
+WebSearch.initialize(
+    backend=config.get('web_search_backend', 'ddgs'),
+    rate_per_sec=config.get('web_search_rate_per_sec', 1.0),
+    burst=config.get('web_search_burst', 4),
+    timeout=config.get('web_search_timeout', 10.0),
+    pool_size=config.get('web_search_pool_size', 4),
+    fixture_path=config.get('web_search_fixture_path'))
+
+# Optional download and extraction of the top search results
+PageFetch.initialize(
+    enabled=config.get('web_fetch_pages', False),
+    cache_dir=config.get('web_fetch_cache_dir', '_page_cache'),
+    top_k=config.get('web_fetch_top_k', 3),
+    max_bytes=config.get('web_fetch_max_bytes', 512 * 1024),
+    timeout=config.get('web_fetch_timeout', 5.0))
+
+# Token budgets of the tool outputs added to the conversation
+ToolBudget.initialize(
+    enabled=config.get('tool_budget_enabled', True),
+    budgets=config.get('tool_token_budgets'))
+
+# Results of the trivial tools (e.g. local time) given with the first request
+IntentFastPath.initialize(
+    enabled=config.get('intent_fast_path', True),
+    assistant_name=config.get('assistant_name'),
+    fillers=config.get('intent_fillers'))
+
 AssistTools.initialize_tools(
     enable_rag=config.get('enable_rag', False),
     rag_query_instructions=config.get('rag_query_instructions'),
+    rag_top_k=config.get('rag_top_k', 5),
+    rag_backend=config.get('rag_backend', 'chroma'),
+    rag_quantize_int8=config.get('rag_quantize_int8', False),
+    rag_hybrid=config.get('rag_hybrid', True),
+    rag_rerank=config.get('rag_rerank', True),
     enable_web_search=config.get('enable_web_search', False),
+    research_fan_out_=config.get('research_fan_out', True),
+    tool_timeouts=config.get('tool_timeouts'),
     storage=_storage,
     super_get_user_info_=local_get_user_info,
     super_get_main_MsgThread_=local_get_main_MsgThread,
@@ -244,6 +329,61 @@ def user_info():
 
     return jsonify({'status': 'success'}) if not has_missing_fields else jsonify({'status': 'error'})
 
+#===============================================================================
+# The stats and usage endpoints are off unless "enable_admin_api" is set, and
+#  then they require the ADMIN_API_TOKEN env var as a bearer token
+def require_admin(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not config.get('enable_admin_api', False):
+            return jsonify({'error': 'Not found'}), 404
+        token = os.getenv('ADMIN_API_TOKEN')
+        if not token:
+            logerr("enable_admin_api is set, but ADMIN_API_TOKEN is not")
+            return jsonify({'error': 'Admin API not configured'}), 403
+        auth = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(auth.encode(), f"Bearer {token}".encode()):
+            return jsonify({'error': 'Unauthorized'}), 401
+        return fn(*args, **kwargs)
+    return wrapper
+
+@app.route('/api/stats', methods=['GET'])
+@require_admin
+def get_stats():
+    return jsonify({
+        'prompt_cache': PromptCache.get_stats(),
+        'model_router': ModelRouter.get_stats(),
+        'fact_check_cache': FactCheckCache.get_stats(),
+        'claim_detector': ClaimDetector.get_stats(),
+        'research': ResearchEngine.get_stats(),
+        'web_search': WebSearch.get_stats(),
+        'page_fetch': PageFetch.get_stats(),
+        'rag': AssistTools.get_rag_status(),
+        'tool_budget': ToolBudget.get_stats(),
+        'tools': AssistTools.registry.get_stats(),
+        'intent_fast_path': IntentFastPath.get_stats(),
+    }), 200
+
+# Readiness for the load balancer: 503 while the RAG is still loading
+@app.route('/api/ready', methods=['GET'])
+def get_ready():
+    rag = AssistTools.get_rag_status()
+    is_ready = rag['state'] != 'loading'
+    return jsonify({'ready': is_ready, 'rag': rag}), (200 if is_ready else 503)
+
+@app.route('/api/usage', methods=['GET'])
+@require_admin
+def get_usage():
+    days = request.args.get('days', default=1, type=int)
+    return jsonify({
+        'top_consumers': UsageLedger.top_consumers(
+            n=request.args.get('n', default=10, type=int),
+            days=days,
+            feature=request.args.get('feature'),
+            by=request.args.get('by', default='total_tokens')),
+        'by_feature': UsageLedger.summary_by_feature(days=days),
+    }), 200
+
 #===============================================================================
 @app.route('/clear_chat', methods=['POST'])
 def clear_chat():
@@ -337,7 +477,20 @@ def get_history():
     if not client_has_msg_thread(client_id=client_id):
         return jsonify({'error': 'No message thread loaded, please reload the page.'}), 400
 
-    return jsonify({'messages': client_get_msg_thread(client_id).make_messages_for_display()}), 200
+    mt = client_get_msg_thread(client_id)
+
+    # Binary transfer for clients that ask for it (much smaller/faster for big threads)
+    if (request.accept_mimetypes.best == BINARY_MIMETYPE and
+            'msgpack' in ThreadCodec.available_codecs()):
+        data = mt.to_bytes(codec='msgpack', compress=request.args.get('compress') == '1')
+        return Response(data, mimetype=BINARY_MIMETYPE), 200
+
+    # Optional paging, e.g. ?start=0&count=50 , to load big threads in parts
+    start = request.args.get('start', default=0, type=int)
+    count = request.args.get('count', default=None, type=int)
+    return jsonify({
+        'messages': mt.make_messages_for_display(start=start, count=count),
+        'total': mt.num_messages()}), 200
 
 #===============================================================================
 @socketio.on('connect')
@@ -363,27 +516,24 @@ def get_addendums():
     if not client_has_msg_thread(client_id):
         return jsonify({'error': 'No message thread loaded, please reload the page.'}), 400
 
-    # Do we have fact-checks to return
+    # Start the fact-checks in the background, if requested
     do_gen_fc = client_consume_key(client_id, 'generate_fchecks')
-    if do_gen_fc is None or not do_gen_fc:
-        return jsonify({'addendums': [], 'message': 'No pending fact-checks', 'final': True}), 200
+    if do_gen_fc:
+        job = client_get_msg_thread(client_id).start_fact_check(tools_user_data=client_id)
+        client_set_key(client_id, 'fcheck_job', job)
 
-    # We get the fact checks directly in JSON format
-    fc_str = client_get_msg_thread(client_id).gen_fact_check(tools_user_data=client_id)
-    if fc_str is None:
+    if (job := client_get_key(client_id, 'fcheck_job')) is None:
         return jsonify({'addendums': [], 'message': 'No pending fact-checks', 'final': True}), 200
 
-    logmsg(f"Got fact-checks: {fc_str}")
-
-    try:
-        fc = json.loads(fc_str)
-    except ValueError as e:
-        logerr(f"Error parsing fact-checks: {e}")
-        return jsonify({'addendums': [], 'message': 'Error parsing fact-checks', 'final': True}), 200
+    # Hand out the fact-checks completed so far, the client polls until final
+    fchecks, is_done = job.take_new(timeout=FCHECK_POLL_WAIT)
+    if is_done:
+        client_consume_key(client_id, 'fcheck_job')
 
-    logmsg(f"FC JSON {fc}")
+    logmsg(f"Got fact-checks: {fchecks}, done: {is_done}")
 
-    return jsonify({'addendums': [fc], 'final': True}), 200
+    addendums = [{'fact_checks': fchecks}] if fchecks else []
+    return jsonify({'addendums': addendums, 'final': is_done}), 200
 
 #===============================================================================
 @socketio.on('send_message')
@@ -406,21 +556,40 @@ def handle_send_message(json, methods=['GET', 'POST']):
     def stream_openai_response(client_id, ws_session_id):
 
         mt = client_get_msg_thread(client_id)
+        start_time = time.time()
+
+        completion_msgs = mt.make_messages_for_completion(20)
+
+        # Pick the model for this turn (fast model for the easy ones)
+        route = ModelRouter.route_turn(
+            wrap=_oa_wrap,
+            config=config,
+            user_text=msg_text,
+            history=completion_msgs[:-1],
+            client_id=client_id)
 
         response = OAIUtils.completion_with_tools(
             wrap=_oa_wrap,
-            model=config["model_version"],
-            temperature=config["model_temperature"],
-            instructions=ChatAICore.instrument_instructions(assistant_instructions),
-            role_and_content_msgs=mt.make_messages_for_completion(20),
+            model=route.model,
+            temperature=route.temperature,
+            instructions=_main_instructions,
+            role_and_content_msgs=completion_msgs,
             tools_user_data=client_id,
-            stream=True  # Enable streaming
+            stream=True,  # Enable streaming
+            feature="chat"
         )
 
         # Create the assistant message, which will be added to the message thread
         assist_msg = mt.create_assistant_message("")
         src_id = assist_msg['src_id']
 
+        # Fact-check the paragraphs as they arrive, the results are handed out
+        #  by /get_addendums as for the regular fact-check
+        spec_fcheck = None
+        if config['support_enable_factcheck'] and config.get('factcheck_speculative', True):
+            spec_fcheck = mt.start_speculative_fact_check(src_id, tools_user_data=client_id)
+            client_set_key(client_id, 'fcheck_job', spec_fcheck)
+
         # Send the response in parts and collect the full text
         reply_text = ""
         for part in response:
@@ -428,16 +597,22 @@ def handle_send_message(json, methods=['GET', 'POST']):
                 #print("<END>")
                 continue
             reply_text += part
+            if spec_fcheck:
+                spec_fcheck.feed(part)
             #print(part, end="")
             socketio.emit('stream', {'src_id': src_id, 'text': part}, room=ws_session_id)
         #print("")
 
+        if spec_fcheck:
+            spec_fcheck.finish(reply_text)
+
         # End the stream with a special signal, e.g., 'END'
         socketio.emit('stream', {'src_id': src_id, 'text': 'END'}, room=ws_session_id)
 
         mt.update_message(src_id, reply_text)
+        ModelRouter.record_latency(route, time.time() - start_time)
 
-        if config['support_enable_factcheck']:
+        if config['support_enable_factcheck'] and not spec_fcheck:
             client_set_key(client_id, 'generate_fchecks', True)
 
     # Call this new streaming function instead of appending replies directly
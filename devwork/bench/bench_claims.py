@@ -0,0 +1,81 @@
+#==================================================================
+# bench_claims.py
+#
+# Description: Fact-check pre-filter, calls saved vs claims missed
+#
+# Usage:
+#   python devwork/bench/bench_claims.py              # default min score
+#   python devwork/bench/bench_claims.py --verbose    # list the errors
+#==================================================================
+
+import os
+import sys
+import json
+import time
+import argparse
+
+# Update the path for the modules below
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from app_web.Common import ClaimDetector
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), "claims_labeled.jsonl")
+
+# Fail if the default setting misses more than this fraction of the claims
+MAX_MISSED_RATIO = 0.1
+
+#==================================================================
+def load_samples():
+    with open(DATA_PATH, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def evaluate(samples, min_score):
+    res = {"calls_saved": 0, "claims_missed": 0, "false_alarms": 0, "errors": []}
+    for s in samples:
+        found = ClaimDetector.has_claims((("text", s["text"]),), min_score)
+        if not found:
+            res["calls_saved"] += 1
+        if s["checkable"] and not found:
+            res["claims_missed"] += 1
+            res["errors"].append(("missed", s["text"]))
+        elif not s["checkable"] and found:
+            res["false_alarms"] += 1
+            res["errors"].append(("false alarm", s["text"]))
+    return res
+
+def main():
+    parser = argparse.ArgumentParser(description='Claim detector benchmark')
+    parser.add_argument('--verbose', action='store_true', help='list the misclassified samples')
+    args = parser.parse_args()
+
+    samples = load_samples()
+    n_pos = sum(1 for s in samples if s["checkable"])
+    print(f"{len(samples)} samples, {n_pos} with checkable claims")
+    print(f"  {'min_score':>9} {'calls saved':>12} {'claims missed':>14} {'false alarms':>13}")
+
+    for min_score in range(1, 5):
+        r = evaluate(samples, min_score)
+        mark = " <- default" if min_score == ClaimDetector.DEFAULT_MIN_SCORE else ""
+        print(f"  {min_score:>9} {r['calls_saved']:>6} ({r['calls_saved'] / len(samples):4.0%})"
+              f" {r['claims_missed']:>7} ({r['claims_missed'] / n_pos:4.0%})"
+              f" {r['false_alarms']:>6} ({r['false_alarms'] / (len(samples) - n_pos):4.0%}){mark}")
+
+    t0 = time.perf_counter()
+    for _ in range(10):
+        evaluate(samples, ClaimDetector.DEFAULT_MIN_SCORE)
+    per_msg = (time.perf_counter() - t0) / (10 * len(samples))
+    print(f"Time per message: {per_msg * 1e6:.1f} us")
+
+    r = evaluate(samples, ClaimDetector.DEFAULT_MIN_SCORE)
+    if args.verbose:
+        for kind, text in r["errors"]:
+            print(f"  {kind}: {text!r}")
+
+    if r["claims_missed"] / n_pos > MAX_MISSED_RATIO:
+        print(f"FAIL: missed ratio above {MAX_MISSED_RATIO:.0%}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
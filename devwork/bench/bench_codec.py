@@ -0,0 +1,100 @@
+#==================================================================
+# bench_codec.py
+#
+# Description: MsgThread serialization, JSON path vs binary codecs
+#
+# Usage:
+#   python devwork/bench/bench_codec.py            # run and compare
+#   python devwork/bench/bench_codec.py --update   # store new baselines
+#==================================================================
+
+import os
+import sys
+import argparse
+
+# Update the path for the modules below
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from bench_utils import run_curve, load_baselines, save_baselines, compare_to_baselines
+from bench_hotpaths import make_thread_messages, _FakeWrap
+from app_web.Common.MsgThread import MsgThread
+from app_web.Common import ThreadCodec
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "baselines_codec.json")
+
+THREAD_SIZES = [10, 100, 1000, 10000]
+
+#==================================================================
+def make_thread(n_msgs):
+    mt = MsgThread(wrap=_FakeWrap(), thread_id="thread_bench")
+    for msg in make_thread_messages(n_msgs):
+        mt.add_message(msg)
+    return mt
+
+def new_empty_thread():
+    return MsgThread(wrap=_FakeWrap(), thread_id="thread_bench")
+
+def make_encode_bench(codec, compress):
+    def make(n_msgs):
+        mt = make_thread(n_msgs)
+        if codec is None:
+            return lambda: mt.serialize_data()
+        return lambda: mt.to_bytes(codec=codec, compress=compress)
+    return make
+
+def make_decode_bench(codec, compress):
+    def make(n_msgs):
+        mt = make_thread(n_msgs)
+        data = mt.serialize_data() if codec is None else mt.to_bytes(codec=codec, compress=compress)
+        return lambda: new_empty_thread().deserialize_data(data)
+    return make
+
+# (name, codec, compress), codec None is the legacy JSON path
+VARIANTS = [("json_legacy", None, False), ("json", "json", False)]
+if "msgpack" in ThreadCodec.available_codecs():
+    # Compressed with zlib when zstandard is not installed (it's optional)
+    VARIANTS += [("msgpack", "msgpack", False),
+                 ("msgpack_zstd" if ThreadCodec.zstandard else "msgpack_zlib", "msgpack", True)]
+
+def print_sizes():
+    mt = make_thread(THREAD_SIZES[-1])
+    print(f"Encoded size for {THREAD_SIZES[-1]} messages:")
+    for name, codec, compress in VARIANTS:
+        data = mt.serialize_data() if codec is None else mt.to_bytes(codec=codec, compress=compress)
+        print(f"  {name:<16} {len(data) / 1024:10.1f} KB")
+
+def main():
+    parser = argparse.ArgumentParser(description='Thread codec benchmarks')
+    parser.add_argument('--update', action='store_true',
+                        help='store the results as the new baselines')
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help='override the time tolerance factor (e.g. 1.5)')
+    args = parser.parse_args()
+
+    results = {}
+    for name, codec, compress in VARIANTS:
+        results[f"encode_{name}"] = run_curve(f"encode_{name}", THREAD_SIZES, make_encode_bench(codec, compress))
+        results[f"decode_{name}"] = run_curve(f"decode_{name}", THREAD_SIZES, make_decode_bench(codec, compress))
+
+    print_sizes()
+
+    if args.update:
+        save_baselines(BASELINES_PATH, results, {})
+        print(f"Baselines saved to {BASELINES_PATH}")
+        return 0
+
+    regressions = compare_to_baselines(
+        results, load_baselines(BASELINES_PATH), time_tolerance=args.tolerance)
+    if regressions:
+        print("REGRESSIONS:")
+        for r in regressions:
+            print(f"  {r}")
+        return 1
+
+    print("No regressions")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
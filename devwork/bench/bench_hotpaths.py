@@ -0,0 +1,232 @@
+#==================================================================
+# bench_hotpaths.py
+#
+# Description: Microbenchmarks for the per-message pure-Python paths
+#
+# Usage:
+#   python devwork/bench/bench_hotpaths.py                 # run and compare
+#   python devwork/bench/bench_hotpaths.py --update        # store new baselines
+#   python devwork/bench/bench_hotpaths.py --only judge    # filter by name
+#==================================================================
+
+import os
+import sys
+import json
+import random
+import argparse
+from types import SimpleNamespace
+
+# Update the path for the modules below
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from bench_utils import run_curve, load_baselines, save_baselines, compare_to_baselines
+from app_web.Common.MsgThread import MsgThread, MsgRecord, META_TAG
+from app_web.Common.ConvoJudge import ConvoJudge
+from app_web.Common.JsonStream import JsonArrayStreamParser
+from app_web.Common import logger
+from app_web.Common import AnnotUtils
+from app_web.Common import OAIUtils
+from app_web.Common import AssistTools
+from app_web.Common.OpenAIWrapper import OpenAIWrapper
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "baselines_hotpaths.json")
+
+MSG_SIZES = [1 << 10, 1 << 12, 1 << 14, 1 << 16, 1 << 18, 1 << 20]  # 1 KB .. 1 MB
+THREAD_SIZES = [10, 100, 1000, 10000]
+
+# Per-benchmark overrides of the defaults in bench_utils (e.g. "max_slope"),
+# stored with the baselines. Don't raise a slope ceiling to hide a
+# quadratic path, fix the path instead.
+THRESHOLDS = {}
+
+#==================================================================
+class _FakeWrap(OpenAIWrapper):
+    def __init__(self):
+        pass
+
+    # Post-tool completion returns an empty stream
+    def CreateCompletion(self, **kwargs):
+        return iter([])
+
+_rnd = random.Random(1234)
+
+WORDS = ("the quick brown fox jumps over lazy dog 2024 $42.5 (approx) "
+         "e=mc^2 {json: true} [list] 東京 naïve café").split()
+
+def make_text(n_bytes):
+    out = []
+    size = 0
+    while size < n_bytes:
+        w = _rnd.choice(WORDS)
+        out.append(w)
+        size += len(w) + 1
+    return " ".join(out)[:n_bytes]
+
+def make_meta():
+    return f"<{META_TAG}>\nunix_time: 1700000000\n</{META_TAG}>\n"
+
+#==================================================================
+def bench_deinstrument(size):
+    # A user message with a meta header every ~4 KB, as when pasting
+    # older transcripts back into the chat
+    chunk = 4096
+    parts = []
+    for _ in range(max(1, size // chunk)):
+        parts.append(make_meta())
+        parts.append(make_text(min(size, chunk)))
+    msg = "".join(parts)
+    return lambda: MsgThread.deinstrument_user_message(msg)
+
+def bench_stream_json_entries(size):
+    # Fact-check entries, fed in small streamed deltas
+    n_checks = max(1, size // 256)
+    obj = {"fact_checks": [{
+                "msg_id": f"msg_{i:08d}",
+                "correctness": i % 6,
+                "rebuttal": make_text(160) + ' "quoted" \\ escaped',
+            } for i in range(n_checks)]}
+    response = json.dumps(obj)
+    parts = [response[i:i+8] for i in range(0, len(response), 8)]
+
+    def run():
+        parser = JsonArrayStreamParser("fact_checks")
+        for part in parts:
+            parser.feed(part)
+    return run
+
+def bench_apply_highlight(size):
+    msg = make_text(size)
+    # Add some color escape sequences in the middle
+    msg = logger.make_color(logger.COL_CYAN, msg[:size // 2]) + msg[size // 2:]
+    return lambda: logger.apply_highlight(msg)
+
+def make_thread_messages(n_msgs, msg_size=400):
+    msgs = []
+    for i in range(n_msgs):
+        role = "user" if (i % 2) == 0 else "assistant"
+        text = make_text(msg_size)
+        if role == "user":
+            text = make_meta() + text
+        msgs.append({
+            "src_id": f"msg_{i:08d}",
+            "created_at": 1700000000 + i,
+            "role": role,
+            "content": [{"type": "text", "value": text}],
+        })
+    return msgs
+
+def bench_build_convo(n_msgs):
+    judge = ConvoJudge(model="none", temperature=0.0)
+    for msg in make_thread_messages(n_msgs):
+        judge.AddMessage(MsgRecord.from_dict(msg))
+    return lambda: judge.buildConvoString(n_msgs)
+
+def bench_messages_for_display(n_msgs):
+    mt = MsgThread(wrap=_FakeWrap(), thread_id="thread_bench")
+    for msg in make_thread_messages(n_msgs):
+        mt.add_message(msg)
+    return lambda: mt.make_messages_for_display()
+
+def bench_update_message(n_msgs):
+    mt = MsgThread(wrap=_FakeWrap(), thread_id="thread_bench")
+    for msg in make_thread_messages(n_msgs):
+        mt.add_message(msg)
+    # Updating the oldest message is the worst case for a linear scan
+    src_id = mt.messages[0].src_id
+    def run():
+        for _ in range(100):
+            mt.update_message(src_id, "updated")
+    return run
+
+def bench_resolve_image_annotations(size):
+    text = make_text(size)
+    annotations = []
+    # One image link every ~2 KB
+    for start in range(0, max(1, len(text) - 64), 2048):
+        path = f"sandbox:/mnt/data/image_{start}.png"
+        annotations.append(SimpleNamespace(
+            type="file_path",
+            text=path,
+            start_index=start,
+            end_index=start + 32,
+            file_path=SimpleNamespace(file_id=f"file-{start}")))
+    make_url = lambda file_id, name: f"https://cdn.example.com/{file_id}_{name}"
+    return lambda: AnnotUtils.ResolveImageAnnotations(text, annotations, make_url)
+
+#==================================================================
+
+def _make_chunk(tool_calls=None, content=None):
+    delta = SimpleNamespace(tool_calls=tool_calls, content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+def _make_call_delta(index, id=None, name=None, arguments=None):
+    return SimpleNamespace(
+        index=index,
+        id=id,
+        function=SimpleNamespace(name=name, arguments=arguments))
+
+def bench_stream_tool_deltas(size):
+    # Arguments of `size` bytes streamed in 4-byte deltas
+    payload = json.dumps({"query": make_text(size)})
+    chunks = [_make_chunk([_make_call_delta(0, id="call_0", name="get_unix_time")])]
+    for i in range(0, len(payload), 4):
+        chunks.append(_make_chunk([_make_call_delta(0, arguments=payload[i:i+4])]))
+    chunks.append(_make_chunk(content=None))
+    wrap = _FakeWrap()
+
+    def run():
+        for _ in OAIUtils.handle_stream(iter(chunks), wrap, "none", 0.0, [], None):
+            pass
+    return run
+
+#==================================================================
+BENCHES = [
+    ("deinstrument_user_message", MSG_SIZES, bench_deinstrument),
+    ("stream_json_entries",       MSG_SIZES, bench_stream_json_entries),
+    ("apply_highlight",           MSG_SIZES, bench_apply_highlight),
+    ("judge_buildConvoString",    THREAD_SIZES, bench_build_convo),
+    ("MsgThread_update_message",  THREAD_SIZES, bench_update_message),
+    ("MsgThread_for_display",     THREAD_SIZES, bench_messages_for_display),
+    ("ResolveImageAnnotations",   MSG_SIZES, bench_resolve_image_annotations),
+    ("handle_stream_tool_deltas", MSG_SIZES, bench_stream_tool_deltas),
+]
+
+def main():
+    parser = argparse.ArgumentParser(description='Hot-path microbenchmarks')
+    parser.add_argument('--update', action='store_true',
+                        help='store the results as the new baselines')
+    parser.add_argument('--only', default=None,
+                        help='run only the benchmarks containing this string')
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help='override the time tolerance factor (e.g. 1.5)')
+    args = parser.parse_args()
+
+    # Needed by handle_stream to dispatch the tool call
+    AssistTools.initialize_tools(enable_web_search=False)
+
+    results = {}
+    for name, sizes, make_fn in BENCHES:
+        if args.only and args.only not in name:
+            continue
+        results[name] = run_curve(name, sizes, make_fn)
+
+    if args.update:
+        save_baselines(BASELINES_PATH, results, THRESHOLDS)
+        print(f"Baselines saved to {BASELINES_PATH}")
+        return 0
+
+    regressions = compare_to_baselines(
+        results, load_baselines(BASELINES_PATH), time_tolerance=args.tolerance)
+    if regressions:
+        print("REGRESSIONS:")
+        for r in regressions:
+            print(f"  {r}")
+        return 1
+
+    print("No regressions")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
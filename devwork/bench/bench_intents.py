@@ -0,0 +1,81 @@
+#==================================================================
+# bench_intents.py
+#
+# Description: Intent fast-path detection, hits vs wrong tool results
+#
+# Usage:
+#   python devwork/bench/bench_intents.py
+#   python devwork/bench/bench_intents.py --verbose    # list the errors
+#
+# Uses the assistant name and the fillers of app_web/config_mei.json.
+# The labeled messages in intents_labeled.jsonl include questions about
+# other times and dates (e.g. "What day did WW2 end?"). A wrong intent
+# puts an unrelated tool result in the request, so any fails the run.
+#==================================================================
+
+import os
+import sys
+import json
+import time
+import argparse
+
+# Update the path for the modules below
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from app_web.Common import IntentFastPath
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), "intents_labeled.jsonl")
+CONFIG_PATH = Path(__file__).resolve().parent.parent.parent / "app_web" / "config_mei.json"
+
+#==================================================================
+def load_samples():
+    with open(DATA_PATH, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def main():
+    parser = argparse.ArgumentParser(description='Intent fast-path benchmark')
+    parser.add_argument('--verbose', action='store_true', help='list the misclassified samples')
+    args = parser.parse_args()
+
+    # Same fillers and assistant name as the app
+    with open(CONFIG_PATH, "r") as f:
+        config = json.load(f)
+    IntentFastPath.initialize(
+        assistant_name=config.get("assistant_name"), fillers=config.get("intent_fillers"))
+
+    samples = load_samples()
+    n_pos = sum(1 for s in samples if s["intents"])
+    hits = 0
+    errors = []
+    for s in samples:
+        found = IntentFastPath.detect_intents(s["text"])
+        if found == s["intents"]:
+            hits += bool(found)
+        elif found:
+            errors.append(("wrong", s["text"], found))
+        else:
+            errors.append(("missed", s["text"], s["intents"]))
+    n_wrong = sum(1 for kind, _, _ in errors if kind == "wrong")
+
+    print(f"{len(samples)} samples, {n_pos} with an intent")
+    print(f"  hits {hits}/{n_pos} ({hits / n_pos:.0%}), "
+          f"missed {len(errors) - n_wrong}, wrong {n_wrong}")
+
+    t0 = time.perf_counter()
+    for _ in range(100):
+        for s in samples:
+            IntentFastPath.detect_intents(s["text"])
+    print(f"Time per message: {(time.perf_counter() - t0) / (100 * len(samples)) * 1e6:.1f} us")
+
+    if args.verbose:
+        for kind, text, intents in errors:
+            print(f"  {kind}: {text!r} {intents}")
+
+    if n_wrong:
+        print("FAIL: intents found in messages without them")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+#==================================================================
+# bench_retrieval.py
+#
+# Description: RAG retrieval quality, vector vs BM25 vs hybrid (+ rerank)
+#
+# Usage:
+#   python devwork/bench/bench_retrieval.py              # 3000 chunks
+#   python devwork/bench/bench_retrieval.py --rows 10000
+#
+# Synthetic knowledge base: chunks on a few topics, each chunk with its own
+# name (like a recipe or a product), and embeddings that know the topics but
+# not the names, as with real embedding models and rare terms.
+# Two kinds of queries, for a known target chunk:
+#   - "name": the name of the chunk plus a topic word, embedded near the topic
+#   - "semantic": paraphrase without the name, embedded near the chunk
+# A target missed in the top-k is a search the model would have to retry.
+#==================================================================
+
+import sys
+import time
+import argparse
+import numpy as np
+
+# Update the path for the modules below
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from app_web.Common.VectorIndex import VectorIndex
+from app_web.Common.LexicalIndex import LexicalIndex, hybrid_rank
+
+DIM = 256
+TOP_K = 5
+# Same as RAG_HYBRID_CANDIDATES_FACTOR in AssistTools
+CANDIDATES_FACTOR = 4
+N_QUERIES = 200
+N_TOPICS = 50
+WORDS_PER_TOPIC = 40
+CHUNK_WORDS = 80
+
+METHODS = ["vector", "bm25", "hybrid", "hybrid+rerank"]
+
+#==================================================================
+def make_words(rng, n):
+    """ Pronounceable pseudo-words, unique """
+    syl = [c + v for c in "bcdfglmnprstvz" for v in "aeiou"]
+    out = set()
+    while len(out) < n:
+        out.add("".join(rng.choice(syl, rng.integers(2, 4))))
+    return sorted(out)
+
+def make_data(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    words = make_words(rng, N_TOPICS * WORDS_PER_TOPIC + 2 * n_rows + 200)
+    common = words[:200]
+    topic_words = [words[200 + t * WORDS_PER_TOPIC:200 + (t + 1) * WORDS_PER_TOPIC]
+                   for t in range(N_TOPICS)]
+    names = words[200 + N_TOPICS * WORDS_PER_TOPIC:]
+
+    centers = rng.standard_normal((N_TOPICS, DIM)).astype(np.float32)
+    topics = rng.integers(0, N_TOPICS, n_rows)
+    emb = centers[topics] + 0.6 * rng.standard_normal((n_rows, DIM)).astype(np.float32)
+
+    texts = []
+    for i, t in enumerate(topics):
+        body = list(rng.choice(topic_words[t], CHUNK_WORDS // 2)) + \
+               list(rng.choice(common, CHUNK_WORDS // 2))
+        rng.shuffle(body)
+        name = f"{names[2 * i]} {names[2 * i + 1]}"
+        texts.append(f"{name}. " + " ".join(body))
+
+    targets = rng.choice(n_rows, N_QUERIES, replace=False)
+    queries = []
+    for kind in ("name", "semantic"):
+        for i in targets:
+            t = topics[i]
+            if kind == "name":
+                text = f"{names[2 * i]} {names[2 * i + 1]} {rng.choice(topic_words[t])}"
+                q_emb = centers[t] + 0.6 * rng.standard_normal(DIM)
+            else:
+                # Paraphrase: a few topic words of the chunk, and some not in it
+                own = [w for w in set(texts[i].split()[2:]) if w in topic_words[t]]
+                text = " ".join(list(rng.choice(own, 2)) + list(rng.choice(topic_words[t], 2)))
+                q_emb = emb[i] + 0.5 * rng.standard_normal(DIM)
+            queries.append((kind, int(i), text, q_emb.astype(np.float32)))
+    return emb, texts, queries
+
+#==================================================================
+def run_method(method, vi, li, texts, query, q_emb):
+    n_candidates = TOP_K * CANDIDATES_FACTOR
+    if method == "bm25":
+        return li.search(query, TOP_K)[0]
+    if method == "vector":
+        return vi.search_ids(q_emb, TOP_K)[0][0]
+    vec_ids, vec_scores = vi.search_ids(q_emb, n_candidates)[0]
+    ids, _ = hybrid_rank(li, query, vec_ids, vec_scores, n_candidates, get_text=texts.__getitem__,
+                         rerank=(method == "hybrid+rerank"))
+    return ids[:TOP_K]
+
+def main():
+    parser = argparse.ArgumentParser(description='Retrieval benchmark')
+    parser.add_argument('--rows', type=int, default=3000, help='number of indexed chunks')
+    args = parser.parse_args()
+
+    emb, texts, queries = make_data(args.rows)
+    t = time.perf_counter()
+    vi = VectorIndex(emb, [{"text": s, "metadata": {}} for s in texts])
+    li = LexicalIndex(texts)
+    print(f"{args.rows} chunks, {len(queries)} queries, indexed in {time.perf_counter() - t:.2f}s")
+
+    print(f"  {'method':<14} {f'recall@{TOP_K} name':>14} {f'recall@{TOP_K} semantic':>18} "
+          f"{'retries':>8} {'ms/query':>9}")
+    for method in METHODS:
+        hits = {"name": 0, "semantic": 0}
+        t = time.perf_counter()
+        for kind, target, query, q_emb in queries:
+            if target in run_method(method, vi, li, texts, query, q_emb):
+                hits[kind] += 1
+        elapsed = time.perf_counter() - t
+        n = len(queries) // 2
+        print(f"  {method:<14} {hits['name'] / n:14.3f} {hits['semantic'] / n:18.3f} "
+              f"{len(queries) - sum(hits.values()):8d} {1e3 * elapsed / len(queries):9.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#==================================================================
+# bench_tool_budget.py
+#
+# Description: Tool outputs before and after ToolBudget, with checks
+#
+# Usage:
+#   python devwork/bench/bench_tool_budget.py
+#
+# Synthetic outputs of the tools, as returned by them (the knowledge base
+# one both as a list and as json.dumps() text, as older tools do).
+# Fails if a fitted output is not valid JSON, is over the budget of the
+# tool, or if the knowledge base results were not compacted.
+#==================================================================
+
+import sys
+import json
+import random
+
+# Update the path for the modules below
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from app_web.Common import ToolBudget
+from app_web.Common.TextUtils import estimate_tokens
+
+_rnd = random.Random(1234)
+
+WORDS = ("la cucina italiana è semplice the recipe uses fresh tomatoes basil "
+         "olive oil garlic pasta 200g 12 minutes perché così naïve café").split()
+
+def make_text(n_chars):
+    out = []
+    while sum(len(w) + 1 for w in out) < n_chars:
+        out.append(_rnd.choice(WORDS))
+    return " ".join(out)[:n_chars]
+
+def make_kb_results(n=8, text_chars=2500):
+    results = [{
+        "score": _rnd.random(),
+        "text": make_text(text_chars),
+        "metadata": {
+            "file_name": f"article_{i}.md",
+            "title": f"Article {i}",
+            "file_path": f"/data/articles/article_{i}.md",
+            "file_size": 12345,
+            "creation_date": "2024-01-01",
+            "last_modified_date": "2024-02-01",
+        }} for i in range(n)]
+    # A chunk retrieved twice (e.g. by both the vector and the BM25 search)
+    results.append(dict(results[0]))
+    return results
+
+def make_web_results(n=10, body_chars=300, passages_chars=3000):
+    return [{
+        "title": f"Result {i}",
+        "href": f"https://example.com/page/{i}?utm_source=x",
+        "body": make_text(body_chars),
+        "passages": make_text(passages_chars) if i < 3 else "",
+    } for i in range(n)]
+
+CASES = [
+    ("search_knowledge_base", "list", make_kb_results),
+    ("search_knowledge_base", "json text", lambda: json.dumps(make_kb_results())),
+    ("perform_web_search",    "list", make_web_results),
+    ("ask_research_assistant", "text", lambda: "\n\n".join(make_text(600) for _ in range(40))),
+]
+
+#==================================================================
+def main():
+    ToolBudget.initialize(enabled=True)
+    failures = []
+    print(f"  {'tool':<24} {'response':<10} {'tokens in':>10} {'tokens out':>11} {'budget':>7}")
+    for tool, kind, make_response in CASES:
+        response = make_response()
+        content = ToolBudget.make_tool_content(tool, response)
+        n_in = estimate_tokens(response if isinstance(response, str) else json.dumps(response))
+        n_out = estimate_tokens(content)
+        budget = ToolBudget.get_budget(tool)
+        print(f"  {tool:<24} {kind:<10} {n_in:10d} {n_out:11d} {budget:7d}")
+
+        try:
+            fitted = json.loads(content)
+        except ValueError as e:
+            failures.append(f"{tool} ({kind}): not valid JSON: {e}")
+            continue
+        if n_out > budget:
+            failures.append(f"{tool} ({kind}): {n_out} tokens, over the budget of {budget}")
+        if tool == "search_knowledge_base":
+            if not isinstance(fitted, list):
+                failures.append(f"{tool} ({kind}): results not compacted as a list")
+            elif any("file_path" in (r.get("metadata") or {}) for r in fitted):
+                failures.append(f"{tool} ({kind}): metadata not compacted")
+            elif len({r["text"][:100] for r in fitted}) != len(fitted):
+                failures.append(f"{tool} ({kind}): duplicates not dropped")
+
+    if failures:
+        print("FAILURES:")
+        for f in failures:
+            print(f"  {f}")
+        return 1
+    print("All outputs valid and within budget")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
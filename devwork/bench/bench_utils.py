@@ -0,0 +1,148 @@
+#==================================================================
+# bench_utils.py
+#
+# Description: Helpers for timing, scaling curves and stored baselines
+#==================================================================
+
+import os
+import gc
+import json
+import math
+import time
+import platform
+
+# Minimum wall-time spent per measurement, to keep small sizes stable
+MIN_MEASURE_TIME = 0.2
+MAX_REPEATS = 50
+
+# Default regression thresholds
+DEFAULT_TIME_TOLERANCE = 1.5    # Fail if slower than baseline by this factor
+DEFAULT_MAX_SLOPE = 1.35        # Fail if log-log slope goes above this (1.0 = linear)
+
+# Wall-time spent timing the calibration loop
+CALIBRATION_MIN_TIME = 0.5
+
+#==================================================================
+def measure(fn, min_time=MIN_MEASURE_TIME, max_repeats=MAX_REPEATS) -> float:
+    """ Return the best time in seconds for a single call of fn() """
+    best = math.inf
+    total = 0.0
+    n = 0
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        while n < max_repeats and (n == 0 or total < min_time):
+            t0 = time.perf_counter()
+            fn()
+            dt = time.perf_counter() - t0
+            best = min(best, dt)
+            total += dt
+            n += 1
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return best
+
+def fit_slope(sizes, times) -> float:
+    """ Least-squares slope of log(time) over log(size).
+        ~1.0 means linear, ~2.0 means quadratic """
+    xs = [math.log(s) for s in sizes]
+    ys = [math.log(max(t, 1e-9)) for t in times]
+    n = len(xs)
+    if n < 2:
+        return 0.0
+    mx = sum(xs) / n
+    my = sum(ys) / n
+    den = sum((x - mx) ** 2 for x in xs)
+    if den == 0:
+        return 0.0
+    return sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / den
+
+def run_curve(name, sizes, make_fn, tail_points=3, log=print) -> dict:
+    """ Run a scaling curve. make_fn(size) returns the callable to time.
+        The slope is fit on the largest sizes only, where the asymptotic
+        behavior dominates the fixed per-call overhead """
+    times = []
+    for size in sizes:
+        fn = make_fn(size)
+        t = measure(fn)
+        times.append(t)
+        log(f"  {name:<32} size={size:<9} {t * 1e3:10.3f} ms")
+    slope = fit_slope(sizes[-tail_points:], times[-tail_points:])
+    log(f"  {name:<32} slope={slope:.2f}")
+    return {"sizes": list(sizes), "times": times, "slope": slope}
+
+def _calibration_work():
+    # Plain interpreter work (dicts, strings, lists), like the hot paths
+    d = {}
+    for i in range(20000):
+        s = str(i)
+        d[s] = len(s)
+    "".join(d)
+    sorted(d.values())
+
+_calibration = None
+
+def calibration_time() -> float:
+    """ Time of a fixed reference loop on this machine, measured once.
+        Stored with the baselines, the times are compared relative to it,
+        so that a faster or slower machine doesn't fail or hide regressions """
+    global _calibration
+    if _calibration is None:
+        _calibration = measure(_calibration_work, min_time=CALIBRATION_MIN_TIME)
+    return _calibration
+
+#==================================================================
+def load_baselines(path) -> dict:
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_baselines(path, results, thresholds):
+    """ Store the results, keeping the baselines of benchmarks not re-run """
+    data = {
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "benchmarks": load_baselines(path).get("benchmarks", {}),
+    }
+    for name, res in results.items():
+        data["benchmarks"][name] = dict(
+            res, calibration=calibration_time(), **thresholds.get(name, {}))
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+def compare_to_baselines(results, baselines, time_tolerance=None, log=print) -> list:
+    """ Return a list of human-readable regressions (empty if all good) """
+    regressions = []
+    base_benches = baselines.get("benchmarks", {})
+    for name, res in results.items():
+        base = base_benches.get(name)
+        max_slope = (base or {}).get("max_slope", DEFAULT_MAX_SLOPE)
+        # Scaling check works even without a stored baseline
+        if res["slope"] > max_slope:
+            regressions.append(f"{name}: slope {res['slope']:.2f} > {max_slope:.2f}")
+
+        if base is None:
+            log(f"  {name}: no baseline stored")
+            continue
+        # Absolute times of another machine can't be compared
+        if not base.get("calibration"):
+            log(f"  {name}: baseline without calibration, times not compared")
+            continue
+
+        # Baseline times as if measured on this machine
+        scale = calibration_time() / base["calibration"]
+        tol = time_tolerance or base.get("time_tolerance", DEFAULT_TIME_TOLERANCE)
+        base_times = dict(zip(base["sizes"], base["times"]))
+        for size, t in zip(res["sizes"], res["times"]):
+            bt = base_times.get(size)
+            if bt is None:
+                continue
+            if t > bt * scale * tol:
+                regressions.append(
+                    f"{name}@{size}: {t * 1e3:.3f} ms > {bt * scale * 1e3:.3f} ms x {tol:.2f}"
+                    f" (baseline x {scale:.2f} for this machine)")
+    return regressions
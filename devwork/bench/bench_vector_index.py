@@ -0,0 +1,173 @@
+#==================================================================
+# bench_vector_index.py
+#
+# Description: RAG retrieval, in-process VectorIndex vs Chroma
+#
+# Usage:
+#   python devwork/bench/bench_vector_index.py                # 5000 chunks
+#   python devwork/bench/bench_vector_index.py --rows 20000   # bigger base
+#
+# Each backend runs in its own process, so that the load time includes
+# the imports and the memory is the RSS growth of a clean interpreter.
+# "private MB" is the anonymous memory only, what each extra worker process
+# costs (mapped files are in the OS cache, shared by the processes).
+# The data is synthetic (clustered embeddings), results are exact top-k
+# from the float32 matrix, to measure the recall of int8 and of Chroma (HNSW).
+#==================================================================
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import subprocess
+import numpy as np
+
+# Update the path for the modules below
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+BACKENDS = ["numpy", "numpy_mmap", "numpy_int8", "chroma"]
+# As from text-embedding-ada-002 / text-embedding-3-small
+DIM = 1536
+TOP_K = 5
+N_QUERIES = 64
+# Queries per call in the batched runs (e.g. research query variants)
+BATCH_SIZE = 8
+
+#==================================================================
+def make_data(n_rows, dim, n_queries, seed=0):
+    """ Clustered unit vectors (similar chunks of the same article),
+        queries close to random rows """
+    rng = np.random.default_rng(seed)
+    n_clusters = max(1, n_rows // 20)
+    centers = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    emb = centers[rng.integers(0, n_clusters, n_rows)] + \
+          0.5 * rng.standard_normal((n_rows, dim)).astype(np.float32)
+    queries = emb[rng.integers(0, n_rows, n_queries)] + \
+              0.7 * rng.standard_normal((n_queries, dim)).astype(np.float32)
+    emb /= np.linalg.norm(emb, axis=1, keepdims=True)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return emb, queries
+
+def build_all(data_dir, emb, queries):
+    from app_web.Common.VectorIndex import VectorIndex
+    records = [{"text": f"chunk {i}", "metadata": {"file_name": f"doc_{i // 20}.md"}}
+               for i in range(len(emb))]
+    VectorIndex(emb, records).save(os.path.join(data_dir, "numpy"))
+    VectorIndex(emb, records, quantize=True).save(os.path.join(data_dir, "numpy_int8"))
+
+    import chromadb
+    client = chromadb.PersistentClient(path=os.path.join(data_dir, "chroma"))
+    coll = client.get_or_create_collection("quickstart", metadata={"hnsw:space": "cosine"})
+    for sta in range(0, len(emb), 1000):
+        end = min(sta + 1000, len(emb))
+        coll.add(ids=[str(i) for i in range(sta, end)],
+                 embeddings=emb[sta:end].tolist(),
+                 documents=[r["text"] for r in records[sta:end]],
+                 metadatas=[r["metadata"] for r in records[sta:end]])
+
+    np.save(os.path.join(data_dir, "queries.npy"), queries)
+    exact = np.argsort(-(queries @ emb.T), axis=1)[:, :TOP_K]
+    np.save(os.path.join(data_dir, "exact.npy"), exact)
+
+#==================================================================
+def get_rss_mb():
+    """ (total, anonymous) resident memory, anonymous is 0 where unknown """
+    try:
+        with open("/proc/self/status", "r") as f:
+            fields = dict(line.split(":", 1) for line in f)
+        return (int(fields["VmRSS"].split()[0]) / 1e3, int(fields["RssAnon"].split()[0]) / 1e3)
+    except (OSError, KeyError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3, 0.0
+
+def run_child(backend, data_dir):
+    """ Load one backend, run the queries, print the results as JSON """
+    queries = np.load(os.path.join(data_dir, "queries.npy"))
+    rss_start = get_rss_mb()
+    start_time = time.perf_counter()
+
+    if backend.startswith("numpy"):
+        from app_web.Common.VectorIndex import VectorIndex
+        if backend == "numpy_mmap":
+            index = VectorIndex.load(os.path.join(data_dir, "numpy"), use_mmap=True)
+        else:
+            index = VectorIndex.load(os.path.join(data_dir, backend))
+        def search(qs):
+            return [[int(r["text"].split()[1]) for _, r in res] for res in index.search(qs, TOP_K)]
+    else:
+        import chromadb
+        client = chromadb.PersistentClient(path=os.path.join(data_dir, "chroma"))
+        coll = client.get_or_create_collection("quickstart")
+        def search(qs):
+            res = coll.query(query_embeddings=qs.tolist(), n_results=TOP_K)
+            return [[int(i) for i in ids] for ids in res["ids"]]
+
+    # The first query completes the loading (e.g. the HNSW index)
+    search(queries[:1])
+    load_time = time.perf_counter() - start_time
+
+    single = []
+    found = []
+    for q in queries:
+        t = time.perf_counter()
+        found += search(q[None, :])
+        single.append(time.perf_counter() - t)
+
+    t = time.perf_counter()
+    for sta in range(0, len(queries), BATCH_SIZE):
+        search(queries[sta:sta + BATCH_SIZE])
+    batch_time = (time.perf_counter() - t) / (len(queries) / BATCH_SIZE)
+
+    exact = np.load(os.path.join(data_dir, "exact.npy"))
+    recall = np.mean([len(set(f) & set(e.tolist())) / TOP_K for f, e in zip(found, exact)])
+    rss_end = get_rss_mb()
+    print(json.dumps({
+        "load_s": load_time,
+        "rss_mb": rss_end[0] - rss_start[0],
+        "private_mb": rss_end[1] - rss_start[1],
+        "single_ms": 1e3 * float(np.median(single)),
+        "batch_ms": 1e3 * batch_time,
+        "recall": float(recall),
+    }))
+
+#==================================================================
+def main():
+    parser = argparse.ArgumentParser(description='Vector index benchmark')
+    parser.add_argument('--rows', type=int, default=5000, help='number of indexed chunks')
+    parser.add_argument('--dim', type=int, default=DIM, help='embedding size')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--data', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.data)
+        return
+
+    data_dir = tempfile.mkdtemp(prefix="bench_vi_")
+    try:
+        print(f"Building {args.rows} x {args.dim} indices...")
+        emb, queries = make_data(args.rows, args.dim, N_QUERIES)
+        build_all(data_dir, emb, queries)
+
+        print(f"  {'backend':<11} {'load s':>7} {'RSS MB':>7} {'private MB':>11} {'1 query ms':>11} "
+              f"{f'{BATCH_SIZE} queries ms':>14} {f'recall@{TOP_K}':>9}")
+        for backend in BACKENDS:
+            out = subprocess.run(
+                [sys.executable, __file__, "--child", backend, "--data", data_dir],
+                capture_output=True, text=True)
+            if out.returncode != 0:
+                print(f"  {backend:<11} failed: {out.stderr.strip().splitlines()[-1:]}")
+                continue
+            r = json.loads(out.stdout.strip().splitlines()[-1])
+            print(f"  {backend:<11} {r['load_s']:7.2f} {r['rss_mb']:7.1f} {r['private_mb']:11.1f} "
+                  f"{r['single_ms']:11.2f} "
+                  f"{r['batch_ms']:14.2f} {r['recall']:9.3f}")
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,8 @@ from app_web.Common.logger import *
 This script will index all *.md files found in SOURCE_DIR.
 The index will be persisted to INDEX_PERSIST_DIR.
 The Chroma data will be persisted to CHROMA_PERSIST_DIR.
+The same chunks and embeddings are exported to VECTOR_INDEX_DIR, for the
+in-process index (see app_web/Common/VectorIndex.py, "rag_backend": "numpy").
 These persist directories will then be uploaded to the cloud storage
 with StorageCloud.
 """
@@ -30,6 +32,8 @@ SOURCE_DIR = "_source_for_db"
 INDEX_PERSIST_DIR = "_index_data"
 # Directory for persisting Chroma data
 CHROMA_PERSIST_DIR = "_chroma_db"
+# Directory for the in-process vector index
+VECTOR_INDEX_DIR = "_vector_index"
 
 TEST_DIR_PREFIX = "_tmp_test_"
 
@@ -58,6 +62,34 @@ def create_index_and_db(force_reindex=False):
         storage_context = StorageContext.from_defaults(persist_dir=INDEX_PERSIST_DIR, vector_store=vector_store)
         index = load_index_from_storage(storage_context)
 
+def export_vector_index(chroma_persist_dir=CHROMA_PERSIST_DIR, out_dir=VECTOR_INDEX_DIR, quantize=False):
+    """ Copy the chunks and their embeddings from Chroma to a VectorIndex,
+        and build the LexicalIndex of the chunks """
+    from llama_index.core import Settings
+    from llama_index.core.vector_stores.utils import metadata_dict_to_node
+    from app_web.Common.VectorIndex import VectorIndex
+    from app_web.Common.LexicalIndex import LexicalIndex
+
+    db = chromadb.PersistentClient(path=chroma_persist_dir)
+    chroma_collection = db.get_or_create_collection("quickstart")
+    data = chroma_collection.get(include=["embeddings", "documents", "metadatas"])
+
+    # Same text and metadata as returned by the llama-index retriever
+    records = []
+    for doc, meta in zip(data["documents"], data["metadatas"]):
+        node = metadata_dict_to_node(meta, text=doc)
+        records.append({"text": node.text, "metadata": node.metadata})
+
+    logmsg(f"Exporting {len(records)} chunks to {out_dir}...")
+    vi = VectorIndex(data["embeddings"], records, quantize=quantize)
+    vi.save(out_dir, extra_header={"embed_model": Settings.embed_model.model_name})
+
+    # BM25 over the same rows, for the exact terms. Titles and file names
+    #  are included, they often hold the names being searched
+    LexicalIndex([
+        " ".join([r["text"]] + [str(r["metadata"].get(k, "")) for k in ("title", "file_name")])
+        for r in records]).save(out_dir)
+
 def test_query(index_perist_dir, chroma_persist_dir, search_str):
     # Initialize Chroma client
     logmsg(f"Initializing Chroma client with {chroma_persist_dir}...")
@@ -98,6 +130,10 @@ def upload_to_storage():
         local_dir=CHROMA_PERSIST_DIR,
         target_dir=CHROMA_PERSIST_DIR,
         use_file_listing=True)
+    storage.upload_dir(
+        local_dir=VECTOR_INDEX_DIR,
+        target_dir=VECTOR_INDEX_DIR,
+        use_file_listing=True)
 
 def test_download_from_storage():
     import filecmp
@@ -137,6 +173,8 @@ def test_download_from_storage():
 if __name__ == "__main__":
     # First create the index and the database
     #create_index_and_db(force_reindex=True)
+    # Export for the in-process index
+    export_vector_index()
     # Do a test query
     test_query(
         INDEX_PERSIST_DIR,